@@ -0,0 +1,314 @@
+"""
+Backtests the calls in the trades table against local OHLCV candles, for the
+expected value the README couldn't work out:
+
+    python backtest.py --candles klines/ --target 3 --out outcomes.csv
+
+Candles are one CSV per symbol (klines/BTCUSDT.csv), in the column order of
+Binance's kline dumps: open time (ms), open, high, low, close, ... Each call
+is followed the way the bots trade it: a limit entry at the far end of the
+entry zone, then a stop loss and a take profit at targets[--target], sold at
+market if neither hits within --expiry-hours. Every call is simulated at once
+with NumPy, a window of candles per call.
+"""
+import argparse
+import csv
+import datetime
+import os
+import numpy as np
+from db import make_engine, make_session
+from models import Trade
+
+ORDER_EXPIRY_TIME_HOURS = 14 * 24  # the bots' default
+CHUNK_ELEMENTS = 4_000_000  # candles looked at in one go, bounds memory
+
+OPEN, HIGH, LOW, CLOSE = range(1, 5)
+
+OUTCOMES = ("NO_DATA", "NO_ENTRY", "STOP_LOSS", "TAKE_PROFIT", "EXPIRED")
+
+
+def load_candles(path: str) -> np.ndarray:
+    """
+    (n, 5) float array of open time (ms), open, high, low, close. Parsed CSVs
+    are cached next to them as .npy, a year of minute bars is slow to parse.
+    """
+    cache = os.path.splitext(path)[0] + ".npy"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return np.load(cache)
+    with open(path) as f:
+        header = not f.readline().split(",")[0].strip().isdigit()
+    candles = np.loadtxt(
+        path, delimiter=",", usecols=range(5), skiprows=int(header), ndmin=2
+    )
+    candles = candles[np.argsort(candles[:, 0], kind="stable")]
+    np.save(cache, candles)
+    return candles
+
+
+class CandleBook:
+    """
+    Every symbol's candles back to back in one array, each followed by
+    `padding` rows of NaN, so a window running past a symbol's last candle
+    reads NaN rather than the next symbol's candles.
+    """
+
+    def __init__(self, candles: dict[str, np.ndarray], padding: int):
+        self.offsets: dict[str, tuple[int, int]] = {}
+        parts = []
+        offset = 0
+        for symbol, rows in candles.items():
+            self.offsets[symbol] = (offset, offset + len(rows))
+            parts.append(rows)
+            parts.append(np.full((padding, 5), np.nan))
+            offset += len(rows) + padding
+        self.data = np.concatenate(parts) if parts else np.empty((0, 5))
+
+    def locate(self, symbol: str, time_ms: float) -> tuple[int, int]:
+        """(index of the first candle at or after time_ms, end of the symbol's candles)"""
+        start, end = self.offsets[symbol]
+        i = np.searchsorted(self.data[start:end, 0], time_ms, side="left")
+        return start + int(i), end
+
+
+def first_crossing(
+    series: np.ndarray, starts: np.ndarray, levels: np.ndarray, width: int, below: bool
+) -> np.ndarray:
+    """
+    For each call, the offset from its start of the first candle in the next
+    `width` whose `series` is at or below (or above) its level, -1 if none
+    """
+    result = np.full(len(starts), -1, dtype=np.int64)
+    if width <= 0:
+        return result
+    steps = np.arange(width)
+    rows = max(1, CHUNK_ELEMENTS // width)
+    for chunk in range(0, len(starts), rows):
+        part = slice(chunk, chunk + rows)
+        window = series[starts[part, None] + steps]
+        level = levels[part, None]
+        hit = window <= level if below else window >= level
+        found = hit.any(axis=1)
+        result[part] = np.where(found, hit.argmax(axis=1), -1)
+    return result
+
+
+def simulate(
+    book: CandleBook,
+    symbols: list[str],
+    times_ms: np.ndarray,
+    buy: np.ndarray,
+    entry: np.ndarray,
+    stop_loss: np.ndarray,
+    target: np.ndarray,
+    width: int,
+    interval_ms: float,
+) -> dict[str, np.ndarray]:
+    """
+    Outcome of every call. A candle that crosses both the stop loss and the
+    target counts as a stop loss, we can't tell which came first.
+    """
+    n = len(symbols)
+    located = [book.locate(s, t) for s, t in zip(symbols, times_ms)]
+    starts = np.array([start for start, _ in located], dtype=np.int64)
+    ends = np.array([end for _, end in located], dtype=np.int64)
+    data = book.data
+
+    outcome = np.zeros(n, dtype=np.int64)  # NO_DATA
+    entry_index = np.full(n, -1, dtype=np.int64)
+    exit_index = np.full(n, -1, dtype=np.int64)
+    entry_price = np.full(n, np.nan)
+    exit_price = np.full(n, np.nan)
+
+    # Calls from before the candles start (or after they end) can't be followed
+    covered = starts < ends
+    covered[covered] = data[starts[covered], 0] - times_ms[covered] <= interval_ms
+
+    for side in (True, False):
+        calls = np.flatnonzero((buy == side) & covered)
+        if not len(calls):
+            continue
+        # Limit entry: buys fill once the low comes down to it, sells the high up
+        hit = first_crossing(
+            data[:, LOW if side else HIGH], starts[calls], entry[calls], width, side
+        )
+        # An entry window cut short by the end of the data can't be called either way
+        outcome[calls] = np.where(
+            (hit < 0) & (starts[calls] + width > ends[calls]),
+            OUTCOMES.index("NO_DATA"),
+            OUTCOMES.index("NO_ENTRY"),
+        )
+        entered = calls[hit >= 0]
+        entry_index[entered] = starts[entered] + hit[hit >= 0]
+        opens = data[entry_index[entered], OPEN]
+        entry_price[entered] = (np.minimum if side else np.maximum)(
+            opens, entry[entered]
+        )
+
+        # Exits are placed once the entry has filled, from the next candle on
+        after = entry_index[entered] + 1
+        stop_hit = first_crossing(
+            data[:, LOW if side else HIGH], after, stop_loss[entered], width, side
+        )
+        target_hit = first_crossing(
+            data[:, HIGH if side else LOW], after, target[entered], width, not side
+        )
+        never = np.iinfo(np.int64).max
+        stop_at = np.where(stop_hit >= 0, stop_hit, never)
+        target_at = np.where(target_hit >= 0, target_hit, never)
+
+        stopped = (stop_at <= target_at) & (stop_at != never)
+        took_profit = (target_at < stop_at) & ~stopped
+        expired = ~stopped & ~took_profit
+        last = after + width - 1
+        complete = last < ends[entered]
+
+        index = np.where(
+            stopped, after + stop_at, np.where(took_profit, after + target_at, last)
+        )
+        opens = data[np.minimum(index, len(data) - 1), OPEN]
+        gapped_stop = (np.minimum if side else np.maximum)(opens, stop_loss[entered])
+        gapped_target = (np.maximum if side else np.minimum)(opens, target[entered])
+        price = np.where(
+            stopped,
+            gapped_stop,
+            np.where(
+                took_profit,
+                gapped_target,
+                data[np.minimum(index, len(data) - 1), CLOSE],
+            ),
+        )
+
+        result = np.select(
+            [stopped, took_profit, expired & complete],
+            [
+                OUTCOMES.index("STOP_LOSS"),
+                OUTCOMES.index("TAKE_PROFIT"),
+                OUTCOMES.index("EXPIRED"),
+            ],
+            OUTCOMES.index("NO_DATA"),
+        )
+        outcome[entered] = result
+        resolved = result != OUTCOMES.index("NO_DATA")
+        exit_index[entered[resolved]] = index[resolved]
+        exit_price[entered[resolved]] = price[resolved]
+
+    direction = np.where(buy, 1.0, -1.0)
+    returns = direction * (exit_price / entry_price - 1)
+    return {
+        "outcome": outcome,
+        "entry_index": entry_index,
+        "exit_index": exit_index,
+        "entry_price": entry_price,
+        "exit_price": exit_price,
+        "return": returns,
+    }
+
+
+def load_calls(session, target_num: int) -> list[Trade]:
+    return [
+        trade
+        for trade in session.query(Trade).order_by(Trade.id).all()
+        if len(trade.targets) > target_num
+    ]
+
+
+def to_ms(timestamp: datetime.datetime) -> float:
+    # Telegram message dates, stored without their (UTC) timezone
+    return timestamp.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--candles", required=True, help="directory of SYMBOL.csv")
+    parser.add_argument("--db", default="tradingbot.db")
+    parser.add_argument("--target", type=int, default=3, help="index into targets")
+    parser.add_argument("--expiry-hours", type=float, default=ORDER_EXPIRY_TIME_HOURS)
+    parser.add_argument("--fee", type=float, default=0.0, help="per side, e.g. 0.001")
+    parser.add_argument("--out", help="per call outcomes as CSV")
+    args = parser.parse_args()
+
+    engine = make_engine(f"sqlite:///{args.db}")
+    trades = load_calls(make_session(engine), args.target)
+    symbols = sorted({trade.symbol for trade in trades})
+    candles = {}
+    for symbol in symbols:
+        path = os.path.join(args.candles, f"{symbol}.csv")
+        if os.path.exists(path):
+            candles[symbol] = load_candles(path)
+    trades = [trade for trade in trades if trade.symbol in candles]
+    if not trades:
+        print("No calls with candles to backtest")
+        return
+
+    interval_ms = float(
+        np.median(np.concatenate([np.diff(c[:, 0]) for c in candles.values()]))
+    )
+    width = int(round(args.expiry_hours * 60 * 60 * 1000 / interval_ms))
+    book = CandleBook(candles, padding=2 * width + 1)
+
+    buy = np.array([trade.side == "BUY" for trade in trades])
+    results = simulate(
+        book,
+        [trade.symbol for trade in trades],
+        np.array([to_ms(trade.timestamp) for trade in trades]),
+        buy,
+        np.array(
+            [
+                max(trade.entry) if trade.side == "BUY" else min(trade.entry)
+                for trade in trades
+            ]
+        ),
+        np.array([trade.stop_loss for trade in trades], dtype=float),
+        np.array([trade.targets[args.target] for trade in trades], dtype=float),
+        width,
+        interval_ms,
+    )
+    returns = results["return"] - 2 * args.fee
+
+    outcome = results["outcome"]
+    for i, name in enumerate(OUTCOMES):
+        print(f"{name:<12} {np.count_nonzero(outcome == i)}")
+    traded = ~np.isnan(returns)
+    if traded.any():
+        print(
+            f"Expected value => {1 + returns[traded].mean():.4f} per unit staked "
+            f"over {np.count_nonzero(traded)} trades "
+            f"(win rate {np.mean(returns[traded] > 0):.1%})"
+        )
+
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                [
+                    "id",
+                    "symbol",
+                    "side",
+                    "outcome",
+                    "entry_time",
+                    "entry_price",
+                    "exit_time",
+                    "exit_price",
+                    "return",
+                ]
+            )
+            data = book.data
+            for i, trade in enumerate(trades):
+                entry_at, exit_at = results["entry_index"][i], results["exit_index"][i]
+                writer.writerow(
+                    [
+                        trade.id,
+                        trade.symbol,
+                        trade.side,
+                        OUTCOMES[outcome[i]],
+                        int(data[entry_at, 0]) if entry_at >= 0 else "",
+                        results["entry_price"][i],
+                        int(data[exit_at, 0]) if exit_at >= 0 else "",
+                        results["exit_price"][i],
+                        returns[i],
+                    ]
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+"""
+Step-latency benchmark: replays recorded exchange responses into one
+FuturesBot/SpotBot step over a DB of 10 to 10,000 trades spread across the
+lifecycle, and writes wall time, API calls, SQL statements and peak memory
+per phase to a JSON file, so versions can be compared:
+
+    python benchmark.py --bot futures --trades 10 100 1000 10000 --out futures.json
+
+Fixtures (the DB before the step plus every response the step got from the
+exchange simulator) are recorded on first use into --fixtures and reused
+after that. Re-record them with --record when the bots start making requests
+the recording doesn't have (reported as replay_misses).
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, urlsplit
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from sqlalchemy import event, text
+from db import make_engine, make_session
+from exchange_cache import index_exchange_info
+from fills import fills_from_response
+from migrate import migrate
+from models import Trade
+from simulator import Market, Simulator, futures_order, spot_order
+from utils import decimal_string, format_quantity
+
+PHASES = (
+    "begin_step",
+    "detect_fills",
+    "cull_expired_orders",
+    "open_new_trades",
+    "end_step",
+)
+# Change with every request, so they're not part of what identifies one
+VOLATILE_PARAMS = {"timestamp", "signature", "recvWindow"}
+REPLAYED_HEADERS = ("X-MBX-USED-WEIGHT-1M", "Retry-After")
+SYMBOLS = 20
+WEIGHT_LIMIT = 10**9  # the recording shouldn't be shaped by the rate limiter
+EXPIRED_AGE = datetime.timedelta(days=15)
+
+
+def request_key(request: requests.PreparedRequest) -> str:
+    url = urlsplit(request.url)
+    params = parse_qsl(url.query)
+    if request.body:
+        body = request.body
+        params += parse_qsl(body.decode() if isinstance(body, bytes) else body)
+    params = sorted((k, v) for k, v in params if k not in VOLATILE_PARAMS)
+    return json.dumps([request.method, url.path, params])
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Sends requests for real and keeps every response, in order, per request"""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.recordings: dict[str, list[dict]] = {}
+
+    def send(self, request, *args, **kwargs):
+        response = super().send(request, *args, **kwargs)
+        recording = {
+            "status": response.status_code,
+            "headers": {
+                k: response.headers[k]
+                for k in REPLAYED_HEADERS
+                if k in response.headers
+            },
+            "body": response.text,
+        }
+        with self.lock:
+            self.recordings.setdefault(request_key(request), []).append(recording)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answers from a recording. Repeated requests get the recorded responses in
+    order (the last one once they run out), unknown ones a 400.
+    """
+
+    def __init__(self, recordings: dict[str, list[dict]]):
+        super().__init__()
+        self.recordings = recordings
+        self.lock = threading.Lock()
+        self.served: dict[str, int] = {}
+        self.misses = 0
+        self.on_request = lambda: None
+
+    def send(self, request, *args, **kwargs):
+        self.on_request()
+        key = request_key(request)
+        with self.lock:
+            recorded = self.recordings.get(key)
+            if recorded is None:
+                self.misses += 1
+                recording = {
+                    "status": 400,
+                    "headers": {},
+                    "body": json.dumps({"code": -1000, "msg": "Not recorded"}),
+                }
+            else:
+                n = self.served.get(key, 0)
+                self.served[key] = n + 1
+                recording = recorded[min(n, len(recorded) - 1)]
+
+        response = requests.Response()
+        response.status_code = recording["status"]
+        response.headers.update(recording["headers"])
+        response._content = recording["body"].encode()
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.reason = "Recorded"
+        return response
+
+    def close(self):
+        pass
+
+
+def make_bot(kind: str, url: str, session, logger, adapter, exchange_info_path):
+    """The bot, with its client's HTTP going through `adapter` from the start"""
+    if kind == "futures":
+        import futures_bot as module
+        from binance.um_futures import UMFutures as client_class
+    else:
+        import spot_bot as module
+        from binance.spot import Spot as client_class
+
+    class Client(client_class):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+
+    setattr(module, client_class.__name__, Client)
+    module.EXCHANGE_INFO_PATH = exchange_info_path
+    module.EXCHANGE_INFO_TTL = 10**9  # never refresh it in the background
+    bot_class = module.FuturesBot if kind == "futures" else module.SpotBot
+    return bot_class("key", "secret", url, session, logger)
+
+
+def quiet_logger() -> logging.Logger:
+    # Log records still get built (the bots log f-strings), just not written
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    return logger
+
+
+def price_paths() -> dict[str, list[float]]:
+    """Tick 0 is what the DB is seeded at, tick 1 what the step sees"""
+    return {
+        f"BENCH{i}USDT": [10.0 ** (i % 5), 10.0 ** (i % 5) * 0.998]
+        for i in range(SYMBOLS)
+    }
+
+
+def seed_trades(bot, market: Market, kind: str, n: int):
+    """
+    n calls, by tenths: 4 NEW (half already staged), 2 waiting on their entry
+    (some filling during the step), 3 protected (some stopping out) and 1 CLOSED.
+    A few of the open orders are old enough to be culled.
+    """
+    session = bot.session
+    symbols = list(market.price_paths)
+    now = datetime.datetime.now()
+    expired_ms = int((now - EXPIRED_AGE).timestamp() * 1000)
+    for i in range(n):
+        symbol = symbols[i % len(symbols)]
+        p = market.price_paths[symbol][0]
+        side = "SELL" if kind == "futures" and i % 2 else "BUY"
+        d = 1 if side == "BUY" else -1
+        kind_of = i % 10
+        if kind_of in (4, 5):
+            # BUY entries below the price, the tick 1 drop fills some of them
+            entry = [p * (1 - d * 0.003), p * (1 - d * (0.001 + 0.004 * (i % 3 == 0)))]
+        else:
+            entry = [p * 0.995, p * 1.005]
+        tight_stop = kind_of in (6, 7, 8) and i % 30 < 10
+        trade = Trade(
+            symbol=symbol,
+            side=side,
+            entry=entry,
+            stop_loss=p * (1 - d * (0.0015 if tight_stop else 0.02)),
+            targets=[p * (1 + d * 0.005 * k) for k in range(1, 7)],
+            timestamp=now - datetime.timedelta(seconds=n - i),
+            texthash=f"bench-{i}",
+        )
+        session.add(trade)
+        if kind_of == 9:
+            trade.closed = 1
+            continue
+        if kind_of <= 3:
+            if kind_of <= 1:
+                trade.order_templates = {
+                    bot.market: bot.build_order_templates(
+                        trade, bot.get_symbol_info(symbol)
+                    )
+                }
+            continue
+
+        templates = bot.build_order_templates(trade, bot.get_symbol_info(symbol))
+        trade.order_templates = {bot.market: templates}
+        order = market.new_order(kind, templates["open_order"])
+        expired = i % 20 in (4, 7)
+        if kind == "futures":
+            open_order = futures_order(order, with_time=False)
+            open_order.setdefault("time", open_order["updateTime"])
+        else:
+            open_order = spot_order(order, full=True)
+        if expired:
+            open_order["time"] = expired_ms
+        trade.open_order = open_order
+        if kind_of in (4, 5):
+            continue
+
+        # Protected: the entry filled right away, the exits are resting
+        if kind == "futures":
+            for order_type, params in bot.tpsl_order_params(trade):
+                exit_order = futures_order(market.new_order(kind, params), False)
+                exit_order["time"] = expired_ms if expired else exit_order["updateTime"]
+                setattr(trade, order_type, exit_order)
+        else:
+            bot.record_fills(
+                trade, "open_order", order["orderId"], fills_from_response(open_order)
+            )
+            target = dict(templates["targets"][3])
+            target["quantity"] = decimal_string(
+                format_quantity(bot.held_quantity(trade), bot.get_symbol_info(symbol))
+            )
+            exit_order = spot_order(market.new_order(kind, target), full=True)
+            exit_order["time"] = expired_ms if expired else exit_order["transactTime"]
+            trade.take_profit_order = exit_order
+    session.commit()
+
+
+def record(kind: str, n: int, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    logger = quiet_logger()
+    market = Market(
+        price_paths(), quote_balance=n * 10_000.0, weight_limit=WEIGHT_LIMIT
+    )
+    market.fixed_tick = 0
+    simulator = Simulator(market, logger)
+    simulator.start()
+
+    exchange_info = market.exchange_info(kind)
+    exchange_info_path = os.path.join(directory, "exchange_info.json")
+    with open(exchange_info_path, "w") as f:
+        json.dump(
+            {
+                "updated_at": time.time(),
+                "symbols": index_exchange_info(exchange_info),
+                "rate_limits": exchange_info["rateLimits"],
+            },
+            f,
+        )
+
+    workdir = tempfile.mkdtemp()
+    engine = make_engine(f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    migrate(engine, logger)
+    adapter = RecordingAdapter()
+    bot = make_bot(
+        kind, simulator.url, make_session(engine), logger, adapter, exchange_info_path
+    )
+    seed_trades(bot, market, kind, n)
+    bot.session.close()
+
+    db_path = os.path.join(directory, "trades.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    with engine.connect() as conn:
+        conn.execute(text(f"VACUUM INTO '{db_path}'"))
+
+    market.fixed_tick = 1
+    bot.step()
+    simulator.stop()
+    engine.dispose()
+    shutil.rmtree(workdir)
+    with open(os.path.join(directory, "responses.json"), "w") as f:
+        json.dump(
+            {"recorded_at": time.time(), "recordings": adapter.recordings},
+            f,
+        )
+
+
+class StepProbe:
+    """Counts time, requests, SQL statements and peak memory per step phase"""
+
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.phase = "step"
+        self.depth = 0
+        self.max_peak = 0
+        self.stats = {
+            phase: {"seconds": 0.0, "api_calls": 0, "sql_statements": 0}
+            for phase in ("step", *PHASES)
+        }
+
+    def on_request(self):
+        self.stats[self.phase]["api_calls"] += 1
+
+    def on_statement(self, *args):
+        self.stats[self.phase]["sql_statements"] += 1
+
+    @contextmanager
+    def measure(self, phase: str):
+        previous, self.phase = self.phase, phase
+        self.depth += 1
+        if self.trace_memory:
+            start, peak = tracemalloc.get_traced_memory()
+            # reset_peak is global, keep what the enclosing phase has seen so far
+            self.max_peak = max(self.max_peak, peak)
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stats[phase]["seconds"] += time.perf_counter() - started
+            self.depth -= 1
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.max_peak = max(self.max_peak, peak)
+                if self.depth == 0:
+                    peak = self.max_peak
+                self.stats[phase]["peak_kib"] = max(
+                    self.stats[phase].get("peak_kib", 0), (peak - start) // 1024
+                )
+            self.phase = previous
+
+    def wrap(self, bot):
+        for phase in PHASES:
+
+            def measured(*args, _phase=phase, _fn=getattr(bot, phase), **kwargs):
+                with self.measure(_phase):
+                    return _fn(*args, **kwargs)
+
+            setattr(bot, phase, measured)
+
+
+def replay(kind: str, directory: str, trace_memory: bool) -> tuple[dict, int]:
+    """One step over a fresh copy of the fixture. (per phase stats, misses)"""
+    with open(os.path.join(directory, "responses.json")) as f:
+        fixture = json.load(f)
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "bench.db")
+    shutil.copy(os.path.join(directory, "trades.db"), db_path)
+    engine = make_engine(f"sqlite:///{db_path}")
+    logger = quiet_logger()
+    migrate(engine, logger)
+    # Move the trades forward to now, for the lookback and expiry windows
+    shift = f"+{int(time.time() - fixture['recorded_at'])} seconds"
+    with engine.begin() as conn:
+        conn.execute(
+            text("UPDATE trades SET timestamp = datetime(timestamp, :shift)"),
+            {"shift": shift},
+        )
+        conn.execute(
+            text("UPDATE orders SET created_time = datetime(created_time, :shift)"),
+            {"shift": shift},
+        )
+
+    adapter = ReplayAdapter(fixture["recordings"])
+    bot = make_bot(
+        kind,
+        "http://127.0.0.1:1",
+        make_session(engine),
+        logger,
+        adapter,
+        os.path.join(directory, "exchange_info.json"),
+    )
+    probe = StepProbe(trace_memory)
+    probe.wrap(bot)
+    adapter.on_request = probe.on_request
+    event.listen(engine, "before_cursor_execute", probe.on_statement)
+
+    if trace_memory:
+        tracemalloc.start()
+    with probe.measure("step"):
+        bot.step()
+    if trace_memory:
+        tracemalloc.stop()
+
+    # "step" is the whole step, the phases are part of it
+    total = probe.stats["step"]
+    for phase in PHASES:
+        for key in ("api_calls", "sql_statements"):
+            total[key] += probe.stats[phase][key]
+    engine.dispose()
+    shutil.rmtree(workdir)
+    return probe.stats, adapter.misses
+
+
+def benchmark(kind: str, n: int, directory: str, repeat: int) -> dict:
+    runs = [replay(kind, directory, trace_memory=False) for _ in range(repeat)]
+    memory, _ = replay(kind, directory, trace_memory=True)
+    stats, misses = runs[0]
+    phases = {}
+    for phase in ("step", *PHASES):
+        seconds = [run[phase]["seconds"] for run, _ in runs]
+        phases[phase] = {
+            "seconds": statistics.median(seconds),
+            "seconds_min": min(seconds),
+            "api_calls": stats[phase]["api_calls"],
+            "sql_statements": stats[phase]["sql_statements"],
+            "peak_kib": memory[phase].get("peak_kib", 0),
+        }
+    return {"trades": n, "replay_misses": misses, "phases": phases}
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bot", choices=("futures", "spot"), default="futures")
+    parser.add_argument("--trades", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--fixtures", default="bench_fixtures")
+    parser.add_argument("--record", action="store_true", help="re-record fixtures")
+    parser.add_argument("--out", default="benchmark.json")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.trades:
+        directory = os.path.join(args.fixtures, f"{args.bot}-{n}")
+        if args.record or not os.path.exists(os.path.join(directory, "responses.json")):
+            print(f"Recording {directory}", flush=True)
+            record(args.bot, n, directory)
+        result = benchmark(args.bot, n, directory, args.repeat)
+        results.append(result)
+        step = result["phases"]["step"]
+        print(
+            f"{args.bot} {n} trades => {step['seconds']:.3f}s, "
+            f"{step['api_calls']} api calls, {step['sql_statements']} sql statements, "
+            f"peak {step['peak_kib']} KiB, {result['replay_misses']} replay misses",
+            flush=True,
+        )
+        for phase in PHASES:
+            stats = result["phases"][phase]
+            print(
+                f"  {phase:<20} {stats['seconds']:8.3f}s {stats['api_calls']:6} api "
+                f"{stats['sql_statements']:7} sql {stats['peak_kib']:8} KiB",
+                flush=True,
+            )
+
+    with open(args.out, "w") as f:
+        json.dump(
+            {
+                "bot": args.bot,
+                "revision": git_revision(),
+                "created_at": datetime.datetime.now().isoformat(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,45 @@
-from typing import List, Type
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, List, Type
 from binance.spot import Spot
 from binance.um_futures import UMFutures
-from models import Trade, OrderType
+from binance.error import ClientError
+from models import Trade, Order, Fill, OrderType, OPEN_ORDER_STATUSES
+from fills import fills_from_response, fill_from_update
 import datetime
+import json
+from sqlalchemy import func, inspect, literal_column
 from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger
+from exchange_cache import ExchangeInfoCache
+from prices import PriceBook, PriceFeed
+from order_events import OrderEventStream
+from reconcile import OrderReconciler
+from memory import MemoryStats
+from rate_limit import RateLimiter, Priority
+from utils import check_order_filters
+from triggers import TriggerIndex
+import time
+
+
+# The exchange's answer to looking up an order it never got
+ORDER_DOES_NOT_EXIST = -2013
+
+
+def client_order_id(trade: Trade) -> str:
+    """newClientOrderId of the trade's opening order, the same on every attempt"""
+    return f"trade-{trade.id}"
 
 
 class Bot:
+    # all-market price stream and the field holding the price in its events
+    price_stream: str | None = None
+    price_stream_key: str | None = None
+    # the duty pending_work pulls forward when a trigger of that kind fires
+    trigger_duties = {"entry": "intake"}
+    # key of this bot's templates in Trade.order_templates, see stage_trades
+    market: str = ""
+
     def __init__(
         self,
         ClientClass: Type[Spot] | Type[UMFutures],
@@ -16,37 +48,451 @@ class Bot:
         api_url: str,
         session: Session,
         logger: Logger,
+        exchange_info_path: str | None = None,
+        exchange_info_ttl: int = 60 * 60,
+        price_max_age: float = 30,
+        order_poll_interval: float = 5 * 60,
+        max_workers: int = 1,
     ):
         self.client = ClientClass(api_key, api_secret, base_url=api_url)
         self.session = session
         self.logger = logger
+        self.in_unit_of_work = False
 
-    def send_open_orders(self, trades):
-        return [
-            item
-            for item in [self.send_open_order(trade) for trade in trades]
-            if item is not None
+        self.exchange_info_cache = ExchangeInfoCache(
+            self.client.exchange_info, exchange_info_path, exchange_info_ttl, logger
+        )
+        self.exchange_info_cache.start()
+
+        self.rate_limiter = RateLimiter(logger)
+        self.rate_limiter.configure(self.exchange_info_cache.rate_limits)
+        self.client.session.hooks["response"].append(self.rate_limiter.on_response)
+
+        self.prices = PriceBook()
+        self.price_feed: PriceFeed | None = None
+        self.price_max_age = price_max_age
+        self.price_hits = 0
+        self.price_misses = 0
+        self.price_requests = 0
+
+        self.order_events: OrderEventStream | None = None
+        self.order_poll_interval = order_poll_interval
+        self.last_order_poll = 0.0
+        self.poll_orders = True
+        self.reconciler = OrderReconciler(self.fetch_open_orders, logger)
+
+        self.memory_stats: MemoryStats | None = None
+
+        self.account_balance: float | None = None
+        self.newest_trade_id: int | None = None
+        # Entry ranges (and SpotBot's stops) of the live trades, see move_triggers
+        self.triggers = TriggerIndex()
+
+        self.executor = (
+            ThreadPoolExecutor(max_workers, thread_name_prefix="exchange")
+            if max_workers > 1
+            else None
+        )
+
+    def begin_step(self):
+        self.rate_limiter.configure(self.exchange_info_cache.rate_limits)
+        self.snapshot_prices()
+        self.reconciler.reset()
+        self.apply_order_events()
+
+    def end_step(self):
+        self.log_price_stats()
+        self.reconciler.log_stats()
+        if self.memory_stats is not None:
+            self.memory_stats.maybe_log(self.session)
+        self.end_session_scope()
+
+    def end_session_scope(self):
+        """
+        Each step gets a fresh identity map, so a bot that runs for weeks holds
+        on to the trades of one step rather than every trade it ever loaded.
+        Closed trades are expunged first; they're never touched again.
+        """
+        closed = [
+            obj
+            for obj in self.session.identity_map.values()
+            # Only look at what's loaded, don't refresh expired trades for this
+            if isinstance(obj, Trade) and inspect(obj).dict.get("state") == "CLOSED"
         ]
+        for trade in closed:
+            self.session.expunge(trade)
+        self.session.close()
+
+    def track_memory(self, interval: float, top_n: int = 10):
+        self.memory_stats = MemoryStats(self.logger, interval, top_n)
+        self.memory_stats.start()
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Groups a phase's DB writes into a single transaction, committed when the
+        phase ends (or rolled back if it fails). See commit for what can't wait.
+        """
+        if self.in_unit_of_work:
+            yield
+            return
+        self.in_unit_of_work = True
+        try:
+            yield
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.in_unit_of_work = False
+
+    def commit(self, durable: bool = False):
+        """
+        Inside a unit of work, only `durable` commits happen right away. Those
+        record the results of an exchange side effect (orders placed, cancelled,
+        positions closed) once its fan-out returns, before anything else is sent.
+        A crash before that commit still loses what the fan-out did, which is why
+        opening orders carry a client order id committed ahead of sending them
+        (see send_open_orders).
+        """
+        if durable or not self.in_unit_of_work:
+            self.session.commit()
+
+    def defer(
+        self, priority: Priority, what: str, weight: int = 1, orders: int = 0
+    ) -> bool:
+        """True if `what` should wait for a later step to stay within rate limits"""
+        if self.rate_limiter.allow(priority, weight, orders):
+            return False
+        self.logger.info(
+            f"Deferring {what} => remaining weight {self.rate_limiter.remaining_weight()}"
+        )
+        return True
+
+    def get_symbol_info(self, symbol: str) -> dict:
+        return self.exchange_info_cache.get(symbol)
+
+    def start_price_feed(self, stream_url: str):
+        if self.price_stream is None or self.price_stream_key is None:
+            raise NotImplementedError
+        self.price_feed = PriceFeed(
+            stream_url,
+            self.price_stream,
+            self.price_stream_key,
+            self.prices,
+            self.logger,
+        )
+        self.price_feed.start()
+
+    def snapshot_prices(self):
+        """
+        One bulk request for every symbol's price, so get_price doesn't need
+        a round-trip per trade for the rest of the step
+        """
+        self.price_hits = 0
+        self.price_misses = 0
+        self.price_requests = 0
+        if self.price_feed is not None and self.price_feed.is_alive(self.price_max_age):
+            # The stream is keeping the book fresh for us
+            return
+        try:
+            self.price_requests += 1
+            self.prices.update_many(self.fetch_prices())
+        except Exception as e:
+            self.logger.error(f"Could not snapshot prices: {e}")
+
+    def log_price_stats(self):
+        self.logger.debug(
+            f"Price requests saved => "
+            f"{self.price_hits + self.price_misses - self.price_requests} "
+            f"(hits={self.price_hits}, misses={self.price_misses})"
+        )
+
+    def get_price(self, symbol: str) -> float:
+        price = self.prices.get(symbol, self.price_max_age)
+        if price is not None:
+            self.price_hits += 1
+            return price
+
+        self.price_misses += 1
+        self.price_requests += 1
+        price = self.fetch_price(symbol)
+        self.prices.update(symbol, price)
+        return price
+
+    def start_order_events(self, stream_url: str, record_path: str | None = None):
+        self.order_events = OrderEventStream(
+            self.client, stream_url, self.logger, record_path
+        )
+        self.order_events.start()
+
+    def apply_order_events(self):
+        """
+        Applies whatever the user data stream pushed since the last step, and
+        decides whether this step still has to poll every order (stream down,
+        or the slow reconciliation poll is due)
+        """
+        now = time.time()
+        if self.order_events is None or not self.order_events.alive:
+            self.poll_orders = True
+        else:
+            self.poll_orders = now - self.last_order_poll > self.order_poll_interval
+        if self.poll_orders:
+            self.last_order_poll = now
+
+        if self.order_events is None:
+            return
+        updates = self.order_events.drain()
+        if not updates:
+            return
+
+        orders = {}
+        for trade in (
+            self.get_trades_with_pending_opening_order()
+            + self.get_trades_with_pending_take_profit_order()
+        ):
+            for order_type in ("open_order", "take_profit_order", "stop_loss_order"):
+                order = getattr(trade, order_type)
+                if order is not None:
+                    orders[(trade.symbol, order["orderId"])] = (trade, order_type)
+
+        for update in updates:
+            match = orders.get((update["symbol"], update["orderId"]))
+            if match is None:
+                self.logger.debug(f"Order update for an untracked order => {update}")
+                continue
+            trade, order_type = match
+            setattr(trade, order_type, dict(getattr(trade, order_type), **update))
+            fill = fill_from_update(update)
+            if fill is not None:
+                self.record_fills(trade, order_type, update["orderId"], [fill])
+            self.session.add(trade)
+            self.logger.info(f"updated status {order_type} => {trade.id} : {update}")
+        self.commit()
+
+    def fan_out(self, fn: Callable[[Any], Any], items: Iterable) -> list:
+        """
+        Runs fn over items on the worker pool and returns the results in order,
+        so a phase takes as long as its slowest call rather than the sum of them.
+        fn must only do exchange I/O; DB writes stay on the calling thread.
+        """
+        items = list(items)
+        for item in items:
+            # Workers must never lazy-load through the (single-threaded) session
+            for obj in item if isinstance(item, tuple) else (item,):
+                if isinstance(obj, Trade) and inspect(obj).expired_attributes:
+                    self.session.refresh(obj)
+
+        if self.executor is None or len(items) <= 1:
+            return [fn(item) for item in items]
+        return list(self.executor.map(fn, items))
+
+    def entry_range(self, trade: Trade) -> tuple[float, float]:
+        if trade.side == "BUY":
+            return trade.stop_loss, trade.targets[0]
+        return trade.targets[0], trade.stop_loss
+
+    def watch_entries(self, trades: list[Trade]):
+        """Remembers the entry ranges of the calls we're waiting on, see pending_work"""
+        self.triggers.watch_zones(
+            "entry",
+            {trade.id: (trade.symbol, *self.entry_range(trade)) for trade in trades},
+        )
+        self.move_triggers()
+
+    def move_triggers(self) -> dict[str, set[int]]:
+        """
+        Moves the trigger index to the price book, one symbol at a time, and
+        returns the trades whose levels were crossed since, by kind
+        """
+        triggered: dict[str, set[int]] = {}
+        for symbol in self.triggers.symbols():
+            moved = self.triggers.move(
+                symbol, self.prices.get(symbol, self.price_max_age)
+            )
+            for kind, trade_ids in moved.items():
+                triggered.setdefault(kind, set()).update(trade_ids)
+        return triggered
+
+    def pending_work(self) -> set[str]:
+        """
+        Duties that should run now rather than wait for their cadence: a new call
+        landed in the DB, the user data stream pushed order updates, or a price
+        moved into a call's entry range (see trigger_duties). Only local checks,
+        no exchange calls.
+        """
+        work = set()
+        newest_trade_id = self.session.query(func.max(Trade.id)).scalar()
+        if newest_trade_id != self.newest_trade_id:
+            self.newest_trade_id = newest_trade_id
+            work.add("intake")
+
+        if self.order_events is not None and not self.order_events.events.empty():
+            work.add("fills")
+
+        for kind, trade_ids in self.move_triggers().items():
+            if trade_ids:
+                work.add(self.trigger_duties[kind])
+        return work
+
+    def record_fills(
+        self, trade: Trade, order_type: OrderType, order_id: int, fills: list[dict]
+    ):
+        """Adds the fills (see fills.py) the ledger doesn't have yet"""
+        seen = {(fill.order_id, fill.exchange_trade_id) for fill in trade.fills}
+        for fill in fills:
+            if (order_id, fill["tradeId"]) in seen:
+                continue
+            seen.add((order_id, fill["tradeId"]))
+            trade.fills.append(
+                Fill(
+                    order_type=order_type,
+                    symbol=trade.symbol,
+                    order_id=order_id,
+                    exchange_trade_id=fill["tradeId"],
+                    price=float(fill["price"]),
+                    quantity=float(fill["qty"]),
+                    commission=float(fill["commission"] or 0),
+                    commission_asset=fill["commissionAsset"],
+                )
+            )
+
+    def send_open_orders(self, trades):
+        """
+        Sends the opening orders under a client order id derived from the trade,
+        committed before anything goes out. A trade that already has one may
+        have been sent before without us hearing back (crash, lost response),
+        so its order is looked up by that id first rather than sent twice.
+        """
+        trades = list(trades)
+        retried = {trade.id for trade in trades if trade.open_client_order_id}
+        for trade in trades:
+            trade.open_client_order_id = client_order_id(trade)
+        if trades:
+            self.commit(durable=True)
+        orders = self.fan_out(
+            lambda trade: self.find_or_place_open_order(trade, trade.id in retried),
+            trades,
+        )
+        sent = []
+        for trade, order in zip(trades, orders):
+            if order is None:
+                continue
+            trade.open_order = order
+            self.record_fills(
+                trade, "open_order", order["orderId"], fills_from_response(order)
+            )
+            self.session.add(trade)
+            self.logger.info(f"New opening order => {trade.id} : {trade.open_order}")
+            sent.append(trade)
+        if sent:
+            self.commit(durable=True)
+        return sent
+
+    def send_open_order(self, trade: Trade):
+        return next(iter(self.send_open_orders([trade])), None)
+
+    def find_or_place_open_order(self, trade: Trade, retried: bool) -> dict | None:
+        if retried:
+            try:
+                order = self.get_order_by_client_id(
+                    trade.symbol, trade.open_client_order_id
+                )
+                self.logger.info(
+                    f"Found opening order sent before => {trade.id}/{trade.symbol}"
+                )
+                return order
+            except Exception as e:
+                if not (
+                    isinstance(e, ClientError) and e.error_code == ORDER_DOES_NOT_EXIST
+                ):
+                    self.logger.error(
+                        f"Could not look up opening order => {trade.id}/{trade.symbol} : {e}"
+                    )
+                    return None
+        return self.place_open_order(trade)
+
+    def stage_trades(self):
+        """
+        Builds the ready-to-send order params of the calls that just came in, so
+        entering a trade later is a single request. The spot and futures bots
+        share the trades, so each keeps its templates under its own market key.
+        Calls this market can't trade (unknown or delisted symbol, params the
+        filters would reject) are marked rejected for it once instead of failing
+        every step, the other market may still take them.
+        """
+        path = f"$.{self.market}"
+        trades = (
+            self.session.query(Trade)
+            .filter(Trade.state == "NEW")
+            .filter(Trade.bragged == 0)
+            .filter(func.json_type(Trade.order_templates, path).is_(None))
+            .all()
+        )
+        for trade in trades:
+            try:
+                info = self.get_symbol_info(trade.symbol)
+            except KeyError:
+                info = None
+            except Exception as e:
+                self.logger.error(f"Could not get info for {trade.symbol}: {str(e)}")
+                continue
+            try:
+                if info is None or info.get("status", "TRADING") != "TRADING":
+                    raise ValueError("unknown or delisted symbol")
+                self.check_call(trade)
+                templates = self.build_order_templates(trade, info)
+                for params in [
+                    templates["open_order"],
+                    templates["stop_loss_order"],
+                    *templates["targets"],
+                ]:
+                    check_order_filters(params, info)
+            except ValueError as e:
+                templates = {"rejected": str(e)}
+                self.logger.info(f"Rejected call => {trade.id}/{trade.symbol} : {e}")
+            # Set in place, so the other bot staging the same call isn't overwritten
+            self.session.query(Trade).filter(Trade.id == trade.id).update(
+                {
+                    Trade.order_templates: func.json_set(
+                        func.coalesce(Trade.order_templates, literal_column("'{}'")),
+                        path,
+                        func.json(json.dumps(templates)),
+                    )
+                },
+                synchronize_session=False,
+            )
+            self.session.expire(trade, ["order_templates"])
+        if trades:
+            self.commit()
+
+    def staged_templates(self, trade: Trade) -> dict | None:
+        """This market's templates for the trade, None if not staged or rejected"""
+        templates = (trade.order_templates or {}).get(self.market)
+        if templates is None or "rejected" in templates:
+            return None
+        return templates
+
+    def get_order_templates(self, trade: Trade) -> dict:
+        templates = self.staged_templates(trade)
+        if templates is not None:
+            return templates
+        # Opened before calls were staged
+        return self.build_order_templates(trade, self.get_symbol_info(trade.symbol))
 
     def filter_viable_trades(self, trades: List[Trade]):
+        """The trades (given to watch_entries first) whose entry range the price is in"""
         for trade in trades:
             # # ONLY FOR TEST NET. It has a limited asset list ###
             # if trade.symbol != "LTCUSDT":
             #     continue
-            if trade.side == "BUY":
-                max_price = trade.targets[0]
-                min_price = trade.stop_loss
-            elif trade.side == "SELL":
-                min_price = trade.targets[0]
-                max_price = trade.stop_loss
-
             try:
-                current_price = self.get_price(trade.symbol)
+                self.triggers.move(trade.symbol, self.get_price(trade.symbol))
             except:
                 self.logger.error(f"Could not get price => {trade.id}/{trade.symbol}")
                 continue
 
-            if current_price < min_price or current_price > max_price:
+            if not self.triggers.is_triggered("entry", trade.id):
                 self.logger.debug(
                     f"Skipping because price not in range => {trade.id}/{trade.symbol}"
                 )
@@ -65,63 +511,93 @@ class Bot:
             if getattr(trade, order_type).get("status", None) == "FILLED"
         ]
 
-    def filter_trades_with_orders_taking_too_long_to_fill(
-        self, trades: list[Trade], order_type, max_expiry_hours: int
-    ):
-        return [
-            trade
-            for trade in trades
-            if getattr(trade, order_type).get("status", None)
-            == "NEW"  # TODO: What about partially filled ones?
-            and (
-                datetime.datetime.now()
-                - datetime.datetime.fromtimestamp(
-                    (
-                        getattr(trade, order_type).get("time", None)
-                        or getattr(trade, order_type).get("transactTime", None)
-                    )
-                    // 1000
-                )
-            )
-            > datetime.timedelta(hours=max_expiry_hours)
-        ]
-
     def update_order_status(
         self,
         trade: Trade,
         order_type: OrderType,
+        order: dict | None = None,
     ):
-        order = self.get_order(trade.symbol, getattr(trade, order_type)["orderId"])
+        if order is None:
+            order = self.get_order(trade.symbol, getattr(trade, order_type)["orderId"])
         if order["status"] != getattr(trade, order_type).get("status", None):
             setattr(trade, order_type, order)
             self.session.add(trade)
-            self.session.commit()
+            self.commit()
             self.logger.info(f"updated status {order_type} => {trade.id} : {order}")
         return trade
 
     def update_order_statuses(self, trades: list[Trade], order_type: OrderType):
-        return [self.update_order_status(trade, order_type) for trade in trades]
+        if not self.poll_orders:
+            # The user data stream is keeping these up to date
+            return trades
+        if self.defer("status", f"{order_type} status refresh", weight=len(trades)):
+            return trades
+
+        changed, gone = self.reconciler.reconcile(trades, order_type)
+        for trade, order in changed:
+            setattr(trade, order_type, dict(getattr(trade, order_type), **order))
+            self.session.add(trade)
+            self.logger.info(f"updated status {order_type} => {trade.id} : {order}")
+        if changed:
+            self.commit()
+
+        orders = self.fan_out(
+            lambda trade: self.get_order(
+                trade.symbol, getattr(trade, order_type)["orderId"]
+            ),
+            gone,
+        )
+        for trade, order in zip(gone, orders):
+            self.update_order_status(trade, order_type, order)
+        return trades
+
+    def close_finished_trades(self, trades: list[Trade]):
+        """Closes the trades whose take profit or stop loss has filled"""
+        finished = [
+            trade
+            for trade in trades
+            if any(
+                (getattr(trade, order_type) or {}).get("status") == "FILLED"
+                for order_type in ("take_profit_order", "stop_loss_order")
+            )
+        ]
+        for trade in finished:
+            trade.closed = 1
+            self.logger.info(f"Trade finished => {trade.id}/{trade.symbol}")
+        if finished:
+            self.commit()
+
+    def cancel_open_order(self, trade: Trade) -> dict | None:
+        try:
+            return self.client.cancel_order(
+                trade.symbol, orderId=trade.open_order["orderId"]
+            )
+        except:
+            self.logger.info(
+                f"Could not cancel open order => {trade.id}/{trade.symbol}"
+            )
+            return None
 
     def cancel_open_orders(self, trades: list[Trade]):
-        for trade in trades:
-            try:
-                trade.open_order = self.client.cancel_order(
-                    trade.symbol, orderId=trade.open_order["orderId"]
-                )
-                trade.closed = 1
-                self.session.commit()
-                self.logger.info(f"Cancelled open order => {trade.id}/{trade.symbol}")
-            except:
-                self.logger.info(
-                    f"Could not cancel open order => {trade.id}/{trade.symbol}"
-                )
+        for trade, order in zip(trades, self.fan_out(self.cancel_open_order, trades)):
+            if order is None:
+                continue
+            trade.open_order = order
+            trade.closed = 1
+            self.logger.info(f"Cancelled open order => {trade.id}/{trade.symbol}")
+        self.commit(durable=True)
 
     def get_unexecuted_trades(
         self, latest_first: bool = True, limit=10, lookback_hours=12
     ):
         return (
             self.session.query(Trade)
-            .filter(Trade.open_order.is_(None))
+            .filter(Trade.state == "NEW")
+            .filter(
+                func.json_type(
+                    Trade.order_templates, f"$.{self.market}.open_order"
+                ).is_not(None)
+            )
             .filter(
                 Trade.timestamp
                 >= datetime.datetime.now() - datetime.timedelta(hours=lookback_hours)
@@ -133,27 +609,58 @@ class Bot:
         )
 
     def get_trades_with_pending_opening_order(self):
-        return (
-            self.session.query(Trade)
-            .filter(Trade.open_order.is_not(None))
-            .filter(Trade.take_profit_order.is_(None))
-            .filter(Trade.closed == 0)
-            .all()
-        )
+        return self.session.query(Trade).filter(Trade.state == "OPEN_PENDING").all()
 
     def get_trades_with_pending_take_profit_order(self):
+        return self.session.query(Trade).filter(Trade.state == "PROTECTED").all()
+
+    def get_trades_with_expired_order(
+        self, order_type: OrderType, max_expiry_hours: int
+    ) -> list[Trade]:
+        """
+        Trades whose `order_type` order is still unfilled after `max_expiry_hours`,
+        straight off the ix_orders_open index
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(hours=max_expiry_hours)
+        state = "OPEN_PENDING" if order_type == "open_order" else "PROTECTED"
         return (
             self.session.query(Trade)
-            .filter(Trade.take_profit_order.is_not(None))
-            .filter(Trade.closed == 0)
+            .join(Order, Order.trade_id == Trade.id)
+            # Repeats the index's WHERE so SQLite will use it
+            .filter(Order.status.in_(OPEN_ORDER_STATUSES))
+            .filter(Order.status == "NEW")  # TODO: What about partially filled ones?
+            .filter(Order.created_time < cutoff)
+            .filter(Order.order_type == order_type)
+            .filter(Trade.state == state)
             .all()
         )
 
-    def send_open_order(self, trade):
+    def check_call(self, trade: Trade):
+        """ValueError if this market can't trade the call, checked when staging"""
+
+    def build_order_templates(self, trade: Trade, info: dict) -> dict:
+        """
+        {"open_order": params, "stop_loss_order": params, "targets": [params, ...]}
+        for the trade, or ValueError if it can't be traded. The exit quantities
+        depend on the fill, they're added when sent.
+        """
         raise NotImplementedError
 
-    def get_price(self, symbol):
+    def place_open_order(self, trade: Trade) -> dict | None:
+        """Sends the opening order and returns it (exchange I/O only)"""
+        raise NotImplementedError
+
+    def get_order_by_client_id(self, symbol: str, client_order_id: str) -> dict:
+        raise NotImplementedError
+
+    def fetch_price(self, symbol: str) -> float:
+        raise NotImplementedError
+
+    def fetch_prices(self) -> dict[str, float]:
         raise NotImplementedError
 
     def get_order(self, symbol, orderId):
         raise NotImplementedError
+
+    def fetch_open_orders(self) -> list[dict]:
+        raise NotImplementedError
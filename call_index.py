@@ -0,0 +1,101 @@
+import collections
+import datetime
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from models import Trade
+
+
+class CallIndex:
+    """
+    What telegram_bot needs to know about recent calls, without asking the DB:
+    the texthashes seen within the debounce window (for duplicates) and the ids
+    of the last `capacity` calls used (for replies and calls seen before).
+
+    Both are complete above a floor, every call newer than it is in there.
+    Below the floor the index doesn't know, and the caller asks the DB.
+    Timestamps are naive UTC, like in the trades table.
+    """
+
+    def __init__(self, window: datetime.timedelta, capacity: int = 10_000):
+        self.window = window
+        self.capacity = capacity
+        # texthash -> timestamps, and the same in the order they came in
+        self.hashes: dict[str, list[datetime.datetime]] = {}
+        self.hash_order: collections.deque[
+            tuple[datetime.datetime, str]
+        ] = collections.deque()
+        self.hashes_since = datetime.datetime.min
+        # call id -> bragged, least recently used first
+        self.calls: collections.OrderedDict[int, bool] = collections.OrderedDict()
+        self.calls_floor = 0
+
+    def warm(self, session: Session):
+        newest = session.query(func.max(Trade.timestamp)).scalar()
+        if newest is not None:
+            since = newest - self.window
+            for texthash, timestamp in (
+                session.query(Trade.texthash, Trade.timestamp)
+                .filter(Trade.timestamp > since)
+                .order_by(Trade.timestamp)
+            ):
+                self.add_hash(texthash, timestamp)
+            self.hashes_since = since
+
+        rows = (
+            session.query(Trade.id, Trade.bragged)
+            .order_by(Trade.id.desc())
+            .limit(self.capacity)
+            .all()
+        )
+        for trade_id, bragged in reversed(rows):
+            self.calls[trade_id] = bool(bragged)
+        if len(rows) == self.capacity:
+            self.calls_floor = rows[-1][0]
+
+    def add_hash(self, texthash: str, timestamp: datetime.datetime):
+        self.hashes.setdefault(texthash, []).append(timestamp)
+        self.hash_order.append((timestamp, texthash))
+        # Nothing older than the window is needed for a call at this time or later
+        cutoff = timestamp - self.window
+        while self.hash_order and self.hash_order[0][0] <= cutoff:
+            old, old_hash = self.hash_order.popleft()
+            timestamps = self.hashes[old_hash]
+            timestamps.remove(old)
+            if not timestamps:
+                del self.hashes[old_hash]
+        self.hashes_since = max(self.hashes_since, cutoff)
+
+    def covers_time(self, timestamp: datetime.datetime) -> bool:
+        """Whether is_duplicate can answer for a call at `timestamp`"""
+        return timestamp - self.window >= self.hashes_since
+
+    def is_duplicate(self, texthash: str, timestamp: datetime.datetime) -> bool:
+        return any(
+            seen > timestamp - self.window for seen in self.hashes.get(texthash, ())
+        )
+
+    def add_call(self, call_id: int, texthash: str, timestamp: datetime.datetime):
+        self.add_hash(texthash, timestamp)
+        self.calls[call_id] = False
+        self.calls.move_to_end(call_id)
+        while len(self.calls) > self.capacity:
+            evicted, _ = self.calls.popitem(last=False)
+            # Calls at or below it might not be in here anymore
+            self.calls_floor = max(self.calls_floor, evicted)
+
+    def is_call(self, call_id: int) -> bool | None:
+        """None if it's below the floor and the DB has to be asked"""
+        if call_id in self.calls:
+            self.calls.move_to_end(call_id)
+            return True
+        if call_id > self.calls_floor:
+            return False
+        return None
+
+    def is_bragged(self, call_id: int) -> bool:
+        """For a call is_call knows about"""
+        return self.calls[call_id]
+
+    def mark_bragged(self, call_id: int):
+        self.calls[call_id] = True
+        self.calls.move_to_end(call_id)
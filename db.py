@@ -0,0 +1,31 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+DATABASE_URL = "sqlite:///tradingbot.db"
+# The ingester and both bots write to the same file, wait for each other
+# rather than failing with "database is locked"
+BUSY_TIMEOUT_MS = 30 * 1000
+
+
+def make_engine(url: str = DATABASE_URL) -> Engine:
+    """
+    The engine every process should use. WAL lets readers carry on while
+    another process writes, and with it synchronous=NORMAL is still safe
+    against the process crashing (only a power loss can lose the last commits).
+    """
+    engine = create_engine(url)
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+    return engine
+
+
+def make_session(engine: Engine) -> Session:
+    return sessionmaker(bind=engine)()
@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+import time
+from logging import Logger
+from typing import Callable
+from utils import step_size_to_precision
+
+
+def index_exchange_info(exchange_info: dict) -> dict[str, dict]:
+    """
+    Turns the raw exchange_info payload into {symbol: info}, with the filters
+    keyed by filterType and the tick/step precisions computed once up front.
+    """
+    index = {}
+    for info in exchange_info["symbols"]:
+        filters = {f["filterType"]: f for f in info.get("filters", [])}
+        info = dict(info, filterIndex=filters)
+        if "PRICE_FILTER" in filters:
+            info["tickPrecision"] = step_size_to_precision(
+                filters["PRICE_FILTER"]["tickSize"]
+            )
+        if "LOT_SIZE" in filters:
+            info["stepPrecision"] = step_size_to_precision(
+                filters["LOT_SIZE"]["stepSize"]
+            )
+        index[info["symbol"]] = info
+    return index
+
+
+class ExchangeInfoCache:
+    """
+    Symbol-keyed exchange_info, refreshed in the background every `ttl` seconds
+    and persisted to `path` so restarts don't have to download it again.
+    """
+
+    # Don't hammer exchange_info when asked for a symbol that doesn't exist
+    MISS_REFRESH_SECONDS = 60
+
+    def __init__(
+        self,
+        fetch: Callable[[], dict],
+        path: str | None,
+        ttl: int,
+        logger: Logger,
+    ):
+        self.fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        self.logger = logger
+        self.symbols: dict[str, dict] = {}
+        self.rate_limits: list[dict] = []
+        self.updated_at = 0.0
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self.load()
+
+    def is_stale(self) -> bool:
+        return time.time() - self.updated_at > self.ttl
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            self.symbols = cached["symbols"]
+            self.rate_limits = cached.get("rate_limits", [])
+            self.updated_at = cached["updated_at"]
+            self.logger.info(
+                f"Loaded exchange info for {len(self.symbols)} symbols from {self.path}"
+            )
+        except Exception as e:
+            self.logger.error(f"Could not load exchange info from {self.path}: {e}")
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "updated_at": self.updated_at,
+                    "symbols": self.symbols,
+                    "rate_limits": self.rate_limits,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
+
+    def refresh(self):
+        with self._lock:
+            exchange_info = self.fetch()
+            symbols = index_exchange_info(exchange_info)
+            self.symbols = symbols
+            self.rate_limits = exchange_info.get("rateLimits", [])
+            self.updated_at = time.time()
+            try:
+                self.save()
+            except Exception as e:
+                self.logger.error(f"Could not save exchange info to {self.path}: {e}")
+        self.logger.debug(f"Refreshed exchange info => {len(symbols)} symbols")
+
+    def get(self, symbol: str) -> dict:
+        info = self.symbols.get(symbol)
+        if info is None and (
+            not self.symbols
+            or time.time() - self.updated_at > self.MISS_REFRESH_SECONDS
+        ):
+            # Possibly a new listing, or we never managed to load anything
+            self.refresh()
+            info = self.symbols.get(symbol)
+        if info is None:
+            raise KeyError(f"Unknown symbol => {symbol}")
+        return info
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._refresh_forever, name="exchange-info", daemon=True
+        )
+        self._thread.start()
+
+    def _refresh_forever(self):
+        while True:
+            if self.is_stale():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    self.logger.error(f"Could not refresh exchange info: {e}")
+                    time.sleep(self.MISS_REFRESH_SECONDS)
+                    continue
+            time.sleep(max(self.updated_at + self.ttl - time.time(), 1))
@@ -0,0 +1,41 @@
+"""
+Turns the different places the exchange reports executions in into the same
+{tradeId, price, qty, commission, commissionAsset} shape, see Bot.record_fills
+"""
+
+
+def fills_from_response(order: dict) -> list[dict]:
+    """The fills of a FULL new_order response (spot, futures responses have none)"""
+    return [
+        {
+            "tradeId": fill["tradeId"],
+            "price": fill["price"],
+            "qty": fill["qty"],
+            "commission": fill["commission"],
+            "commissionAsset": fill["commissionAsset"],
+        }
+        for fill in order.get("fills", [])
+    ]
+
+
+def fill_from_update(update: dict) -> dict | None:
+    """From a normalized order event, None unless it's an execution"""
+    if update.get("executionType") != "TRADE":
+        return None
+    return {
+        "tradeId": update["tradeId"],
+        "price": update["lastFilledPrice"],
+        "qty": update["lastFilledQty"],
+        "commission": update["commission"],
+        "commissionAsset": update["commissionAsset"],
+    }
+
+
+def fill_from_my_trade(my_trade: dict) -> dict:
+    return {
+        "tradeId": my_trade["id"],
+        "price": my_trade["price"],
+        "qty": my_trade["qty"],
+        "commission": my_trade["commission"],
+        "commissionAsset": my_trade["commissionAsset"],
+    }
@@ -1,15 +1,21 @@
 from binance.um_futures import UMFutures
 import os
-import time
 from typing import List
 from dotenv import load_dotenv
-from models import Trade
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import traceback
-from utils import format_quantity, format_price, setup_logger
+from models import Trade, OrderType
+from db import make_engine, make_session
+from utils import (
+    format_quantity,
+    format_price,
+    decimal_string,
+    setup_logger,
+)
 import itertools
+import json
 from bot import Bot
+from migrate import migrate
+from scheduler import StepScheduler
+from notify import CALL_SOCKETS, CallListener
 
 # SETUP ENV
 dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
@@ -17,177 +23,332 @@ load_dotenv(dotenv_path)
 BINANCE_API_KEY = os.getenv("FUTURES_API_KEY")
 BINANCE_API_SECRET = os.getenv("FUTURES_API_SECRET")
 BINANCE_API_URL = os.getenv("FUTURES_API_URL")
+BINANCE_STREAM_URL = os.getenv("FUTURES_STREAM_URL")
+BINANCE_USER_STREAM_URL = os.getenv("FUTURES_USER_STREAM_URL")
+# Seconds between memory reports, unset to turn tracemalloc off
+MEMORY_LOG_INTERVAL = os.getenv("MEMORY_LOG_INTERVAL")
 
 # SETUP DB
-engine = create_engine("sqlite:///tradingbot.db")
-SESSION = sessionmaker(bind=engine)()
+engine = make_engine()
+SESSION = make_session(engine)
 
 # CONSTANTS
 ORDER_SIZE = 100  # USD per trade
 ORDER_EXPIRY_TIME_HOURS = 14 * 24  # 14 days
 DELAY_BETWEEN_STEPS = 10  # seconds
+EXPIRY_CHECK_INTERVAL = 5 * 60  # seconds
+BALANCE_REFRESH_INTERVAL = 60  # seconds
 TARGET_NUM = 3
 LEVERAGE = 2
+BATCH_ORDERS_MAX = 5  # batchOrders limit
+MAX_WORKERS = 8  # concurrent exchange requests within a step
+EXCHANGE_INFO_PATH = "futures_exchange_info.json"
+EXCHANGE_INFO_TTL = 60 * 60  # seconds
 
 LOGGER = setup_logger("futoor")
 
 
 class FuturesBot(Bot):
     client: UMFutures
+    price_stream = "!markPrice@arr@1s"
+    price_stream_key = "p"
+    market = "futures"
 
     def __init__(self, api_key, api_secret, api_url, session, logger):
-        super().__init__(UMFutures, api_key, api_secret, api_url, session, logger)
+        super().__init__(
+            UMFutures,
+            api_key,
+            api_secret,
+            api_url,
+            session,
+            logger,
+            exchange_info_path=EXCHANGE_INFO_PATH,
+            exchange_info_ttl=EXCHANGE_INFO_TTL,
+            max_workers=MAX_WORKERS,
+        )
 
         if self.client.get_position_mode()["dualSidePosition"] is True:
             self.client.change_position_mode(dualSidePosition="false")
         if self.client.get_multi_asset_mode()["multiAssetsMargin"] is True:
             self.client.change_multi_asset_mode(multiAssetsMargin="false")
 
-    def get_price(self, symbol: str):
+        # symbol -> (margin type, leverage), so opening orders don't have to ask
+        self.symbol_config: dict[str, tuple[str, int]] = {}
+        self.load_symbol_config()
+
+    def fetch_price(self, symbol: str):
         return float(self.client.mark_price(symbol)["markPrice"])
 
+    def fetch_prices(self):
+        return {p["symbol"]: float(p["markPrice"]) for p in self.client.mark_price()}
+
     def get_order(self, symbol: str, order_id: int):
         return self.client.query_order(symbol=symbol, orderId=order_id)
 
-    def send_open_order(self, trade: Trade):
+    def get_order_by_client_id(self, symbol: str, client_order_id: str):
+        return self.client.query_order(symbol=symbol, origClientOrderId=client_order_id)
+
+    def fetch_open_orders(self):
+        return self.client.get_orders()
+
+    def load_symbol_config(self, symbol: str | None = None):
+        """One position risk call covers every symbol when `symbol` is None"""
+        for position in self.client.get_position_risk(symbol=symbol):
+            self.symbol_config[position["symbol"]] = (
+                position["marginType"].lower(),
+                int(position["leverage"]),  # comes back as a string
+            )
+
+    def configure_symbol(self, symbol: str):
+        """Makes sure the symbol is isolated at LEVERAGE, only calling out on a change"""
+        if symbol not in self.symbol_config:
+            self.load_symbol_config(symbol)
+        margin_type, leverage = self.symbol_config[symbol]
+
+        if margin_type != "isolated":
+            self.client.change_margin_type(symbol, "ISOLATED")
+            margin_type = "isolated"
+            self.symbol_config[symbol] = (margin_type, leverage)
+        if leverage != LEVERAGE:
+            response = self.client.change_leverage(symbol, LEVERAGE)
+            self.symbol_config[symbol] = (margin_type, int(response["leverage"]))
+
+    def check_call(self, trade: Trade):
+        if len(trade.targets) <= TARGET_NUM:
+            raise ValueError(f"no target {TARGET_NUM + 1} to take profit at")
+
+    def configure_symbols(self, symbols: set[str]) -> set[str]:
         """
-        Have to long/short + TP + SL separately because atomic endpoint is private
-        See: https://dev.binance.vision/t/how-to-implement-otoco-tp-sl-orders-using-api/1622/18
+        Configures each symbol once, concurrently across symbols but never twice
+        at the same time for one. Returns the ones ready to trade.
         """
-        if trade.open_order is not None:
-            return trade
 
-        try:
-            position_risk = self.client.get_position_risk(symbol=trade.symbol)[0]
+        def configure(symbol: str) -> bool:
+            try:
+                self.configure_symbol(symbol)
+                return True
+            except Exception as e:
+                # Whatever we had for it is suspect now, ask again next time
+                self.symbol_config.pop(symbol, None)
+                self.logger.error(
+                    f"Could not change margin type/leverage => {symbol} : {e}"
+                )
+                return False
+
+        symbols = sorted(symbols)
+        return {
+            symbol
+            for symbol, ok in zip(symbols, self.fan_out(configure, symbols))
+            if ok
+        }
+
+    def send_open_orders(self, trades):
+        trades = list(trades)
+        # Before the fan-out, two trades on one symbol would race to configure it
+        configured = self.configure_symbols({trade.symbol for trade in trades})
+        return super().send_open_orders(
+            [trade for trade in trades if trade.symbol in configured]
+        )
 
-            if position_risk["marginType"].lower() != "isolated":
-                self.client.change_margin_type(str(trade.symbol), "ISOLATED")
-            if position_risk["leverage"] != LEVERAGE:
-                self.client.change_leverage(str(trade.symbol), LEVERAGE)
-        except Exception as e:
-            self.logger.error(
-                f"Could not change margin type/leverage => {trade.id}/{trade.symbol} : {e}"
+    def build_order_templates(self, trade: Trade, info) -> dict:
+        price = max(trade.entry) if trade.side == "BUY" else min(trade.entry)
+        open_order = {
+            "symbol": trade.symbol,
+            "side": trade.side,
+            "type": "LIMIT",
+            "quantity": decimal_string(
+                format_quantity(ORDER_SIZE * LEVERAGE / price, info)
+            ),
+            "reduceOnly": "false",
+            "price": decimal_string(format_price(price, info)),
+            "newOrderRespType": "FULL",
+            "timeInForce": "GTC",
+        }
+        protective = {
+            "symbol": trade.symbol,
+            "side": "SELL" if trade.side == "BUY" else "BUY",
+            "reduceOnly": "true",
+            "newOrderRespType": "RESULT",
+            "timeInForce": "GTE_GTC",
+            "workingType": "MARK_PRICE",
+        }
+        stop_loss_order = dict(
+            protective,
+            type="STOP_MARKET",
+            stopPrice=decimal_string(format_price(trade.stop_loss, info)),
+        )
+        targets = [
+            dict(
+                protective,
+                type="TAKE_PROFIT_MARKET",
+                stopPrice=decimal_string(format_price(target, info)),
             )
-            return
+            for target in trade.targets
+        ]
+        return {
+            "open_order": open_order,
+            "stop_loss_order": stop_loss_order,
+            "targets": targets,
+        }
 
-        info = [
-            x
-            for x in self.client.exchange_info()["symbols"]
-            if x.get("symbol") == trade.symbol
-        ][0]
-        # TODO sanity check on the asset pair
-        price = (
-            max(iter(trade.entry)) if trade.side == "BUY" else min(iter(trade.entry))
-        )
-        quantity = format_quantity(ORDER_SIZE * LEVERAGE / price, info)
+    def place_open_order(self, trade: Trade):
+        """
+        Have to long/short + TP + SL separately because atomic endpoint is private
+        See: https://dev.binance.vision/t/how-to-implement-otoco-tp-sl-orders-using-api/1622/18
+        """
+        if trade.open_order is not None:
+            return
 
         # open the long/short position
         try:
-            params = {
-                "symbol": trade.symbol,
-                "side": trade.side,
-                "type": "LIMIT",
-                "quantity": quantity,
-                "reduceOnly": "false",
-                "price": format_price(price, info),
-                "newOrderRespType": "FULL",
-                "timeInForce": "GTC",
-            }
-
-            response = self.client.new_order(**params)
-            confirmed_order = self.get_order(str(trade.symbol), response["orderId"])
-            trade.open_order = confirmed_order
-
-            self.session.add(trade)
-            self.session.commit()
-            self.logger.info(f"New opening order => {trade.id} : {trade.open_order}")
+            response = self.client.new_order(
+                **self.get_order_templates(trade)["open_order"],
+                newClientOrderId=trade.open_client_order_id,
+            )
+            # The response is the full order already, see submit_tpsl_batch for time
+            response.setdefault("time", response.get("updateTime"))
+            return response
         except Exception as e:
             self.logger.error(
                 f"Could not create new opening order => {trade.id}/{trade.symbol} : {e}"
             )
             return
 
-        return trade
+    def tpsl_order_params(self, trade: Trade) -> list[tuple[OrderType, dict]]:
+        """The protective legs this trade is still missing"""
+        templates = self.get_order_templates(trade)
+        quantity = trade.open_order["executedQty"]
+        legs: list[tuple[OrderType, dict]] = []
+        if trade.stop_loss_order is None:
+            legs.append(
+                (
+                    "stop_loss_order",
+                    dict(templates["stop_loss_order"], quantity=quantity),
+                )
+            )
+        if trade.take_profit_order is None:
+            if len(templates["targets"]) <= TARGET_NUM:
+                # Opened before such calls were rejected, the stop loss still goes out
+                self.logger.error(
+                    f"No target {TARGET_NUM + 1} to take profit at => {trade.id}/{trade.symbol}"
+                )
+                return legs
+            legs.append(
+                (
+                    "take_profit_order",
+                    dict(templates["targets"][TARGET_NUM], quantity=quantity),
+                )
+            )
+        return legs
 
     def send_tpsl_orders(self, trades: List[Trade]):
+        """
+        Sends the TP and SL of each trade together through batchOrders, packing
+        the legs of several trades into one request (never splitting a trade's
+        legs across requests). The responses are used as is, no re-querying.
+        """
+        batches: list[list[tuple[Trade, OrderType, dict]]] = [[]]
+        for trade in trades:
+            try:
+                legs = [
+                    (trade, order_type, params)
+                    for order_type, params in self.tpsl_order_params(trade)
+                ]
+            except Exception as e:
+                self.logger.error(
+                    f"Could not build tp/sl orders => {trade.id}/{trade.symbol} : {e}"
+                )
+                continue
+            if len(batches[-1]) + len(legs) > BATCH_ORDERS_MAX:
+                batches.append([])
+            batches[-1].extend(legs)
+
+        batches = [batch for batch in batches if batch]
+        for batch, responses in zip(
+            batches, self.fan_out(self.submit_tpsl_batch, batches)
+        ):
+            for (trade, order_type, _), response in zip(batch, responses):
+                if response is None:
+                    continue
+                setattr(trade, order_type, response)
+                self.session.add(trade)
+                self.logger.info(f"New {order_type} => {trade.id} : {response}")
+        self.commit(durable=True)
+
         return [
-            item
-            for item in [self.send_tpsl_order(trade) for trade in trades]
-            if item is not None
+            trade
+            for trade in trades
+            if trade.take_profit_order is not None and trade.stop_loss_order is not None
         ]
 
-    def send_tpsl_order(self, trade):
-        try:
-            info = [
-                x
-                for x in self.client.exchange_info()["symbols"]
-                if x.get("symbol") == trade.symbol
-            ][0]
-        except Exception as e:
-            self.logger.error(f"Could not get info for {trade.symbol}: {str(e)}")
-            return
-
-        quantity = trade.open_order["executedQty"]
-
-        # create the stop loss order
-        try:
-            params = {
-                "symbol": trade.symbol,
-                "side": "SELL" if trade.side == "BUY" else "BUY",
-                "type": "STOP_MARKET",
-                "quantity": quantity,
-                "reduceOnly": "true",
-                "stopPrice": format_price(trade.stop_loss, info),
-                "newOrderRespType": "FULL",
-                "timeInForce": "GTE_GTC",
-                "workingType": "MARK_PRICE",
-            }
-
-            response = self.client.new_order(**params)
-            confirmed_order = self.get_order(trade.symbol, response["orderId"])
-            trade.stop_loss_order = confirmed_order
-
-            self.session.add(trade)
-            self.session.commit()
-            self.logger.info(
-                f"New stop loss order => {trade.id} : {trade.stop_loss_order}"
-            )
-        except Exception as e:
-            self.logger.error(
-                f"Could not create new stop loss order => {trade.id}/{trade.symbol} : {e}"
-            )
-            return
+    def send_tpsl_order(self, trade: Trade):
+        return next(iter(self.send_tpsl_orders([trade])), None)
 
-        # create the take profit order
+    def submit_tpsl_batch(
+        self, batch: list[tuple[Trade, OrderType, dict]]
+    ) -> list[dict | None]:
+        """
+        Sends one batchOrders request and returns the created orders, lined up
+        with `batch` (None for the legs that didn't go through). Exchange I/O only.
+        """
         try:
-            params = {
-                "symbol": trade.symbol,
-                "side": "SELL" if trade.side == "BUY" else "BUY",
-                "type": "TAKE_PROFIT_MARKET",
-                "quantity": quantity,
-                "reduceOnly": "true",
-                "stopPrice": format_price(trade.targets[TARGET_NUM], info),
-                "newOrderRespType": "FULL",
-                "timeInForce": "GTE_GTC",
-                "workingType": "MARK_PRICE",
-            }
-
-            response = self.client.new_order(**params)
-            confirmed_order = self.get_order(trade.symbol, response["orderId"])
-            trade.take_profit_order = confirmed_order
-
-            self.session.add(trade)
-            self.session.commit()
-            self.logger.info(
-                f"New take profit order => {trade.id} : {trade.take_profit_order}"
+            # Not new_batch_order: binance-connector ships its own binance/api.py
+            # over the futures one, whose sign_request doesn't take `special`
+            responses = self.client.sign_request(
+                "POST",
+                "/fapi/v1/batchOrders",
+                {
+                    "batchOrders": json.dumps(
+                        [
+                            {k: decimal_string(v) for k, v in params.items()}
+                            for _, _, params in batch
+                        ]
+                    )
+                },
             )
         except Exception as e:
             self.logger.error(
-                f"Could not create new take profit order => {trade.id}/{trade.symbol} : {e}"
+                f"Could not create tp/sl orders => {[t.id for t, _, _ in batch]} : {e}"
             )
-            return
+            return [None] * len(batch)
 
-        return trade
+        orders: list[dict | None] = []
+        for (trade, order_type, _), response in zip(batch, responses):
+            if "orderId" not in response:
+                self.logger.error(
+                    f"Could not create new {order_type} => {trade.id}/{trade.symbol} : {response}"
+                )
+                orders.append(None)
+                continue
+            # The order responses carry updateTime but not time, which expiry relies on
+            response.setdefault("time", response.get("updateTime"))
+            orders.append(response)
+
+        placed = {
+            (id(trade), order_type)
+            for (trade, order_type, _), order in zip(batch, orders)
+            if order is not None
+        }
+        for i, ((trade, order_type, params), order) in enumerate(zip(batch, orders)):
+            if (
+                order_type == "take_profit_order"
+                and order is not None
+                and trade.stop_loss_order is None
+                and (id(trade), "stop_loss_order") not in placed
+            ):
+                # Don't leave a take profit without its stop loss. Both legs get
+                # retried next step since the trade is still pending tp/sl.
+                try:
+                    self.client.cancel_order(params["symbol"], orderId=order["orderId"])
+                    orders[i] = None
+                    self.logger.info(
+                        f"Cancelled take profit without stop loss => {trade.id}/{trade.symbol}"
+                    )
+                except Exception as e:
+                    self.logger.error(
+                        f"Could not cancel take profit without stop loss => {trade.id}/{trade.symbol} : {e}"
+                    )
+        return orders
 
     def cancel_tpsl_orders_and_close_position(self, trades: list[Trade]):
         """
@@ -196,33 +357,38 @@ class FuturesBot(Bot):
 
         Note: If either of the tp/sl orders are filled, you don't have to do anything!
         """
-        for trade in trades:
-            try:
-                self.client.new_order(
-                    **{
-                        "symbol": trade.symbol,
-                        "side": "SELL" if trade.side == "BUY" else "BUY",
-                        "type": "MARKET",
-                        "quantity": float(trade.open_order["origQty"]),
-                        "newOrderRespType": "FULL",
-                    }
-                )
-                trade.closed = 1
-                self.session.commit()
-                self.logger.info(f"closed position => {trade.id}/{trade.symbol}")
-            except Exception as e:
-                self.logger.error(
-                    f"Could not close position => {trade.id}/{trade.symbol}: {str(e)}"
-                )
-
-    def step(self):
-        self.logger.debug("--- NEW STEP ---")
+        for trade, response in zip(trades, self.fan_out(self.close_position, trades)):
+            if response is None:
+                continue
+            trade.closed = 1
+            self.logger.info(f"closed position => {trade.id}/{trade.symbol}")
+        self.commit(durable=True)
+
+    def close_position(self, trade: Trade) -> dict | None:
+        try:
+            return self.client.new_order(
+                **{
+                    "symbol": trade.symbol,
+                    "side": "SELL" if trade.side == "BUY" else "BUY",
+                    "type": "MARKET",
+                    "quantity": float(trade.open_order["origQty"]),
+                    "newOrderRespType": "FULL",
+                }
+            )
+        except Exception as e:
+            self.logger.error(
+                f"Could not close position => {trade.id}/{trade.symbol}: {str(e)}"
+            )
+            return None
 
+    def detect_fills(self):
         pendingOpeningOrders = self.get_trades_with_pending_opening_order()
         self.logger.debug(f"Pending opening orders => {pendingOpeningOrders}")
         filledOpeningOrders = self.filter_trades_with_filled_order(
             self.update_order_statuses(pendingOpeningOrders, "open_order"), "open_order"
         )
+        # Protect new positions before anything else uses up the rate limit
+        self.send_tpsl_orders(filledOpeningOrders)
 
         pendingTpSlOrders = self.get_trades_with_pending_take_profit_order()
         self.logger.debug(f"Pending tp/sl orders => {pendingTpSlOrders}")
@@ -230,27 +396,22 @@ class FuturesBot(Bot):
             pendingTpSlOrders, "take_profit_order"
         )
         self.update_order_statuses(pendingTpSlOrders, "stop_loss_order")
+        self.close_finished_trades(pendingTpSlOrders)
 
-        self.send_tpsl_orders(filledOpeningOrders)
-
-        # Cull orders taking too long to fill
+    def cull_expired_orders(self):
+        if self.defer("status", "expiry culling"):
+            return
         self.cancel_open_orders(
-            self.filter_trades_with_orders_taking_too_long_to_fill(
-                self.get_trades_with_pending_opening_order(),
-                "open_order",
-                ORDER_EXPIRY_TIME_HOURS,
-            ),
+            self.get_trades_with_expired_order("open_order", ORDER_EXPIRY_TIME_HOURS)
         )
         self.cancel_tpsl_orders_and_close_position(
-            self.filter_trades_with_orders_taking_too_long_to_fill(
-                self.get_trades_with_pending_take_profit_order(),
-                "take_profit_order",
-                ORDER_EXPIRY_TIME_HOURS,
-            ),
+            self.get_trades_with_expired_order(
+                "take_profit_order", ORDER_EXPIRY_TIME_HOURS
+            )
         )
 
-        # Get account and balance information
-        account_balance = float(
+    def refresh_balance(self):
+        self.account_balance = float(
             [
                 b["availableBalance"]
                 for b in self.client.account()["assets"]
@@ -258,33 +419,66 @@ class FuturesBot(Bot):
             ][0]
         )
 
-        if account_balance > ORDER_SIZE:
+    def open_new_trades(self):
+        self.stage_trades()
+        if self.defer("entry", "new entries", weight=10, orders=1):
+            return
+        if self.account_balance is None:
+            self.refresh_balance()
+
+        if self.account_balance > ORDER_SIZE:
             unseen_trades = self.get_unexecuted_trades(latest_first=True, limit=100)
             self.logger.debug(f"Unseen trades => {unseen_trades}")
+            self.watch_entries(unseen_trades)
             viable_trades = self.filter_viable_trades(unseen_trades)
             pendingOpeningOrders = self.send_open_orders(
-                itertools.islice(viable_trades, int(account_balance // ORDER_SIZE))
+                itertools.islice(viable_trades, int(self.account_balance // ORDER_SIZE))
             )
+            # Until the next balance refresh
+            self.account_balance -= ORDER_SIZE * len(pendingOpeningOrders)
         else:
             self.logger.debug("!!! Insufficient USDT balance !!!")
 
-        # TODO: Token accounting
+    def step(self):
+        self.logger.debug("--- NEW STEP ---")
+        self.begin_step()
+        with self.unit_of_work():
+            self.detect_fills()
+        with self.unit_of_work():
+            self.cull_expired_orders()
+        self.account_balance = None
+        with self.unit_of_work():
+            self.open_new_trades()
+        self.end_step()
+
+        # TODO: Token accounting, on top of the fills ledger (Trade.fills)
 
 
 def main():
+    migrate(engine, LOGGER)
     bot = FuturesBot(
         BINANCE_API_KEY, BINANCE_API_SECRET, BINANCE_API_URL, SESSION, LOGGER
     )
-
-    while True:
-        try:
-            bot.step()
-        except Exception:
-            # self.logger.info detailed trace of the error
-            LOGGER.error("!!! step failed :/ !!!")
-            LOGGER.error(traceback.format_exc())
-
-        time.sleep(DELAY_BETWEEN_STEPS)
-
-
-main()
+    if BINANCE_STREAM_URL:
+        bot.start_price_feed(BINANCE_STREAM_URL)
+    if BINANCE_USER_STREAM_URL:
+        bot.start_order_events(BINANCE_USER_STREAM_URL)
+    if MEMORY_LOG_INTERVAL:
+        bot.track_memory(float(MEMORY_LOG_INTERVAL))
+
+    scheduler = StepScheduler(bot, LOGGER)
+    scheduler.every("fills", DELAY_BETWEEN_STEPS, bot.detect_fills)
+    scheduler.every("expiry", EXPIRY_CHECK_INTERVAL, bot.cull_expired_orders)
+    scheduler.every("balance", BALANCE_REFRESH_INTERVAL, bot.refresh_balance)
+    scheduler.every("intake", DELAY_BETWEEN_STEPS, bot.open_new_trades)
+    if bot.order_events is not None:
+        bot.order_events.on_update = scheduler.wakeup.set
+    CallListener(
+        CALL_SOCKETS["futures"], LOGGER, lambda trade_id: scheduler.trigger("intake")
+    ).start()
+
+    scheduler.run_forever()
+
+
+if __name__ == "__main__":
+    main()
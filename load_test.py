@@ -0,0 +1,128 @@
+"""
+Runs FuturesBot or SpotBot against the exchange simulator with thousands of
+calls in flight, to see which part of the step gives out first:
+
+    python load_test.py --bot futures --trades 5000 --steps 50 --latency 0.02
+"""
+import argparse
+import collections
+import datetime
+import os
+import tempfile
+import time
+from sqlalchemy import func
+from db import make_engine, make_session
+from migrate import migrate
+from models import Trade
+from simulator import Market, Simulator, random_walk
+from utils import setup_logger
+
+
+def seed_calls(session, paths: dict[str, list[float]], n: int, sides: tuple[str, ...]):
+    """Calls whose entry range brackets each symbol's opening price"""
+    symbols = list(paths)
+    for i in range(n):
+        symbol = symbols[i % len(symbols)]
+        price = paths[symbol][0]
+        side = sides[i % len(sides)]
+        direction = 1 if side == "BUY" else -1
+        session.add(
+            Trade(
+                symbol=symbol,
+                side=side,
+                entry=[price * 0.995, price * 1.005],
+                stop_loss=price * (1 - direction * 0.02),
+                targets=[price * (1 + direction * 0.005 * k) for k in range(1, 7)],
+                timestamp=datetime.datetime.now(),
+                texthash=f"load-{i}",
+            )
+        )
+    session.commit()
+
+
+def make_bot(kind: str, url: str, session, logger):
+    # Imported here so the other bot's module-level setup doesn't run
+    if kind == "futures":
+        import futures_bot as module
+
+        bot_class = module.FuturesBot
+    else:
+        import spot_bot as module
+
+        bot_class = module.SpotBot
+    # Don't pick up (or overwrite) the real exchange info cache
+    module.EXCHANGE_INFO_PATH = None
+    return bot_class("key", "secret", url, session, logger)
+
+
+def state_counts(session) -> dict[str, int]:
+    return dict(session.query(Trade.state, func.count()).group_by(Trade.state).all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bot", choices=("futures", "spot"), default="futures")
+    parser.add_argument("--trades", type=int, default=1000)
+    parser.add_argument("--symbols", type=int, default=50)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--step-delay", type=float, default=0.0)
+    parser.add_argument("--tick-seconds", type=float, default=0.5)
+    parser.add_argument("--volatility", type=float, default=0.003)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--weight-limit", type=int, default=1200)
+    args = parser.parse_args()
+
+    logger = setup_logger("load-test")
+    paths = random_walk(
+        {f"SIM{i}USDT": 10.0 ** (i % 5) for i in range(args.symbols)},
+        100_000,
+        args.volatility,
+    )
+    market = Market(
+        paths,
+        args.tick_seconds,
+        quote_balance=args.trades * 1000.0,
+        weight_limit=args.weight_limit,
+    )
+    simulator = Simulator(
+        market,
+        logger,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+    )
+    simulator.start()
+
+    engine = make_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load.db')}")
+    migrate(engine, logger)
+    session = make_session(engine)
+    sides = ("BUY", "SELL") if args.bot == "futures" else ("BUY",)
+    seed_calls(session, paths, args.trades, sides)
+
+    bot = make_bot(args.bot, simulator.url, session, logger)
+    print("step,seconds,requests,weight_used,NEW,OPEN_PENDING,PROTECTED,CLOSED")
+    for n in range(1, args.steps + 1):
+        requests_before = sum(simulator.requests.values())
+        started = time.perf_counter()
+        bot.step()
+        seconds = time.perf_counter() - started
+        counts = collections.Counter(state_counts(session))
+        print(
+            f"{n},{seconds:.3f},{sum(simulator.requests.values()) - requests_before},"
+            f"{simulator.weight_window[1]},{counts['NEW']},{counts['OPEN_PENDING']},"
+            f"{counts['PROTECTED']},{counts['CLOSED']}",
+            flush=True,
+        )
+        session.close()
+        time.sleep(args.step_delay)
+
+    busiest = sorted(simulator.requests.items(), key=lambda item: -item[1])
+    for (method, path), count in busiest[:10]:
+        print(f"# {count} x {method} {path}")
+    simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import resource
+import time
+import tracemalloc
+from logging import Logger
+from sqlalchemy.orm import Session
+
+
+class MemoryStats:
+    """
+    Logs the session's identity map size and the top tracemalloc allocation
+    sites every `interval` seconds, to catch a bot slowly growing over weeks.
+    """
+
+    def __init__(self, logger: Logger, interval: float, top_n: int = 10):
+        self.logger = logger
+        self.interval = interval
+        self.top_n = top_n
+        self.last_logged = 0.0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def maybe_log(self, session: Session):
+        now = time.time()
+        if now - self.last_logged < self.interval:
+            return
+        self.last_logged = now
+        self.log(session)
+
+    def log(self, session: Session):
+        current, peak = tracemalloc.get_traced_memory()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on linux
+        self.logger.info(
+            f"Memory => identity map {len(session.identity_map)} objects, "
+            f"traced {current // 1024} KiB (peak {peak // 1024} KiB), "
+            f"max rss {max_rss} KiB"
+        )
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+        for stat in snapshot.statistics("lineno")[: self.top_n]:
+            self.logger.info(f"Memory => {stat}")
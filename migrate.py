@@ -0,0 +1,82 @@
+from logging import Logger
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from models import Base, Fill, Order, Trade, sync_order
+
+
+def migrate(engine: Engine, logger: Logger):
+    """
+    Brings an existing tradingbot.db up to the current schema: creates missing
+    tables, adds the new trades columns (backfilling state), and copies the
+    order payloads into the orders table. Safe to run on every start.
+    """
+    Base.metadata.create_all(engine, checkfirst=True)
+
+    columns = {column["name"] for column in inspect(engine).get_columns("trades")}
+    if "state" not in columns:
+        logger.info("Migrating trades => adding state column")
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "ALTER TABLE trades ADD COLUMN state VARCHAR(12) NOT NULL DEFAULT 'NEW'"
+                )
+            )
+            # Cleared orders used to be stored as JSON 'null' rather than NULL
+            for column in ("open_order", "take_profit_order", "stop_loss_order"):
+                conn.execute(
+                    text(f"UPDATE trades SET {column} = NULL WHERE {column} = 'null'")
+                )
+            conn.execute(
+                text(
+                    """
+                    UPDATE trades SET state = CASE
+                        WHEN closed != 0 THEN 'CLOSED'
+                        WHEN open_order IS NULL THEN 'NEW'
+                        WHEN take_profit_order IS NULL THEN 'OPEN_PENDING'
+                        ELSE 'PROTECTED'
+                    END
+                    """
+                )
+            )
+
+    if "order_templates" not in columns:
+        logger.info("Migrating trades => adding order_templates column")
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE trades ADD COLUMN order_templates JSON"))
+
+    if "open_client_order_id" not in columns:
+        logger.info("Migrating trades => adding open_client_order_id column")
+        with engine.begin() as conn:
+            conn.execute(
+                text("ALTER TABLE trades ADD COLUMN open_client_order_id VARCHAR")
+            )
+
+    with engine.begin() as conn:
+        # Templates used to be staged for one market only, restage them by market
+        conn.execute(
+            text(
+                "UPDATE trades SET order_templates = NULL"
+                " WHERE json_type(order_templates, '$.open_order') IS NOT NULL"
+            )
+        )
+
+    with engine.begin() as conn:
+        # Was unique on (symbol, exchange_trade_id), which spot and futures share
+        conn.execute(text("DROP INDEX IF EXISTS ix_fills_symbol_trade"))
+
+    # create_all skips the indexes of tables that already existed
+    for index in [*Trade.__table__.indexes, *Fill.__table__.indexes]:
+        index.create(engine, checkfirst=True)
+
+    with Session(engine) as session:
+        if session.query(Order.id).first() is not None:
+            return
+        trades = session.query(Trade).filter(Trade.open_order.is_not(None)).all()
+        if not trades:
+            return
+        logger.info(f"Migrating orders => backfilling from {len(trades)} trades")
+        for trade in trades:
+            for order_type in ("open_order", "take_profit_order", "stop_loss_order"):
+                sync_order(trade, order_type, getattr(trade, order_type))
+        session.commit()
@@ -1,21 +1,56 @@
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
     String,
     DateTime,
     Float,
     JSON,
     Enum,
     SmallInteger,
+    ForeignKey,
+    Index,
+    event,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from typing import Literal, TypeAlias
+from sqlalchemy.orm import relationship
+from typing import Literal, TypeAlias, get_args
 from dataclasses import dataclass
+import datetime
 
 Base = declarative_base()
 
 OrderType = Literal["open_order", "take_profit_order", "stop_loss_order"]
 
+# NEW: call parsed, nothing sent yet
+# OPEN_PENDING: opening order sent, waiting for it to fill and get its tp/sl
+# PROTECTED: take profit (and stop loss) in place
+# CLOSED: cancelled, closed out, or its take profit/stop loss filled
+TradeState = Literal["NEW", "OPEN_PENDING", "PROTECTED", "CLOSED"]
+
+# Exchange order statuses that can still change
+OPEN_ORDER_STATUSES = ("NEW", "PARTIALLY_FILLED")
+
+
+def trade_state(open_order, take_profit_order, closed) -> TradeState:
+    if closed:
+        return "CLOSED"
+    if open_order is None:
+        return "NEW"
+    if take_profit_order is None:
+        return "OPEN_PENDING"
+    return "PROTECTED"
+
+
+def order_time(order: dict) -> datetime.datetime | None:
+    """When the exchange created the order, from whichever field the payload has"""
+    timestamp = (
+        order.get("time") or order.get("transactTime") or order.get("updateTime")
+    )
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp // 1000)
+
 
 @dataclass
 class Trade(Base):
@@ -28,12 +63,182 @@ class Trade(Base):
     stop_loss = Column(Float, nullable=False)
     targets = Column(JSON, nullable=False)  # should be float[6]
     timestamp = Column(DateTime, nullable=False)
-    texthash = Column(String, nullable=False)
+    texthash = Column(String, nullable=False, index=True)  # see telegram_bot dedup
     bragged = Column(SmallInteger, nullable=False, server_default="0")
-    open_order = Column(JSON)  # should be {open_order}
-    take_profit_order = Column(JSON)  # should be {take_profit_order}
-    stop_loss_order = Column(JSON)  # should be {stop_loss_order}
+    # none_as_null so that clearing one stores NULL rather than JSON 'null'
+    open_order = Column(JSON(none_as_null=True))  # should be {open_order}
+    take_profit_order = Column(JSON(none_as_null=True))  # should be {take_profit_order}
+    stop_loss_order = Column(JSON(none_as_null=True))  # should be {stop_loss_order}
     closed = Column(SmallInteger, nullable=False, server_default="0")
+    # Ready-to-send order params by market (Bot.market), built once when the call
+    # comes in (Bot.stage_trades)
+    order_templates = Column(JSON(none_as_null=True))
+    # newClientOrderId of the opening order, committed before it's sent so a
+    # retry looks the order up instead of sending another (Bot.send_open_orders)
+    open_client_order_id = Column(String)
+    # Kept in sync with the columns above, see sync_state
+    state = Column(
+        Enum(*get_args(TradeState), name="trade_state"),
+        nullable=False,
+        server_default="NEW",
+        default="NEW",
+    )
+
+    orders = relationship("Order", back_populates="trade", cascade="all, delete-orphan")
+    fills = relationship("Fill", back_populates="trade", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        # Partial indexes so the step queries stay O(active trades). One per
+        # state, SQLite only picks a partial index for an exact match of its WHERE.
+        Index("ix_trades_open_pending", "id", sqlite_where=state == "OPEN_PENDING"),
+        Index("ix_trades_protected", "id", sqlite_where=state == "PROTECTED"),
+        Index(
+            "ix_trades_new",
+            "id",
+            "timestamp",
+            sqlite_where=(state == "NEW") & (bragged == 0),
+        ),
+    )
+
+    def __repr__(self):
+        return f"Trade({self.id}, {self.timestamp}, {self.symbol}, {self.side}, entry={self.entry}, stop_loss={self.stop_loss}, targets={self.targets}, texthash={self.texthash}, bragged={self.bragged}, open_order={self.open_order}, take_profit_order={self.take_profit_order}, stop_loss_order={self.stop_loss_order}, closed={self.closed}, state={self.state})"
+
+
+class Order(Base):
+    """
+    Typed, indexed copy of the order payloads in Trade.open_order & co, kept in
+    sync whenever one of them is set (see sync_order)
+    """
+
+    __tablename__ = "orders"
+
+    id = Column(Integer, primary_key=True)
+    trade_id = Column(Integer, ForeignKey("trades.id"), nullable=False, index=True)
+    order_type = Column(
+        Enum(*get_args(OrderType), name="order_type"),
+        nullable=False,
+    )
+    symbol = Column(String, nullable=False)
+    order_id = Column(BigInteger, nullable=False)
+    status = Column(String)
+    created_time = Column(DateTime)
+    updated_time = Column(DateTime)
+
+    trade = relationship("Trade", back_populates="orders")
+
+    __table_args__ = (
+        Index("ix_orders_symbol_order_id", "symbol", "order_id"),
+        Index(
+            "ix_orders_open",
+            "status",
+            "created_time",
+            sqlite_where=status.in_(OPEN_ORDER_STATUSES),
+        ),
+    )
+
+    def __repr__(self):
+        return f"Order({self.id}, trade={self.trade_id}, {self.order_type}, {self.symbol}, {self.order_id}, {self.status}, created={self.created_time})"
+
+
+class Fill(Base):
+    """
+    One execution of one of the trade's orders, from a FULL order response, the
+    user data stream or my_trades (see Bot.record_fills)
+    """
+
+    __tablename__ = "fills"
+
+    id = Column(Integer, primary_key=True)
+    trade_id = Column(Integer, ForeignKey("trades.id"), nullable=False, index=True)
+    order_type = Column(
+        Enum(*get_args(OrderType), name="order_type"),
+        nullable=False,
+    )
+    symbol = Column(String, nullable=False)
+    order_id = Column(BigInteger, nullable=False)
+    exchange_trade_id = Column(BigInteger, nullable=False)
+    price = Column(Float, nullable=False)
+    quantity = Column(Float, nullable=False)
+    commission = Column(Float, nullable=False)
+    commission_asset = Column(String)
+
+    trade = relationship("Trade", back_populates="fills")
+
+    __table_args__ = (
+        # Trade ids are per symbol and market, an order's are its own
+        Index("ix_fills_order_trade", "order_id", "exchange_trade_id", unique=True),
+    )
+
+    def __repr__(self):
+        return f"Fill({self.id}, trade={self.trade_id}, {self.order_type}, {self.symbol}, {self.order_id}, {self.quantity}@{self.price}, commission={self.commission} {self.commission_asset})"
+
+
+class Watermark(Base):
+    """The newest message ingested from a channel, where telegram_bot resumes from"""
+
+    __tablename__ = "watermarks"
+
+    channel = Column(String, primary_key=True)
+    message_id = Column(Integer, nullable=False)
+    message_date = Column(DateTime, nullable=False)
 
     def __repr__(self):
-        return f"Trade({self.id}, {self.timestamp}, {self.symbol}, {self.side}, entry={self.entry}, stop_loss={self.stop_loss}, targets={self.targets}, texthash={self.texthash}, bragged={self.bragged}, open_order={self.open_order}, take_profit_order={self.take_profit_order}, stop_loss_order={self.stop_loss_order}, closed={self.closed})"
+        return f"Watermark({self.channel}, {self.message_id}, {self.message_date})"
+
+
+def sync_order(trade: Trade, order_type: OrderType, order: dict | None):
+    if order is None or "orderId" not in order:
+        return
+    row = next(
+        (
+            o
+            for o in trade.orders
+            if o.order_type == order_type and o.order_id == order["orderId"]
+        ),
+        None,
+    )
+    if row is None:
+        row = Order(
+            order_type=order_type,
+            symbol=order.get("symbol") or trade.symbol,
+            order_id=order["orderId"],
+            created_time=order_time(order),
+        )
+        trade.orders.append(row)
+    row.status = order.get("status")
+    if order.get("updateTime"):
+        row.updated_time = datetime.datetime.fromtimestamp(order["updateTime"] // 1000)
+    if row.created_time is None:
+        row.created_time = order_time(order)
+
+
+def sync_state(trade: Trade, **changed):
+    current = {
+        "open_order": trade.open_order,
+        "take_profit_order": trade.take_profit_order,
+        "closed": trade.closed,
+    }
+    trade.state = trade_state(**dict(current, **changed))
+
+
+# "set" fires before the new value is stored, hence passing it along
+@event.listens_for(Trade.open_order, "set")
+def on_open_order_set(trade, value, oldvalue, initiator):
+    sync_order(trade, "open_order", value)
+    sync_state(trade, open_order=value)
+
+
+@event.listens_for(Trade.take_profit_order, "set")
+def on_take_profit_order_set(trade, value, oldvalue, initiator):
+    sync_order(trade, "take_profit_order", value)
+    sync_state(trade, take_profit_order=value)
+
+
+@event.listens_for(Trade.stop_loss_order, "set")
+def on_stop_loss_order_set(trade, value, oldvalue, initiator):
+    sync_order(trade, "stop_loss_order", value)
+
+
+@event.listens_for(Trade.closed, "set")
+def on_closed_set(trade, value, oldvalue, initiator):
+    sync_state(trade, closed=value)
@@ -0,0 +1,61 @@
+import os
+import socket
+import threading
+from logging import Logger
+from typing import Callable
+
+# One datagram socket per trading bot, next to tradingbot.db
+CALL_SOCKETS = {"futures": "futures_bot.sock", "spot": "spot_bot.sock"}
+
+
+class CallNotifier:
+    """
+    Tells the trading bots a new call was saved, so they don't have to wait
+    for their next poll of the trades table. Fire and forget: if a bot isn't
+    running it picks the call up from the DB when it starts.
+    """
+
+    def __init__(self, paths: list[str], logger: Logger):
+        self.paths = paths
+        self.logger = logger
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def notify(self, trade_id: int):
+        for path in self.paths:
+            try:
+                self.sock.sendto(str(trade_id).encode(), path)
+            except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+                self.logger.debug(f"No bot listening on {path}")
+            except OSError as e:
+                self.logger.error(f"Could not notify {path} of {trade_id}: {e}")
+
+
+class CallListener:
+    """Receives CallNotifier datagrams and hands the trade ids to on_call"""
+
+    def __init__(self, path: str, logger: Logger, on_call: Callable[[int], None]):
+        self.path = path
+        self.logger = logger
+        self.on_call = on_call
+        self.sock: socket.socket | None = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            # Left behind by a previous run
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        threading.Thread(target=self._listen, name="calls", daemon=True).start()
+        self.logger.info(f"Listening for new calls => {self.path}")
+
+    def _listen(self):
+        while True:
+            data = self.sock.recv(64)
+            try:
+                trade_id = int(data)
+            except ValueError:
+                self.logger.error(f"Bad call notification => {data!r}")
+                continue
+            self.logger.debug(f"New call notification => {trade_id}")
+            self.on_call(trade_id)
@@ -0,0 +1,134 @@
+import json
+import queue
+import threading
+import time
+from logging import Logger
+from typing import Callable
+from binance.spot import Spot
+from binance.um_futures import UMFutures
+from streams import StreamClient
+
+
+def normalize_order_event(event: dict) -> dict | None:
+    """
+    Maps an ORDER_TRADE_UPDATE (futures) or executionReport (spot) event onto
+    the field names query_order/get_order use, so it can be merged straight
+    into Trade.open_order & co. Returns None for anything that isn't an order update.
+    """
+    if event.get("e") == "ORDER_TRADE_UPDATE":
+        o = event["o"]
+        return {
+            "symbol": o["s"],
+            "orderId": o["i"],
+            "clientOrderId": o["c"],
+            "status": o["X"],
+            "executedQty": o["z"],
+            "avgPrice": o["ap"],
+            "updateTime": event["T"],
+            "lastFilledQty": o["l"],
+            "lastFilledPrice": o["L"],
+            "commission": o.get("n", "0"),
+            "commissionAsset": o.get("N"),
+            "tradeId": o["t"],
+            "executionType": o["x"],
+        }
+    if event.get("e") == "executionReport":
+        return {
+            "symbol": event["s"],
+            "orderId": event["i"],
+            "clientOrderId": event["c"],
+            "status": event["X"],
+            "executedQty": event["z"],
+            "cummulativeQuoteQty": event["Z"],
+            "updateTime": event["T"],
+            "lastFilledQty": event["l"],
+            "lastFilledPrice": event["L"],
+            "commission": event.get("n", "0"),
+            "commissionAsset": event.get("N"),
+            "tradeId": event["t"],
+            "executionType": event["x"],
+        }
+    return None
+
+
+class OrderEventStream:
+    """
+    Listens to the user data stream and queues normalized order updates.
+    The bot drains the queue on its own thread (see Bot.apply_order_events),
+    so the SQLAlchemy session is never touched from the reactor thread.
+    """
+
+    # Binance expires listen keys after 60 minutes without a keepalive
+    KEEPALIVE_SECONDS = 30 * 60
+
+    def __init__(
+        self,
+        client: Spot | UMFutures,
+        stream_url: str,
+        logger: Logger,
+        record_path: str | None = None,
+    ):
+        self.client = client
+        self.stream_url = stream_url
+        self.logger = logger
+        self.record_path = record_path
+        self.listen_key: str | None = None
+        self.events: queue.Queue[dict] = queue.Queue()
+        self.wakeup = threading.Event()
+        self.on_update: Callable[[], None] | None = None
+        self.alive = False
+        self.stream: StreamClient | None = None
+
+    def start(self):
+        self.listen_key = self.client.new_listen_key()["listenKey"]
+        self.stream = StreamClient(self.stream_url)
+        self.stream.start()
+        self.stream.live_subscribe(self.listen_key, id=1, callback=self.on_message)
+        self.alive = True
+        threading.Thread(
+            target=self._keepalive_forever, name="listen-key", daemon=True
+        ).start()
+        self.logger.info(f"Subscribed to user data stream => {self.stream_url}")
+
+    def stop(self):
+        self.alive = False
+        if self.stream is not None:
+            self.stream.close()
+
+    def _keepalive_forever(self):
+        while self.alive:
+            time.sleep(self.KEEPALIVE_SECONDS)
+            try:
+                self.client.renew_listen_key(self.listen_key)
+            except Exception as e:
+                # Polling takes over until we're restarted
+                self.alive = False
+                self.logger.error(f"Could not renew listen key: {e}")
+
+    def on_message(self, message):
+        if not isinstance(message, dict):
+            return
+        if self.record_path is not None:
+            with open(self.record_path, "a") as f:
+                f.write(json.dumps(message) + "\n")
+
+        if message.get("e") in ("error", "listenKeyExpired"):
+            self.alive = False
+            self.logger.error(f"User data stream is down => {message}")
+            return
+
+        update = normalize_order_event(message)
+        if update is not None:
+            self.events.put(update)
+            self.wakeup.set()
+            if self.on_update is not None:
+                self.on_update()
+
+    def drain(self) -> list[dict]:
+        self.wakeup.clear()
+        updates = []
+        while True:
+            try:
+                updates.append(self.events.get_nowait())
+            except queue.Empty:
+                return updates
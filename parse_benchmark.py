@@ -0,0 +1,91 @@
+"""
+Parser throughput over a synthetic channel history (calls, plus the replies
+and chatter in between): python parse_benchmark.py --calls 100000
+"""
+import argparse
+import datetime
+import random
+import time
+from types import SimpleNamespace
+from parse_call import Rejected, TradingCallParser
+
+
+def synthetic_call(rng: random.Random, message_id: int, date) -> SimpleNamespace:
+    coin = "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(4))
+    price = round(rng.uniform(0.01, 50000), 4)
+    long = rng.random() < 0.7
+    direction = 1 if long else -1
+    targets = "\n".join(
+        f"Target {n} • {price * (1 + direction * step):.4f}"
+        for n, step in enumerate((0.005, 0.013, 0.021, 0.035, 0.043, 0.052), 1)
+    )
+    text = (
+        f"⚡️⚡️ #{coin}/USDT ⚡️⚡️\n"
+        f"**Setup:** {coin}USDT\n"
+        f"**{'Long' if long else 'Short'} trade**\n"
+        f"Entry zone: {price * 1.002:.4f} - {price * 0.998:.4f}\n"
+        f"Stop-loss: {price * (1 - direction * 0.08):.4f}\n"
+        f"\n{targets}\n\n"
+        f"Leverage: cross 20x"
+    )
+    return SimpleNamespace(id=message_id, text=text, date=date)
+
+
+def synthetic_history(calls: int, seed: int = 0) -> list[SimpleNamespace]:
+    rng = random.Random(seed)
+    date = datetime.datetime(2022, 1, 1)
+    messages = []
+    for message_id in range(1, calls + 1):
+        date += datetime.timedelta(minutes=rng.randint(1, 30))
+        messages.append(synthetic_call(rng, message_id, date))
+        if rng.random() < 0.3:
+            # A brag under an earlier call
+            messages.append(
+                SimpleNamespace(
+                    id=-message_id, text="Target 3 ✅ +21% profit 🚀", date=date
+                )
+            )
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    messages = synthetic_history(args.calls)
+    lines = sum(message.text.count("\n") + 1 for message in messages)
+    call_parser = TradingCallParser()
+
+    best = None
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        tokenized = 0
+        for message in messages:
+            for line in message.text.lower().split("\n"):
+                call_parser.tokenize(line)
+                tokenized += 1
+        tokenize_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        parsed = rejected = 0
+        for result in call_parser.parse_many(messages):
+            if isinstance(result, Rejected):
+                rejected += 1
+            else:
+                parsed += 1
+        parse_seconds = time.perf_counter() - started
+        if best is None or parse_seconds < best[1]:
+            best = (tokenize_seconds, parse_seconds)
+
+    tokenize_seconds, parse_seconds = best
+    print(
+        f"{len(messages)} messages, {lines} lines => {parsed} calls, {rejected} rejects"
+    )
+    print(f"tokenize   {lines / tokenize_seconds:12,.0f} lines/s")
+    print(f"parse_many {len(messages) / parse_seconds:12,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,52 @@
 import re
+from dataclasses import dataclass
+from typing import Iterable, Iterator
 from models import Trade
 from hashlib import sha256
 
+# (token, literal every match contains, pattern), in order of precedence. The
+# substring checks are what classify a line, so most lines run one regex.
+TOKEN_PATTERNS = (
+    ("symbol", "setup:** ", re.compile(r"setup:\*\* (.*)")),
+    ("side", " trade", re.compile(r"(\w+) trade")),
+    (
+        "entry",
+        "entry zone: ",
+        re.compile(r"entry zone: (\d+(?:\.\d+)? - \d+(?:\.\d+)?)"),
+    ),
+    ("stop_loss", "stop-loss: ", re.compile(r"stop-loss: (\d+\.\d+)")),
+    ("target", " • ", re.compile(r"target \d+ • (\d+\.\d+)")),
+)
+SIDES = {"long": "BUY", "short": "SELL"}
+
+
+@dataclass
+class Rejected:
+    """A message parse_many couldn't make a call out of"""
+
+    message_id: int
+    reason: str
+
 
 class TradingCallParser:
     def __init__(self):
         pass
 
     def tokenize(self, txt: str) -> dict[str, str]:
-        match = re.search(r"setup:\*\* (.*)", txt)
-        if match:
-            return {"symbol": match.group(1).upper()}
-
-        match = re.search(r"(\w+) trade", txt)
-        if match:
-            side = match.group(1).upper()
-            if side != "LONG" and side != "SHORT":
-                raise ValueError("Invalid trade type")
-            return {"side": "BUY" if side == "LONG" else "SELL"}
-        match = re.search(r"entry zone: (\d+(\.\d+)? - \d+(\.\d+)?)", txt)
-
-        if match:
-            return {"entry": match.group(1)}
-
-        match = re.search(r"stop-loss: (\d+\.\d+)", txt)
-        if match:
-            return {"stop_loss": match.group(1)}
-
-        match = re.search(r"target [\d]+ • (\d+\.\d+)", txt)
-        if match:
-            return {"target": match.group(1)}
+        for key, literal, pattern in TOKEN_PATTERNS:
+            if literal not in txt:
+                continue
+            match = pattern.search(txt)
+            if match is None:
+                continue
+            value = match.group(1)
+            if key == "symbol":
+                return {"symbol": value.upper()}
+            if key == "side":
+                if value.lower() not in SIDES:
+                    raise ValueError("Invalid trade type")
+                return {"side": SIDES[value.lower()]}
+            return {key: value}
         return {}
 
     def parse(self, message) -> Trade:
@@ -59,3 +76,20 @@ class TradingCallParser:
             timestamp=message.date,
             texthash=sha256(message.text.encode("utf-8")).hexdigest(),
         )
+
+    def parse_many(self, messages: Iterable) -> Iterator[Trade | Rejected]:
+        """
+        Streams the calls out of `messages` (anything with id, text and date),
+        with a Rejected in place of each message that isn't one
+        """
+        for message in messages:
+            # Media-only posts have no text
+            if not message.text or "setup" not in message.text.lower():
+                yield Rejected(message.id, "not a call")
+                continue
+            try:
+                yield self.parse(message)
+            except KeyError as e:
+                yield Rejected(message.id, f"missing {e.args[0]}")
+            except ValueError as e:
+                yield Rejected(message.id, str(e))
@@ -0,0 +1,81 @@
+import threading
+import time
+from logging import Logger
+from streams import StreamClient
+
+
+class PriceBook:
+    """
+    Last known price per symbol as {symbol: (price, timestamp)}.
+    Filled in bulk (one request for every symbol) and read by Bot.get_price.
+    """
+
+    def __init__(self):
+        self.prices: dict[str, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def update(self, symbol: str, price: float, timestamp: float | None = None):
+        with self._lock:
+            self.prices[symbol] = (price, timestamp or time.time())
+
+    def update_many(self, prices: dict[str, float], timestamp: float | None = None):
+        timestamp = timestamp or time.time()
+        with self._lock:
+            self.prices.update(
+                {symbol: (price, timestamp) for symbol, price in prices.items()}
+            )
+
+    def get(self, symbol: str, max_age: float) -> float | None:
+        """Returns None if we don't know the price or it's older than max_age"""
+        entry = self.prices.get(symbol)
+        if entry is None or time.time() - entry[1] > max_age:
+            return None
+        return entry[0]
+
+
+class PriceFeed:
+    """
+    Keeps a PriceBook up to date from an all-market stream
+    (!markPrice@arr@1s on futures, !miniTicker@arr on spot)
+    """
+
+    def __init__(
+        self,
+        stream_url: str,
+        stream: str,
+        price_key: str,
+        book: PriceBook,
+        logger: Logger,
+    ):
+        self.stream_url = stream_url
+        self.stream = stream
+        self.price_key = price_key
+        self.book = book
+        self.logger = logger
+        self.last_message_at = 0.0
+        self.client: StreamClient | None = None
+
+    def start(self):
+        self.client = StreamClient(self.stream_url)
+        self.client.start()
+        self.client.live_subscribe(self.stream, id=1, callback=self.on_message)
+        self.logger.info(f"Subscribed to {self.stream} => {self.stream_url}")
+
+    def stop(self):
+        if self.client is not None:
+            self.client.close()
+
+    def on_message(self, message):
+        if not isinstance(message, list):
+            if message.get("e") == "error":
+                self.logger.error(f"Price stream error => {message}")
+            return
+
+        now = time.time()
+        self.book.update_many(
+            {event["s"]: float(event[self.price_key]) for event in message}, now
+        )
+        self.last_message_at = now
+
+    def is_alive(self, max_age: float) -> bool:
+        return time.time() - self.last_message_at <= max_age
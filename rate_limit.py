@@ -0,0 +1,107 @@
+import collections
+import threading
+import time
+from logging import Logger
+from typing import Literal
+from requests import Response
+
+# Protective orders first, then status refresh, then new entries
+Priority = Literal["protective", "status", "entry"]
+
+# How much of the budget each priority class may use before it's deferred.
+# Protective orders are never deferred by the budget alone.
+BUDGET_SHARE: dict[Priority, float] = {"protective": 1.0, "status": 0.8, "entry": 0.6}
+
+INTERVAL_SECONDS = {"SECOND": 1, "MINUTE": 60, "HOUR": 60 * 60, "DAY": 24 * 60 * 60}
+HEADER_INTERVALS = {"s": "SECOND", "m": "MINUTE", "h": "HOUR", "d": "DAY"}
+
+
+def header_interval_seconds(suffix: str) -> int:
+    """The "10s" / "1m" / "1d" at the end of X-MBX-ORDER-COUNT-* headers"""
+    return INTERVAL_SECONDS[HEADER_INTERVALS[suffix[-1]]] * int(suffix[:-1])
+
+
+class RateLimiter:
+    """
+    Tracks how much of the request-weight and order-count budgets we've used,
+    from the X-MBX-USED-WEIGHT-* / X-MBX-ORDER-COUNT-* headers of every
+    response plus a sliding window of the weight seen over the last minute.
+    """
+
+    def __init__(
+        self, logger: Logger, weight_limit: int = 1200, order_limit: int = 1200
+    ):
+        self.logger = logger
+        self.weight_limit = weight_limit  # per minute
+        self.order_limits: dict[int, int] = {60: order_limit}  # per window seconds
+        self.window: collections.deque[tuple[float, int]] = collections.deque()
+        self.used_weight = (0, 0.0)  # (value, when) from the last header
+        self.order_counts: dict[int, tuple[int, float]] = {}
+        self.backoff_until = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, rate_limits: list[dict]):
+        """Takes the limits from exchange_info()["rateLimits"]"""
+        for limit in rate_limits:
+            seconds = INTERVAL_SECONDS[limit["interval"]] * limit["intervalNum"]
+            if limit["rateLimitType"] == "REQUEST_WEIGHT" and seconds == 60:
+                self.weight_limit = limit["limit"]
+            elif limit["rateLimitType"] == "ORDERS":
+                self.order_limits[seconds] = limit["limit"]
+
+    def on_response(self, response: Response, *args, **kwargs):
+        """requests response hook, see Bot.__init__"""
+        now = time.time()
+        with self._lock:
+            for key, value in response.headers.items():
+                key = key.lower()
+                if key == "x-mbx-used-weight-1m":
+                    used = int(value)
+                    last_used, last_at = self.used_weight
+                    # Binance windows are calendar minutes, the count resets with them
+                    same_window = int(last_at // 60) == int(now // 60)
+                    self.window.append(
+                        (now, max(used - last_used, 1) if same_window else used)
+                    )
+                    self.used_weight = (used, now)
+                elif key.startswith("x-mbx-order-count-"):
+                    seconds = header_interval_seconds(key.rsplit("-", 1)[1])
+                    self.order_counts[seconds] = (int(value), now)
+
+            if response.status_code in (418, 429):
+                retry_after = int(response.headers.get("Retry-After", 60))
+                self.backoff_until = max(self.backoff_until, now + retry_after)
+                self.logger.error(
+                    f"Rate limited ({response.status_code}), backing off for {retry_after}s"
+                )
+
+    def remaining_weight(self) -> int:
+        now = time.time()
+        with self._lock:
+            while self.window and self.window[0][0] < now - 60:
+                self.window.popleft()
+            sliding = sum(weight for _, weight in self.window)
+            used, at = self.used_weight
+            if int(at // 60) != int(now // 60):
+                used = 0
+        return self.weight_limit - max(sliding, used)
+
+    def allow(self, priority: Priority, weight: int = 1, orders: int = 0) -> bool:
+        """Whether work of this priority (and estimated weight) should go ahead now"""
+        if priority == "protective":
+            return True
+        now = time.time()
+        if now < self.backoff_until:
+            return False
+
+        budget = self.weight_limit * BUDGET_SHARE[priority]
+        if self.weight_limit - self.remaining_weight() + weight > budget:
+            return False
+
+        for seconds, limit in self.order_limits.items():
+            count, at = self.order_counts.get(seconds, (0, 0.0))
+            if int(at // seconds) != int(now // seconds):
+                count = 0
+            if orders and count + orders > limit * BUDGET_SHARE[priority]:
+                return False
+        return True
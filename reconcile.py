@@ -0,0 +1,77 @@
+from logging import Logger
+from typing import Callable
+from models import Trade, OrderType
+
+# Orders in these states never change again, no point asking the exchange
+FINAL_STATUSES = {"FILLED", "CANCELED", "EXPIRED", "REJECTED", "EXPIRED_IN_MATCH"}
+
+
+class OrderReconciler:
+    """
+    Diffs the tracked orders against a single open-orders listing per step.
+    Orders still on the list are refreshed from it; only the ones that
+    dropped off it (filled, cancelled, expired...) need a query_order each.
+    """
+
+    def __init__(self, fetch_open_orders: Callable[[], list[dict]], logger: Logger):
+        self.fetch_open_orders = fetch_open_orders
+        self.logger = logger
+        self.open_orders: dict[tuple[str, int], dict] | None = None
+        self.reset()
+
+    def reset(self):
+        self.open_orders = None
+        self.listing_calls = 0
+        self.order_queries = 0
+        self.orders_checked = 0
+
+    def load_open_orders(self) -> dict[tuple[str, int], dict]:
+        if self.open_orders is None:
+            self.listing_calls += 1
+            self.open_orders = {
+                (order["symbol"], order["orderId"]): order
+                for order in self.fetch_open_orders()
+            }
+        return self.open_orders
+
+    def reconcile(
+        self, trades: list[Trade], order_type: OrderType
+    ) -> tuple[list[tuple[Trade, dict]], list[Trade]]:
+        """
+        Returns the trades whose order changed while still open (with the fresh
+        order), and the trades whose order has to be queried individually
+        """
+        pending = [
+            trade
+            for trade in trades
+            if getattr(trade, order_type).get("status") not in FINAL_STATUSES
+        ]
+        self.orders_checked += len(trades)
+
+        try:
+            open_orders = self.load_open_orders()
+        except Exception as e:
+            self.logger.error(f"Could not list open orders, querying each: {e}")
+            self.order_queries += len(pending)
+            return [], pending
+
+        changed = []
+        gone = []
+        for trade in pending:
+            order = getattr(trade, order_type)
+            live = open_orders.get((trade.symbol, order["orderId"]))
+            if live is None:
+                gone.append(trade)
+            elif live["status"] != order.get("status") or live.get(
+                "executedQty"
+            ) != order.get("executedQty"):
+                changed.append((trade, live))
+
+        self.order_queries += len(gone)
+        return changed, gone
+
+    def log_stats(self):
+        self.logger.debug(
+            f"Order status API calls => {self.listing_calls + self.order_queries} "
+            f"(one query per order would have been {self.orders_checked})"
+        )
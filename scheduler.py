@@ -0,0 +1,74 @@
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from logging import Logger
+from typing import Callable
+from bot import Bot
+
+
+@dataclass
+class Duty:
+    name: str
+    interval: float  # seconds
+    run: Callable[[], None]
+    next_run: float = 0.0
+
+
+class StepScheduler:
+    """
+    Runs each of the bot's duties on its own cadence instead of a full step
+    followed by a fixed sleep. Bot.pending_work is polled every
+    `watch_interval` seconds to pull a duty forward when there's a reason to.
+    Each duty runs as its own unit of work (see Bot.unit_of_work).
+    """
+
+    def __init__(self, bot: Bot, logger: Logger, watch_interval: float = 1):
+        self.bot = bot
+        self.logger = logger
+        self.watch_interval = watch_interval
+        self.duties: list[Duty] = []
+        self.wakeup = threading.Event()
+
+    def every(self, name: str, interval: float, run: Callable[[], None]):
+        """Duties run in the order they're added when several are due at once"""
+        self.duties.append(Duty(name, interval, run))
+
+    def trigger(self, *names: str):
+        for duty in self.duties:
+            if duty.name in names:
+                self.logger.debug(f"Triggered early => {duty.name}")
+                duty.next_run = 0
+        if names:
+            self.wakeup.set()
+
+    def run_pending(self):
+        now = time.time()
+        due = [duty for duty in self.duties if duty.next_run <= now]
+        if not due:
+            return
+
+        self.logger.debug(f"--- NEW STEP --- {[duty.name for duty in due]}")
+        try:
+            self.bot.begin_step()
+            for duty in due:
+                duty.next_run = now + duty.interval
+                with self.bot.unit_of_work():
+                    duty.run()
+            self.bot.end_step()
+        except Exception:
+            self.logger.error("!!! step failed :/ !!!")
+            self.logger.error(traceback.format_exc())
+
+    def run_forever(self):
+        while True:
+            try:
+                self.trigger(*self.bot.pending_work())
+            except Exception:
+                self.logger.error(traceback.format_exc())
+
+            self.run_pending()
+
+            next_run = min(duty.next_run for duty in self.duties)
+            self.wakeup.wait(max(min(next_run - time.time(), self.watch_interval), 0))
+            self.wakeup.clear()
@@ -0,0 +1,862 @@
+"""
+Localhost stand-in for the Spot and UM-Futures REST endpoints the bots use,
+with a small matching engine driven by a scripted price path, so the bots can
+be run without the testnet:
+
+    python simulator.py --port 8800 --prices prices.json --latency 0.05
+    FUTURES_API_URL=http://127.0.0.1:8800 python futures_bot.py
+
+Signatures aren't checked. See load_test.py for running a bot against it.
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import Logger
+from urllib.parse import parse_qsl, urlsplit
+from utils import setup_logger
+
+SPOT_COMMISSION = 0.001  # of the received asset
+FUTURES_COMMISSION = 0.0004  # of the notional, in USDT
+DEFAULT_LEVERAGE = 20
+
+# Request weights, roughly Binance's. Anything missing counts as 1.
+WEIGHTS = {
+    ("GET", "/api/v3/exchangeInfo"): 10,
+    ("GET", "/api/v3/openOrders"): 40,
+    ("GET", "/api/v3/account"): 10,
+    ("GET", "/api/v3/myTrades"): 10,
+    ("GET", "/api/v3/ticker/price"): 2,
+    ("GET", "/fapi/v1/exchangeInfo"): 1,
+    ("GET", "/fapi/v1/openOrders"): 40,
+    ("GET", "/fapi/v2/account"): 5,
+    ("GET", "/fapi/v2/positionRisk"): 5,
+    ("POST", "/fapi/v1/batchOrders"): 5,
+}
+
+
+class SimulatorError(Exception):
+    """Becomes a Binance style {"code", "msg"} error response"""
+
+    def __init__(self, code: int, msg: str, status: int = 400):
+        super().__init__(msg)
+        self.code = code
+        self.msg = msg
+        self.status = status
+
+
+def random_walk(
+    symbols: dict[str, float], steps: int, volatility: float = 0.002, seed: int = 0
+) -> dict[str, list[float]]:
+    """A price path per symbol, starting from the given prices"""
+    rng = random.Random(seed)
+    paths = {}
+    for symbol, price in symbols.items():
+        path = [price]
+        for _ in range(steps - 1):
+            path.append(path[-1] * math.exp(rng.gauss(0, volatility)))
+        paths[symbol] = path
+    return paths
+
+
+def decimal(value: float) -> str:
+    return f"{value:.8f}".rstrip("0").rstrip(".") or "0"
+
+
+def symbol_filters(price: float) -> tuple[float, float]:
+    """(tick size, step size) that give a few significant digits at this price"""
+    magnitude = math.floor(math.log10(price))
+    return 10.0 ** (magnitude - 4), min(1.0, 10.0 ** (-magnitude - 1))
+
+
+class Market:
+    """
+    Order book-less matching engine: resting orders fill against the scripted
+    price as soon as it crosses them. Spot keeps balances, futures one-way
+    positions. Everything happens under one lock.
+    """
+
+    def __init__(
+        self,
+        price_paths: dict[str, list[float]],
+        tick_seconds: float = 1.0,
+        quote_balance: float = 100_000.0,
+        weight_limit: int = 1200,
+    ):
+        self.price_paths = price_paths
+        self.weight_limit = weight_limit
+        self.tick_seconds = tick_seconds
+        self.started_at = time.time()
+        self.matched_tick = -1
+        # Pins the price path to one tick instead of following the clock
+        self.fixed_tick: int | None = None
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.order_list_ids = itertools.count(1)
+        self.orders: dict[int, dict] = {}
+        self.open_orders: dict[int, dict] = {}
+        self.fills: list[dict] = []
+        self.balances: dict[str, float] = {"USDT": quote_balance}
+        self.wallet = quote_balance
+        self.positions: dict[str, dict] = {}
+        self.symbol_config = {
+            symbol: {"marginType": "cross", "leverage": DEFAULT_LEVERAGE}
+            for symbol in price_paths
+        }
+        self.filters = {
+            symbol: symbol_filters(path[0]) for symbol, path in price_paths.items()
+        }
+
+    def now_ms(self) -> int:
+        return int(time.time() * 1000)
+
+    def tick(self) -> int:
+        if self.fixed_tick is not None:
+            return self.fixed_tick
+        return int((time.time() - self.started_at) / self.tick_seconds)
+
+    def price(self, symbol: str) -> float:
+        path = self.price_paths.get(symbol)
+        if path is None:
+            raise SimulatorError(-1121, "Invalid symbol.")
+        return path[min(self.tick(), len(path) - 1)]
+
+    def advance(self):
+        """Fills whatever the price crossed since the last request"""
+        with self.lock:
+            tick = self.tick()
+            if tick == self.matched_tick:
+                return
+            self.matched_tick = tick
+            for order in list(self.open_orders.values()):
+                self.try_fill(order)
+
+    def exchange_info(self, market: str) -> dict:
+        symbols = []
+        for symbol, (tick_size, step_size) in self.filters.items():
+            notional = (
+                {"filterType": "MIN_NOTIONAL", "notional": "5"}
+                if market == "futures"
+                else {"filterType": "NOTIONAL", "minNotional": "5"}
+            )
+            symbols.append(
+                {
+                    "symbol": symbol,
+                    "status": "TRADING",
+                    "baseAsset": symbol[: -len("USDT")],
+                    "quoteAsset": "USDT",
+                    "filters": [
+                        {
+                            "filterType": "PRICE_FILTER",
+                            "minPrice": decimal(tick_size),
+                            "maxPrice": "0",
+                            "tickSize": decimal(tick_size),
+                        },
+                        {
+                            "filterType": "LOT_SIZE",
+                            "minQty": decimal(step_size),
+                            "maxQty": "10000000",
+                            "stepSize": decimal(step_size),
+                        },
+                        notional,
+                    ],
+                }
+            )
+        return {
+            "timezone": "UTC",
+            "serverTime": self.now_ms(),
+            "rateLimits": [
+                {
+                    "rateLimitType": "REQUEST_WEIGHT",
+                    "interval": "MINUTE",
+                    "intervalNum": 1,
+                    "limit": self.weight_limit,
+                },
+                {
+                    "rateLimitType": "ORDERS",
+                    "interval": "SECOND",
+                    "intervalNum": 10,
+                    "limit": 300,
+                },
+            ],
+            "symbols": symbols,
+        }
+
+    def new_order(self, market: str, params: dict) -> dict:
+        symbol = params.get("symbol", "")
+        price = self.price(symbol)
+        side = params.get("side")
+        order_type = params.get("type")
+        quantity = float(params.get("quantity") or 0)
+        if side not in ("BUY", "SELL") or quantity <= 0:
+            raise SimulatorError(
+                -1102, "Mandatory parameter was not sent or malformed."
+            )
+        if order_type == "LIMIT" and not params.get("price"):
+            raise SimulatorError(-1102, "Mandatory parameter 'price' was not sent.")
+        if order_type in ("STOP_MARKET", "TAKE_PROFIT_MARKET") and not params.get(
+            "stopPrice"
+        ):
+            raise SimulatorError(-1102, "Mandatory parameter 'stopPrice' was not sent.")
+
+        if market == "spot":
+            base = symbol[: -len("USDT")]
+            cost = quantity * float(params.get("price") or price)
+            if side == "BUY" and self.balances["USDT"] < cost:
+                raise SimulatorError(
+                    -2010, "Account has insufficient balance for requested action."
+                )
+            if side == "SELL" and self.balances.get(base, 0) < quantity - 1e-12:
+                raise SimulatorError(
+                    -2010, "Account has insufficient balance for requested action."
+                )
+
+        now = self.now_ms()
+        order = {
+            "market": market,
+            "symbol": symbol,
+            "orderId": next(self.ids),
+            "clientOrderId": params.get("newClientOrderId", f"sim{now}"),
+            "side": side,
+            "type": order_type,
+            "timeInForce": params.get("timeInForce", "GTC"),
+            "price": float(params.get("price") or 0),
+            "stopPrice": float(params.get("stopPrice") or 0),
+            "origQty": quantity,
+            "executedQty": 0.0,
+            "quote": 0.0,
+            "status": "NEW",
+            "reduceOnly": params.get("reduceOnly") == "true",
+            "workingType": params.get("workingType", "CONTRACT_PRICE"),
+            "orderListId": -1,
+            "time": now,
+            "updateTime": now,
+            "fills": [],
+        }
+        with self.lock:
+            self.orders[order["orderId"]] = order
+            self.open_orders[order["orderId"]] = order
+            self.try_fill(order)
+        return order
+
+    def new_order_list(self, params: dict) -> list[dict]:
+        """A spot sell OCO: a LIMIT_MAKER above the price, a STOP_LOSS_LIMIT below it"""
+        price = self.price(params.get("symbol", ""))
+        if params.get("side") != "SELL" or not (
+            float(params.get("price") or 0)
+            > price
+            > float(params.get("stopPrice") or math.inf)
+        ):
+            raise SimulatorError(
+                -2010, "The relationship of the prices for the orders is not correct."
+            )
+        with self.lock:
+            order_list_id = next(self.order_list_ids)
+            take_profit = self.new_order(
+                "spot", dict(params, type="LIMIT_MAKER", stopPrice="0")
+            )
+            stop_loss = self.new_order(
+                "spot",
+                dict(
+                    params,
+                    type="STOP_LOSS_LIMIT",
+                    price=params.get("stopLimitPrice"),
+                    timeInForce=params.get("stopLimitTimeInForce", "GTC"),
+                ),
+            )
+            for order in (take_profit, stop_loss):
+                order["orderListId"] = order_list_id
+            return [take_profit, stop_loss]
+
+    def order_list(self, params: dict) -> list[dict]:
+        order_list_id = int(params.get("orderListId", 0))
+        orders = [
+            order
+            for order in self.orders.values()
+            if order["orderListId"] == order_list_id and order_list_id != -1
+        ]
+        if not orders:
+            raise SimulatorError(-2011, "Order list does not exist.")
+        return orders
+
+    def cancel_order_list(self, params: dict) -> list[dict]:
+        with self.lock:
+            orders = self.order_list(params)
+            if not any(order["orderId"] in self.open_orders for order in orders):
+                raise SimulatorError(-2011, "Unknown order list sent.")
+            for order in orders:
+                self.close(order, "CANCELED")
+            return orders
+
+    def triggered(self, order: dict, price: float) -> float | None:
+        """The fill price if the order should fill at this market price"""
+        buy = order["side"] == "BUY"
+        if order["type"] == "MARKET":
+            return price
+        if order["type"] == "STOP_LOSS_LIMIT":
+            if not order.get("stopped"):
+                if (buy and price < order["stopPrice"]) or (
+                    not buy and price > order["stopPrice"]
+                ):
+                    return None
+                order["stopped"] = True
+            # A limit order from here on, one the price gapped past keeps waiting
+            if (buy and price <= order["price"]) or (
+                not buy and price >= order["price"]
+            ):
+                return price
+            return None
+        if order["type"] in ("LIMIT", "LIMIT_MAKER"):
+            if (buy and price <= order["price"]) or (
+                not buy and price >= order["price"]
+            ):
+                return order["price"]
+            return None
+        if order["type"] == "STOP_MARKET":
+            stop = order["stopPrice"]
+            return (
+                price
+                if (buy and price >= stop) or (not buy and price <= stop)
+                else None
+            )
+        if order["type"] == "TAKE_PROFIT_MARKET":
+            stop = order["stopPrice"]
+            return (
+                price
+                if (buy and price <= stop) or (not buy and price >= stop)
+                else None
+            )
+        return None
+
+    def try_fill(self, order: dict):
+        fill_price = self.triggered(order, self.price(order["symbol"]))
+        if fill_price is None:
+            return
+        if order["market"] == "futures" and order["reduceOnly"]:
+            position = self.positions.get(order["symbol"], {"amount": 0.0})["amount"]
+            closes = -1 if order["side"] == "BUY" else 1
+            if position * closes <= 0:
+                self.close(order, "EXPIRED")
+                return
+        self.fill(order, fill_price)
+
+    def fill(self, order: dict, price: float):
+        quantity = order["origQty"] - order["executedQty"]
+        symbol = order["symbol"]
+        fill = {
+            "symbol": symbol,
+            "id": len(self.fills) + 1,
+            "orderId": order["orderId"],
+            "price": price,
+            "qty": quantity,
+            "quoteQty": price * quantity,
+            "isBuyer": order["side"] == "BUY",
+            "time": self.now_ms(),
+        }
+        if order["market"] == "spot":
+            base = symbol[: -len("USDT")]
+            if order["side"] == "BUY":
+                fill["commission"], fill["commissionAsset"] = (
+                    quantity * SPOT_COMMISSION,
+                    base,
+                )
+                self.balances["USDT"] -= price * quantity
+                self.balances[base] = self.balances.get(base, 0) + quantity * (
+                    1 - SPOT_COMMISSION
+                )
+            else:
+                fee = price * quantity * SPOT_COMMISSION
+                fill["commission"], fill["commissionAsset"] = fee, "USDT"
+                self.balances[base] = self.balances.get(base, 0) - quantity
+                self.balances["USDT"] += price * quantity - fee
+        else:
+            fill["commission"] = price * quantity * FUTURES_COMMISSION
+            fill["commissionAsset"] = "USDT"
+            self.wallet -= fill["commission"]
+            self.move_position(
+                symbol, quantity if order["side"] == "BUY" else -quantity, price
+            )
+
+        self.fills.append(fill)
+        order["fills"].append(fill)
+        order["executedQty"] += quantity
+        order["quote"] += price * quantity
+        self.close(order, "FILLED")
+
+        if order["orderListId"] != -1:
+            # One cancels the other
+            for other in list(self.open_orders.values()):
+                if other["orderListId"] == order["orderListId"]:
+                    self.close(other, "EXPIRED")
+
+        if order["market"] == "futures" and not self.positions[symbol]["amount"]:
+            # GTE_GTC orders go away with the position
+            for other in list(self.open_orders.values()):
+                if (
+                    other["market"] == "futures"
+                    and other["symbol"] == symbol
+                    and other["timeInForce"] == "GTE_GTC"
+                ):
+                    self.close(other, "EXPIRED")
+
+    def move_position(self, symbol: str, amount: float, price: float):
+        position = self.positions.setdefault(symbol, {"amount": 0.0, "entry": 0.0})
+        current = position["amount"]
+        if current and (current > 0) != (amount > 0):
+            closed = min(abs(amount), abs(current))
+            self.wallet += (
+                closed * (price - position["entry"]) * (1 if current > 0 else -1)
+            )
+        new = current + amount
+        if abs(new) < 1e-12:
+            position.update(amount=0.0, entry=0.0)
+        elif not current or (current > 0) == (amount > 0):
+            position["entry"] = (
+                abs(current) * position["entry"] + abs(amount) * price
+            ) / abs(new)
+            position["amount"] = new
+        else:
+            position["amount"] = new
+            if (new > 0) != (current > 0):
+                position["entry"] = price
+
+    def close(self, order: dict, status: str):
+        order["status"] = status
+        order["updateTime"] = self.now_ms()
+        self.open_orders.pop(order["orderId"], None)
+
+    def get_order(self, market: str, params: dict) -> dict:
+        order = self.orders.get(int(params.get("orderId", 0)))
+        if order is None and params.get("origClientOrderId"):
+            order = next(
+                (
+                    o
+                    for o in reversed(self.orders.values())
+                    if o["clientOrderId"] == params["origClientOrderId"]
+                    and o["market"] == market
+                ),
+                None,
+            )
+        if (
+            order is None
+            or order["market"] != market
+            or (order["symbol"] != params.get("symbol"))
+        ):
+            raise SimulatorError(-2013, "Order does not exist.")
+        return order
+
+    def cancel_order(self, market: str, params: dict) -> dict:
+        with self.lock:
+            order = self.get_order(market, params)
+            if order["orderId"] not in self.open_orders:
+                raise SimulatorError(-2011, "Unknown order sent.")
+            self.close(order, "CANCELED")
+            return order
+
+    def list_open_orders(self, market: str, symbol: str | None) -> list[dict]:
+        return [
+            order
+            for order in self.open_orders.values()
+            if order["market"] == market and symbol in (None, order["symbol"])
+        ]
+
+    def futures_available_balance(self) -> float:
+        margin = sum(
+            abs(position["amount"])
+            * position["entry"]
+            / self.symbol_config[symbol]["leverage"]
+            for symbol, position in self.positions.items()
+        )
+        return self.wallet - margin
+
+
+def spot_order(order: dict, full: bool = False) -> dict:
+    response = {
+        "symbol": order["symbol"],
+        "orderId": order["orderId"],
+        "orderListId": order["orderListId"],
+        "clientOrderId": order["clientOrderId"],
+        "price": decimal(order["price"]),
+        "origQty": decimal(order["origQty"]),
+        "executedQty": decimal(order["executedQty"]),
+        "cummulativeQuoteQty": decimal(order["quote"]),
+        "status": order["status"],
+        "timeInForce": order["timeInForce"],
+        "type": order["type"],
+        "side": order["side"],
+        "stopPrice": decimal(order["stopPrice"]),
+    }
+    if full:
+        response["transactTime"] = order["updateTime"]
+        response["fills"] = [
+            {
+                "price": decimal(fill["price"]),
+                "qty": decimal(fill["qty"]),
+                "commission": decimal(fill["commission"]),
+                "commissionAsset": fill["commissionAsset"],
+                "tradeId": fill["id"],
+            }
+            for fill in order["fills"]
+        ]
+    else:
+        response["time"] = order["time"]
+        response["updateTime"] = order["updateTime"]
+        response["isWorking"] = order["status"] == "NEW"
+    return response
+
+
+def spot_order_list(orders: list[dict]) -> dict:
+    done = all(order["status"] != "NEW" for order in orders)
+    return {
+        "orderListId": orders[0]["orderListId"],
+        "contingencyType": "OCO",
+        "listStatusType": "ALL_DONE" if done else "EXEC_STARTED",
+        "listOrderStatus": "ALL_DONE" if done else "EXECUTING",
+        "listClientOrderId": f"simlist{orders[0]['orderListId']}",
+        "transactionTime": max(order["updateTime"] for order in orders),
+        "symbol": orders[0]["symbol"],
+        "orders": [
+            {
+                "symbol": order["symbol"],
+                "orderId": order["orderId"],
+                "clientOrderId": order["clientOrderId"],
+            }
+            for order in orders
+        ],
+        "orderReports": [
+            {
+                key: value
+                for key, value in spot_order(order, full=True).items()
+                if key != "fills"
+            }
+            for order in orders
+        ],
+    }
+
+
+def futures_order(order: dict, with_time: bool = True) -> dict:
+    executed = order["executedQty"]
+    response = {
+        "orderId": order["orderId"],
+        "symbol": order["symbol"],
+        "status": order["status"],
+        "clientOrderId": order["clientOrderId"],
+        "price": decimal(order["price"]),
+        "avgPrice": decimal(order["quote"] / executed if executed else 0),
+        "origQty": decimal(order["origQty"]),
+        "executedQty": decimal(executed),
+        "cumQuote": decimal(order["quote"]),
+        "timeInForce": order["timeInForce"],
+        "type": order["type"],
+        "reduceOnly": order["reduceOnly"],
+        "closePosition": False,
+        "side": order["side"],
+        "positionSide": "BOTH",
+        "stopPrice": decimal(order["stopPrice"]),
+        "workingType": order["workingType"],
+        "origType": order["type"],
+        "updateTime": order["updateTime"],
+    }
+    if with_time:
+        response["time"] = order["time"]
+    return response
+
+
+class Simulator:
+    """
+    Serves a Market over HTTP. `latency` (seconds, +-50% jitter) is added to
+    every request, and `error_rate`/`rate_limit_rate` of them fail with a 503
+    or a 429 respectively.
+    """
+
+    def __init__(
+        self,
+        market: Market,
+        logger: Logger,
+        port: int = 0,
+        host: str = "127.0.0.1",
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.market = market
+        self.logger = logger
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.requests: dict[tuple[str, str], int] = {}
+        self.weight_window = (0, 0)  # (minute, weight used)
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                simulator.handle(self, "GET")
+
+            def do_POST(self):
+                simulator.handle(self, "POST")
+
+            def do_PUT(self):
+                simulator.handle(self, "PUT")
+
+            def do_DELETE(self):
+                simulator.handle(self, "DELETE")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="simulator", daemon=True
+        )
+        self._thread.start()
+        self.logger.info(f"Exchange simulator listening => {self.url}")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def use_weight(self, method: str, path: str) -> int:
+        weight = WEIGHTS.get((method, path), 1)
+        minute = int(time.time() // 60)
+        with self.market.lock:
+            last_minute, used = self.weight_window
+            used = (used if last_minute == minute else 0) + weight
+            self.weight_window = (minute, used)
+            self.requests[(method, path)] = self.requests.get((method, path), 0) + 1
+        return used
+
+    def handle(self, request: BaseHTTPRequestHandler, method: str):
+        url = urlsplit(request.path)
+        params = dict(parse_qsl(url.query))
+        length = int(request.headers.get("Content-Length") or 0)
+        if length:
+            params.update(parse_qsl(request.rfile.read(length).decode()))
+
+        if self.latency:
+            time.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        used = self.use_weight(method, url.path)
+        headers = {"X-MBX-USED-WEIGHT-1M": str(used)}
+
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            status, body = 429, {"code": -1003, "msg": "Too many requests."}
+            headers["Retry-After"] = "1"
+        elif roll < self.rate_limit_rate + self.error_rate:
+            status, body = 503, {"code": -1001, "msg": "Internal error."}
+        else:
+            try:
+                self.market.advance()
+                status, body = 200, self.route(method, url.path, params)
+            except SimulatorError as e:
+                status, body = e.status, {"code": e.code, "msg": e.msg}
+            except Exception as e:
+                self.logger.exception(f"Simulator failed on {method} {url.path}")
+                status, body = 500, {"code": -1000, "msg": str(e)}
+
+        payload = json.dumps(body).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(payload)))
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def route(self, method: str, path: str, params: dict):
+        market = self.market
+        symbol = params.get("symbol")
+        with market.lock:
+            match (method, path):
+                # Spot
+                case ("GET", "/api/v3/exchangeInfo"):
+                    return market.exchange_info("spot")
+                case ("GET", "/api/v3/ticker/price"):
+                    if symbol:
+                        return {
+                            "symbol": symbol,
+                            "price": decimal(market.price(symbol)),
+                        }
+                    return [
+                        {"symbol": s, "price": decimal(market.price(s))}
+                        for s in market.price_paths
+                    ]
+                case ("GET", "/api/v3/avgPrice"):
+                    return {"mins": 5, "price": decimal(market.price(symbol or ""))}
+                case ("POST", "/api/v3/order"):
+                    return spot_order(market.new_order("spot", params), full=True)
+                case ("GET", "/api/v3/order"):
+                    return spot_order(market.get_order("spot", params))
+                case ("DELETE", "/api/v3/order"):
+                    return spot_order(market.cancel_order("spot", params))
+                case ("POST", "/api/v3/order/oco"):
+                    return spot_order_list(market.new_order_list(params))
+                case ("GET", "/api/v3/orderList"):
+                    return spot_order_list(market.order_list(params))
+                case ("DELETE", "/api/v3/orderList"):
+                    return spot_order_list(market.cancel_order_list(params))
+                case ("GET", "/api/v3/openOrders"):
+                    return [
+                        spot_order(order)
+                        for order in market.list_open_orders("spot", symbol)
+                    ]
+                case ("GET", "/api/v3/account"):
+                    return {
+                        "balances": [
+                            {"asset": asset, "free": decimal(free), "locked": "0"}
+                            for asset, free in market.balances.items()
+                        ]
+                    }
+                case ("GET", "/api/v3/myTrades"):
+                    order_id = int(params.get("orderId", 0))
+                    return [
+                        dict(
+                            fill,
+                            price=decimal(fill["price"]),
+                            qty=decimal(fill["qty"]),
+                            quoteQty=decimal(fill["quoteQty"]),
+                            commission=decimal(fill["commission"]),
+                        )
+                        for fill in market.fills
+                        if fill["symbol"] == symbol and order_id in (0, fill["orderId"])
+                    ]
+                case ("POST", "/api/v3/userDataStream") | (
+                    "POST",
+                    "/fapi/v1/listenKey",
+                ):
+                    return {"listenKey": "simulator"}
+                case ("PUT", "/api/v3/userDataStream") | ("PUT", "/fapi/v1/listenKey"):
+                    return {}
+
+                # UM-Futures
+                case ("GET", "/fapi/v1/exchangeInfo"):
+                    return market.exchange_info("futures")
+                case ("GET", "/fapi/v1/premiumIndex"):
+                    marks = [
+                        {
+                            "symbol": s,
+                            "markPrice": decimal(market.price(s)),
+                            "indexPrice": decimal(market.price(s)),
+                            "time": market.now_ms(),
+                        }
+                        for s in ([symbol] if symbol else market.price_paths)
+                    ]
+                    return marks[0] if symbol else marks
+                case ("POST", "/fapi/v1/order"):
+                    order = market.new_order("futures", params)
+                    return futures_order(order, with_time=False)
+                case ("POST", "/fapi/v1/batchOrders"):
+                    responses = []
+                    for order_params in json.loads(params.get("batchOrders", "[]")):
+                        try:
+                            order = market.new_order("futures", order_params)
+                            responses.append(futures_order(order, with_time=False))
+                        except SimulatorError as e:
+                            responses.append({"code": e.code, "msg": e.msg})
+                    return responses
+                case ("GET", "/fapi/v1/order"):
+                    return futures_order(market.get_order("futures", params))
+                case ("DELETE", "/fapi/v1/order"):
+                    return futures_order(market.cancel_order("futures", params))
+                case ("GET", "/fapi/v1/openOrders"):
+                    return [
+                        futures_order(order)
+                        for order in market.list_open_orders("futures", symbol)
+                    ]
+                case ("GET", "/fapi/v2/account"):
+                    available = market.futures_available_balance()
+                    return {
+                        "assets": [
+                            {
+                                "asset": "USDT",
+                                "walletBalance": decimal(market.wallet),
+                                "availableBalance": decimal(available),
+                            }
+                        ],
+                        "positions": [],
+                    }
+                case ("GET", "/fapi/v2/positionRisk"):
+                    return [
+                        {
+                            "symbol": s,
+                            "positionAmt": decimal(
+                                market.positions.get(s, {"amount": 0.0})["amount"]
+                            ),
+                            "markPrice": decimal(market.price(s)),
+                            "marginType": config["marginType"],
+                            "leverage": str(config["leverage"]),
+                            "positionSide": "BOTH",
+                        }
+                        for s, config in market.symbol_config.items()
+                        if symbol in (None, s)
+                    ]
+                case ("POST", "/fapi/v1/marginType"):
+                    market.symbol_config[symbol]["marginType"] = params[
+                        "marginType"
+                    ].lower()
+                    return {"code": 200, "msg": "success"}
+                case ("POST", "/fapi/v1/leverage"):
+                    leverage = int(params["leverage"])
+                    market.symbol_config[symbol]["leverage"] = leverage
+                    return {"symbol": symbol, "leverage": leverage}
+                case ("GET", "/fapi/v1/positionSide/dual"):
+                    return {"dualSidePosition": False}
+                case ("GET", "/fapi/v1/multiAssetsMargin"):
+                    return {"multiAssetsMargin": False}
+                case ("POST", "/fapi/v1/positionSide/dual") | (
+                    "POST",
+                    "/fapi/v1/multiAssetsMargin",
+                ):
+                    return {"code": 200, "msg": "success"}
+        raise SimulatorError(-1000, f"Not simulated => {method} {path}", status=404)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument(
+        "--prices", help="JSON file of {symbol: [price, ...]}, one price per tick"
+    )
+    parser.add_argument("--symbols", type=int, default=20, help="without --prices")
+    parser.add_argument("--tick-seconds", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--weight-limit", type=int, default=1200)
+    args = parser.parse_args()
+
+    if args.prices:
+        with open(args.prices) as f:
+            paths = json.load(f)
+    else:
+        paths = random_walk(
+            {f"SIM{i}USDT": 10.0 ** (i % 5) for i in range(args.symbols)}, 24 * 60 * 60
+        )
+    simulator = Simulator(
+        Market(paths, args.tick_seconds, weight_limit=args.weight_limit),
+        setup_logger("simulator"),
+        port=args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+    )
+    simulator.start()
+    simulator._thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Runs the Bot step lifecycle against a simulated exchange that fills every
+order on the following step, and reports memory as it goes. Used to check
+that a long-running bot stays flat: python soak.py --steps 100000
+"""
+import argparse
+import datetime
+import itertools
+import logging
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+import requests
+from bot import Bot
+from db import make_engine, make_session
+from migrate import migrate
+from models import Trade
+
+
+class SoakClient:
+    """Just enough of a connector for Bot.__init__"""
+
+    def __init__(self, api_key, api_secret, base_url=None):
+        self.session = requests.Session()
+
+    def exchange_info(self):
+        return {
+            "symbols": [{"symbol": "BTCUSDT", "status": "TRADING", "filters": []}],
+            "rateLimits": [],
+        }
+
+
+class SoakBot(Bot):
+    market = "soak"
+
+    def __init__(self, session, logger):
+        super().__init__(SoakClient, "", "", "", session, logger)
+        self.order_ids = itertools.count(1)
+        self.open_orders: dict[tuple[str, int], dict] = {}
+
+    def new_order(self, trade: Trade) -> dict:
+        order = {
+            "symbol": trade.symbol,
+            "orderId": next(self.order_ids),
+            "status": "NEW",
+            "executedQty": "0",
+            "time": int(time.time() * 1000),
+        }
+        self.open_orders[(order["symbol"], order["orderId"])] = order
+        return order
+
+    def build_order_templates(self, trade, info):
+        params = {"symbol": trade.symbol}
+        return {"open_order": params, "stop_loss_order": params, "targets": []}
+
+    def place_open_order(self, trade):
+        return self.new_order(trade)
+
+    def fetch_prices(self):
+        return {}
+
+    def fetch_open_orders(self):
+        # Everything placed last step has filled since
+        open_orders, self.open_orders = list(self.open_orders.values()), {}
+        return open_orders
+
+    def get_order(self, symbol, orderId):
+        return {"symbol": symbol, "orderId": orderId, "status": "FILLED"}
+
+    def step(self):
+        self.begin_step()
+        with self.unit_of_work():
+            filled = self.filter_trades_with_filled_order(
+                self.update_order_statuses(
+                    self.get_trades_with_pending_opening_order(), "open_order"
+                ),
+                "open_order",
+            )
+            for trade in filled:
+                trade.take_profit_order = self.new_order(trade)
+            self.commit(durable=True)
+
+            protected = self.update_order_statuses(
+                self.get_trades_with_pending_take_profit_order(), "take_profit_order"
+            )
+            self.close_finished_trades(protected)
+        with self.unit_of_work():
+            self.stage_trades()
+            self.send_open_orders(self.get_unexecuted_trades())
+        self.end_step()
+
+
+def ingest(session, n: int):
+    session.add(
+        Trade(
+            symbol="BTCUSDT",
+            side="BUY",
+            entry=[100.0, 101.0],
+            stop_loss=92.0,
+            targets=[101.5, 102.3, 103.1, 104.5, 105.3, 106.2],
+            timestamp=datetime.datetime.now(),
+            texthash=str(n),
+        )
+    )
+    session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=100_000)
+    parser.add_argument("--report-every", type=int, default=10_000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "soak.db")
+    engine = make_engine(f"sqlite:///{path}")
+    logger = logging.getLogger("soak")
+    migrate(engine, logger)
+    ingester = make_session(engine)
+    bot = SoakBot(make_session(engine), logger)
+
+    tracemalloc.start()
+    baseline = traced = None
+    print("step,identity_map,traced_kib,max_rss_kib,trades_in_db,closed_trades")
+    for n in range(1, args.steps + 1):
+        ingest(ingester, n)
+        bot.step()
+        if n % args.report_every == 0:
+            traced = tracemalloc.get_traced_memory()[0] // 1024
+            baseline = baseline or traced
+            print(
+                f"{n},{len(bot.session.identity_map)},{traced},"
+                f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},"
+                f"{bot.session.query(Trade).count()},"
+                f"{bot.session.query(Trade).filter(Trade.state == 'CLOSED').count()}",
+                flush=True,
+            )
+            bot.session.close()
+    if baseline is not None:
+        print(f"traced memory grew {traced - baseline} KiB since the first report")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
 import os
-import time
 from binance.spot import Spot
+from binance.error import ClientError
 from dotenv import load_dotenv
-from models import Trade
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from models import Trade, OrderType
+from db import make_engine, make_session
 import traceback
 from utils import *
 import itertools
 from bot import Bot
+from fills import fills_from_response, fill_from_my_trade
+from migrate import migrate
+from scheduler import StepScheduler
+from notify import CALL_SOCKETS, CallListener
 
 # SETUP ENV
 dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
@@ -16,147 +19,396 @@ load_dotenv(dotenv_path)
 BINANCE_API_KEY = os.getenv("API_KEY")
 BINANCE_API_SECRET = os.getenv("API_SECRET")
 BINANCE_API_URL = os.getenv("API_URL")
+BINANCE_STREAM_URL = os.getenv("STREAM_URL")
+BINANCE_USER_STREAM_URL = os.getenv("USER_STREAM_URL")
+# Seconds between memory reports, unset to turn tracemalloc off
+MEMORY_LOG_INTERVAL = os.getenv("MEMORY_LOG_INTERVAL")
 
 # SETUP DB
-engine = create_engine("sqlite:///tradingbot.db")
-SESSION = sessionmaker(bind=engine)()
+engine = make_engine()
+SESSION = make_session(engine)
 
 # CONSTANTS
 ORDER_SIZE = 100  # USD per trade
 ORDER_EXPIRY_TIME_HOURS = 24 * 14  # 14 days
 DELAY_BETWEEN_STEPS = 10  # seconds
+EXPIRY_CHECK_INTERVAL = 5 * 60  # seconds
+BALANCE_REFRESH_INTERVAL = 60  # seconds
 TARGET_NUM = 3
+# "OCO": take profit and a stop limit as one order list on the exchange
+# "POLLED": take profit only, stopped out by us, see filter_need_to_stop_loss
+PROTECTION = "OCO"
+STOP_LIMIT_SLIPPAGE = 0.01  # how far below the stop the stop limit will sell
+EXCHANGE_INFO_PATH = "spot_exchange_info.json"
+EXCHANGE_INFO_TTL = 60 * 60  # seconds
+MAX_WORKERS = 8  # concurrent exchange requests within a step
 
 LOGGER = setup_logger("spotoor")
 
 
+# Binance's error code for orders the matching engine refused
+NEW_ORDER_REJECTED = -2010
+
+
+def is_price_relationship_error(error: ClientError) -> bool:
+    """An order list rejected because the price isn't between its legs anymore"""
+    return error.error_code == NEW_ORDER_REJECTED and "relationship" in str(
+        error.error_message
+    )
+
+
+def is_order_list(order: dict | None) -> bool:
+    # Orders outside of a list come back with orderListId -1
+    return order is not None and order.get("orderListId", -1) != -1
+
+
+def order_list_legs(order_list: dict) -> dict[OrderType, dict]:
+    """The legs of an OCO order list response, by the Trade column they go in"""
+    return {
+        (
+            "stop_loss_order"
+            if report["type"] in ("STOP_LOSS", "STOP_LOSS_LIMIT")
+            else "take_profit_order"
+        ): report
+        for report in order_list["orderReports"]
+    }
+
+
 class SpotBot(Bot):
     client: Spot
+    price_stream = "!miniTicker@arr"
+    price_stream_key = "c"
+    market = "spot"
+    # A crossed target has probably filled the take profit, worth a look early
+    trigger_duties = {"entry": "intake", "stop": "fills", "target": "fills"}
+
+    def __init__(
+        self, api_key, api_secret, api_url, session, logger, protection=PROTECTION
+    ):
+        super().__init__(
+            Spot,
+            api_key,
+            api_secret,
+            api_url,
+            session,
+            logger,
+            exchange_info_path=EXCHANGE_INFO_PATH,
+            exchange_info_ttl=EXCHANGE_INFO_TTL,
+            max_workers=MAX_WORKERS,
+        )
+        self.protection = protection
 
-    def __init__(self, api_key, api_secret, api_url, session, logger):
-        super().__init__(Spot, api_key, api_secret, api_url, session, logger)
+    def get_order_by_client_id(self, symbol, client_order_id):
+        return self.client.get_order(symbol, origClientOrderId=client_order_id)
 
-    def get_price(self, symbol):
-        return float(self.client.avg_price(symbol)["price"])
+    def fetch_price(self, symbol):
+        return float(self.client.ticker_price(symbol)["price"])
+
+    def fetch_prices(self):
+        return {p["symbol"]: float(p["price"]) for p in self.client.ticker_price()}
 
     def get_order(self, symbol, orderId):
         return self.client.get_order(symbol, orderId=orderId)
 
-    def send_open_order(self, trade: Trade):
-        if trade.open_order is not None or trade.side != "BUY":
+    def fetch_open_orders(self):
+        return self.client.get_open_orders()
+
+    def build_order_templates(self, trade: Trade, info) -> dict:
+        if trade.side != "BUY":
             # We dont support SHORT orders yet.
-            return trade
+            raise ValueError("short calls aren't supported on spot")
+        if len(trade.targets) <= TARGET_NUM:
+            raise ValueError(f"no target {TARGET_NUM + 1} to take profit at")
+        price = max(trade.entry)
+        open_order = {
+            "symbol": trade.symbol,
+            "side": trade.side,
+            "type": "LIMIT",
+            "quantity": decimal_string(format_quantity(ORDER_SIZE / price, info)),
+            "price": decimal_string(format_price(price, info)),
+            "newOrderRespType": "FULL",
+            "timeInForce": "GTC",
+        }
+        exit_order = {
+            "symbol": trade.symbol,
+            "side": "SELL",
+            "newOrderRespType": "FULL",
+        }
+        # Market sell for stopping out ourselves, see filter_need_to_stop_loss
+        stop_loss_order = dict(exit_order, type="MARKET")
+        targets = [
+            dict(
+                exit_order,
+                type="LIMIT",
+                timeInForce="GTC",
+                price=decimal_string(format_price(target, info)),
+            )
+            for target in trade.targets
+        ]
+        # The take profit and the stop as one order list, see place_exit_orders
+        oco_order = dict(
+            exit_order,
+            price=targets[TARGET_NUM]["price"],
+            stopPrice=decimal_string(format_price(trade.stop_loss, info)),
+            stopLimitPrice=decimal_string(
+                format_price(trade.stop_loss * (1 - STOP_LIMIT_SLIPPAGE), info)
+            ),
+            stopLimitTimeInForce="GTC",
+        )
+        check_order_filters({"price": oco_order["stopLimitPrice"]}, info)
+        return {
+            "open_order": open_order,
+            "stop_loss_order": stop_loss_order,
+            "targets": targets,
+            "oco_order": oco_order,
+        }
 
-        try:
-            info = self.client.exchange_info(trade.symbol)["symbols"][0]
-            # TODO sanity check on the asset pair
-            quantity = format_quantity(ORDER_SIZE / max(iter(trade.entry)), info)
-
-            params = {
-                "symbol": trade.symbol,
-                "side": trade.side,
-                "type": "LIMIT",
-                "quantity": quantity,
-                "price": format_price(max(iter(trade.entry)), info),
-                # TODO this might help avoid calling get_order again. need to confirm
-                "newOrderRespType": "FULL",
-                "timeInForce": "GTC",
-            }
-
-            response = self.client.new_order(**params)
-            confirmed_order = self.get_order(trade.symbol, orderId=response["orderId"])
-            trade.open_order = confirmed_order
+    def place_open_order(self, trade: Trade):
+        if trade.open_order is not None:
+            return None
 
-            self.session.add(trade)
-            self.session.commit()
-            self.logger.info(f"New opening order => {trade.id} : {trade.open_order}")
+        try:
+            # FULL already has the status, quantities and fills
+            return self.client.new_order(
+                **self.get_order_templates(trade)["open_order"],
+                newClientOrderId=trade.open_client_order_id,
+            )
         except Exception as e:
             self.logger.error(
                 f"Could not create new opening order => {trade.id}/{trade.symbol} : {e}"
             )
-
-        return trade
+            return None
+
+    def stop_level(self, trade: Trade) -> float:
+        """
+        The price below which we sell at market ourselves. An order list's stop
+        is the exchange's job, unless the price gapped past its stop limit.
+        """
+        if is_order_list(trade.stop_loss_order):
+            return float(trade.stop_loss_order["price"])
+        return trade.stop_loss
+
+    def watch_stop_losses(self, trades: list[Trade]):
+        """Remembers the stops and targets of the open positions, see pending_work"""
+        self.triggers.watch_levels(
+            "stop",
+            {
+                trade.id: (trade.symbol, self.stop_level(trade), True)
+                for trade in trades
+            },
+        )
+        self.triggers.watch_levels(
+            "target",
+            {
+                trade.id: (trade.symbol, trade.targets[TARGET_NUM], False)
+                for trade in trades
+                if len(trade.targets) > TARGET_NUM
+            },
+        )
+        self.move_triggers()
 
     def filter_need_to_stop_loss(self, trades):
+        """The trades (given to watch_stop_losses first) whose stop the price is below"""
+        for trade in trades:
+            self.triggers.move(trade.symbol, self.get_price(trade.symbol))
         return [
-            trade for trade in trades if self.get_price(trade.symbol) < trade.stop_loss
+            trade for trade in trades if self.triggers.is_triggered("stop", trade.id)
         ]
 
-    def send_take_profit_order(self, trade: Trade):
-        params = {
-            "symbol": trade.symbol,
-            "side": "SELL" if trade.side == "BUY" else "BUY",
-            "newOrderRespType": "FULL",
-        }
-        try:
-            info = self.client.exchange_info(trade.symbol)["symbols"][0]
+    def held_quantity(self, trade: Trade) -> float | None:
+        """
+        What the entry left us holding: the executed quantity minus the commission
+        paid in the base asset. None if the ledger is missing some of its fills.
+        """
+        fills = [fill for fill in trade.fills if fill.order_type == "open_order"]
+        executed = float(trade.open_order["executedQty"])
+        if round(sum(fill.quantity for fill in fills), 8) < executed:
+            return None
+        base_asset = self.get_symbol_info(trade.symbol)["baseAsset"]
+        return executed - sum(
+            fill.commission for fill in fills if fill.commission_asset == base_asset
+        )
 
-            fills = self.client.my_trades(
-                trade.symbol, orderId=trade.open_order["orderId"]
+    def fetch_entry_fills(self, trade: Trade) -> list[dict] | None:
+        """Exchange I/O only, for entries that filled while nobody was listening"""
+        try:
+            return [
+                fill_from_my_trade(my_trade)
+                for my_trade in self.client.my_trades(
+                    trade.symbol, orderId=trade.open_order["orderId"]
+                )
+            ]
+        except Exception as e:
+            self.logger.error(
+                f"Could not get fills of opening order => {trade.id}/{trade.symbol} : {e}"
             )
-            qty = float(trade.open_order["executedQty"]) - sum(
-                float(fill["commission"]) for fill in fills
+            return None
+
+    def place_exit_orders(
+        self, trade: Trade, quantity: float
+    ) -> dict[OrderType, dict] | None:
+        """
+        Protects a filled entry and returns the orders sent, by the Trade column
+        they go in (exchange I/O only). With OCO protection the take profit and
+        the stop limit go out as one order list, so the exchange stops us out.
+        """
+        params = {}
+        try:
+            info = self.get_symbol_info(trade.symbol)
+            templates = self.get_order_templates(trade)
+            quantity = decimal_string(format_quantity(quantity, info))
+            # Staged before order lists
+            oco_order = (
+                templates.get("oco_order")
+                or self.build_order_templates(trade, info)["oco_order"]
             )
-            params["quantity"] = format_quantity(qty, info)
-
-            current_price = self.get_price(trade.symbol)
-            target = format_price(trade.targets[TARGET_NUM], info)
-            if current_price > target:
-                params["type"] = "MARKET"
-            else:
-                params["type"] = "LIMIT"
-                params["timeInForce"] = "GTC"
-                params["price"] = target
-
-            response = self.client.new_order(**params)
-
-            trade.take_profit_order = response
-            self.session.add(trade)
-            self.session.commit()
-            self.logger.info(f"New close order => {trade.id} : {response}")
 
+            for attempt in (1, 2):
+                # Not get_price: a price some seconds old near a leg gets the
+                # order list rejected
+                price = self.fetch_price(trade.symbol)
+                if price >= float(templates["targets"][TARGET_NUM]["price"]):
+                    # Already past the target, just sell
+                    params = dict(templates["stop_loss_order"], quantity=quantity)
+                    return {"take_profit_order": self.client.new_order(**params)}
+                if self.protection == "POLLED":
+                    params = dict(templates["targets"][TARGET_NUM], quantity=quantity)
+                    return {"take_profit_order": self.client.new_order(**params)}
+                if price <= trade.stop_loss:
+                    # Already past the stop, the order list would be rejected
+                    params = dict(templates["stop_loss_order"], quantity=quantity)
+                    return {"stop_loss_order": self.client.new_order(**params)}
+
+                params = dict(oco_order, quantity=quantity)
+                try:
+                    return order_list_legs(self.client.new_oco_order(**params))
+                except ClientError as e:
+                    if attempt == 2 or not is_price_relationship_error(e):
+                        raise
+                    # The price crossed a leg since we looked, look again
+                    self.logger.info(
+                        f"Order list rejected at {price}, retrying => {trade.id}/{trade.symbol} : {e.error_message}"
+                    )
         except Exception as e:
             self.logger.error(
                 f"Could not create new close order => {trade.id}/{trade.symbol} : {params} : {e} {traceback.format_exc()}"
             )
-
-        return trade
+            return None
 
     def send_take_profit_orders(self, filledOrders: list[Trade]):
-        return [self.send_take_profit_order(trade) for trade in filledOrders]
+        # The FULL response or the user data stream normally brought the fills in
+        missing = [trade for trade in filledOrders if self.held_quantity(trade) is None]
+        for trade, fills in zip(missing, self.fan_out(self.fetch_entry_fills, missing)):
+            if fills is not None:
+                self.record_fills(
+                    trade, "open_order", trade.open_order["orderId"], fills
+                )
 
-    def send_cancel_take_profit_orders(self, trades: list[Trade]):
-        for trade in trades:
-            try:
-                trade.take_profit_order = self.client.cancel_order(
-                    trade.symbol, orderId=trade.take_profit_order["orderId"]
+        held = [(trade, self.held_quantity(trade)) for trade in filledOrders]
+        held = [(trade, quantity) for trade, quantity in held if quantity is not None]
+        for (trade, _), orders in zip(
+            held,
+            self.fan_out(lambda item: self.place_exit_orders(*item), held),
+        ):
+            if orders is None:
+                continue
+            for order_type, order in orders.items():
+                setattr(trade, order_type, order)
+                self.record_fills(
+                    trade, order_type, order["orderId"], fills_from_response(order)
                 )
-            except:
-                self.logger.info(
-                    f"Could not cancel close order => {trade.id}/{trade.symbol}"
+                self.logger.info(f"New {order_type} => {trade.id} : {order}")
+            if "take_profit_order" not in orders:
+                # Sold at the stop right away, nothing left to protect
+                trade.closed = 1
+            self.session.add(trade)
+        self.commit(durable=True)
+        return filledOrders
+
+    def cancel_take_profit_and_sell(
+        self, trade: Trade
+    ) -> tuple[dict[OrderType, dict], dict | None]:
+        """
+        Returns the cancelled orders, by the Trade column they go in, and the
+        market sell if it went through
+        """
+        if is_order_list(trade.take_profit_order):
+            return self.cancel_order_list_and_sell(trade)
+
+        cancelled = None
+        try:
+            cancelled = self.client.cancel_order(
+                trade.symbol, orderId=trade.take_profit_order["orderId"]
+            )
+        except:
+            self.logger.info(
+                f"Could not cancel close order => {trade.id}/{trade.symbol}"
+            )
+
+        try:
+            sold = self.client.new_order(
+                **self.get_order_templates(trade)["stop_loss_order"],
+                quantity=(cancelled or trade.take_profit_order)["origQty"],
+            )
+        except:
+            self.logger.error(f"Could not market order => {trade.id}/{trade.symbol}")
+            sold = None
+
+        return ({"take_profit_order": cancelled} if cancelled else {}), sold
+
+    def cancel_order_list_and_sell(
+        self, trade: Trade
+    ) -> tuple[dict[OrderType, dict], dict | None]:
+        """
+        cancel_take_profit_and_sell for an OCO. Only sells what the cancelled
+        list hadn't, a list that can't be cancelled has most likely filled.
+        """
+        try:
+            legs = order_list_legs(
+                self.client.cancel_oco_order(
+                    trade.symbol, orderListId=trade.take_profit_order["orderListId"]
                 )
+            )
+        except Exception as e:
+            self.logger.info(
+                f"Could not cancel order list => {trade.id}/{trade.symbol} : {e}"
+            )
+            return {}, None
 
-            try:
-                trade.stop_loss_order = self.client.new_order(
-                    **{
-                        "symbol": trade.symbol,
-                        "side": "SELL" if trade.side == "BUY" else "BUY",
-                        "type": "MARKET",
-                        "quantity": float(trade.take_profit_order["origQty"]),
-                        "newOrderRespType": "FULL",
-                    }
+        try:
+            quantity = float(legs["take_profit_order"]["origQty"]) - sum(
+                float(leg["executedQty"]) for leg in legs.values()
+            )
+            sold = self.client.new_order(
+                **self.get_order_templates(trade)["stop_loss_order"],
+                quantity=decimal_string(
+                    format_quantity(quantity, self.get_symbol_info(trade.symbol))
+                ),
+            )
+        except Exception as e:
+            self.logger.error(
+                f"Could not market order => {trade.id}/{trade.symbol} : {e}"
+            )
+            sold = None
+        return legs, sold
+
+    def send_cancel_take_profit_orders(self, trades: list[Trade]):
+        for trade, (cancelled, sold) in zip(
+            trades, self.fan_out(self.cancel_take_profit_and_sell, trades)
+        ):
+            for order_type, order in cancelled.items():
+                # Cancel responses don't say when the order was created
+                setattr(trade, order_type, dict(getattr(trade, order_type), **order))
+            if sold is not None:
+                trade.stop_loss_order = sold
+                self.record_fills(
+                    trade, "stop_loss_order", sold["orderId"], fills_from_response(sold)
                 )
                 trade.closed = 1
-                self.session.commit()
                 self.logger.info(f"Cancelled close order => {trade.id}/{trade.symbol}")
-            except:
-                self.logger.error(
-                    f"Could not market order => {trade.id}/{trade.symbol}"
-                )
-
-    def step(self):
-        self.logger.debug("--- NEW STEP ---")
+        self.commit(durable=True)
 
+    def detect_fills(self):
         pendingOpeningOrders = self.get_trades_with_pending_opening_order()
         self.logger.debug(f"Pending opening orders => {pendingOpeningOrders}")
         filledOpeningOrders = self.filter_trades_with_filled_order(
@@ -166,34 +418,38 @@ class SpotBot(Bot):
         pendingTakeProfitOrders = self.get_trades_with_pending_take_profit_order()
         self.logger.debug(f"Pending take_profit orders => {pendingTakeProfitOrders}")
         self.update_order_statuses(pendingTakeProfitOrders, "take_profit_order")
+        # Either leg of an order list can fill, the other one then expires
+        self.update_order_statuses(
+            [
+                trade
+                for trade in pendingTakeProfitOrders
+                if is_order_list(trade.stop_loss_order)
+            ],
+            "stop_loss_order",
+        )
+        self.close_finished_trades(pendingTakeProfitOrders)
 
         self.send_take_profit_orders(filledOpeningOrders)
 
-        # Cull orders taking too long to fill
+        # STOP LOSS
+        positions = self.get_trades_with_pending_take_profit_order()
+        self.watch_stop_losses(positions)
+        self.send_cancel_take_profit_orders(self.filter_need_to_stop_loss(positions))
+
+    def cull_expired_orders(self):
+        if self.defer("status", "expiry culling"):
+            return
         self.cancel_open_orders(
-            self.filter_trades_with_orders_taking_too_long_to_fill(
-                self.get_trades_with_pending_opening_order(),
-                "open_order",
-                ORDER_EXPIRY_TIME_HOURS,
-            )
-        )
-        self.send_cancel_take_profit_orders(
-            self.filter_trades_with_orders_taking_too_long_to_fill(
-                self.get_trades_with_pending_take_profit_order(),
-                "take_profit_order",
-                ORDER_EXPIRY_TIME_HOURS,
-            )
+            self.get_trades_with_expired_order("open_order", ORDER_EXPIRY_TIME_HOURS)
         )
-
-        # STOP LOSS
         self.send_cancel_take_profit_orders(
-            self.filter_need_to_stop_loss(
-                self.get_trades_with_pending_take_profit_order()
+            self.get_trades_with_expired_order(
+                "take_profit_order", ORDER_EXPIRY_TIME_HOURS
             )
         )
 
-        # Get account and balance information
-        account_balance = float(
+    def refresh_balance(self):
+        self.account_balance = float(
             [
                 b["free"]
                 for b in self.client.account()["balances"]
@@ -201,31 +457,64 @@ class SpotBot(Bot):
             ][0]
         )
 
-        if account_balance > ORDER_SIZE:
+    def open_new_trades(self):
+        self.stage_trades()
+        if self.defer("entry", "new entries", weight=10, orders=1):
+            return
+        if self.account_balance is None:
+            self.refresh_balance()
+
+        if self.account_balance > ORDER_SIZE:
             unseen_trades = self.get_unexecuted_trades(latest_first=True, limit=100)
             self.logger.debug(f"Unseen trades => {unseen_trades}")
+            self.watch_entries(unseen_trades)
             viable_trades = self.filter_viable_trades(unseen_trades)
             pendingOpeningOrders = self.send_open_orders(
-                itertools.islice(viable_trades, int(account_balance // ORDER_SIZE))
+                itertools.islice(viable_trades, int(self.account_balance // ORDER_SIZE))
             )
+            # Until the next balance refresh
+            self.account_balance -= ORDER_SIZE * len(pendingOpeningOrders)
         else:
             self.logger.debug("!!! Insufficient USDT balance !!!")
 
-        # TODO: Token accounting
+    def step(self):
+        self.logger.debug("--- NEW STEP ---")
+        self.begin_step()
+        with self.unit_of_work():
+            self.detect_fills()
+        with self.unit_of_work():
+            self.cull_expired_orders()
+        self.account_balance = None
+        with self.unit_of_work():
+            self.open_new_trades()
+        self.end_step()
+
+        # TODO: Token accounting, on top of the fills ledger (Trade.fills)
 
 
 def main():
+    migrate(engine, LOGGER)
     bot = SpotBot(BINANCE_API_KEY, BINANCE_API_SECRET, BINANCE_API_URL, SESSION, LOGGER)
-
-    while True:
-        try:
-            bot.step()
-        except Exception:
-            # logger.info detailed trace of the error
-            LOGGER.error("!!! step failed :/ !!!")
-            LOGGER.error(traceback.format_exc())
-
-        time.sleep(DELAY_BETWEEN_STEPS)
-
-
-main()
+    if BINANCE_STREAM_URL:
+        bot.start_price_feed(BINANCE_STREAM_URL)
+    if BINANCE_USER_STREAM_URL:
+        bot.start_order_events(BINANCE_USER_STREAM_URL)
+    if MEMORY_LOG_INTERVAL:
+        bot.track_memory(float(MEMORY_LOG_INTERVAL))
+
+    scheduler = StepScheduler(bot, LOGGER)
+    scheduler.every("fills", DELAY_BETWEEN_STEPS, bot.detect_fills)
+    scheduler.every("expiry", EXPIRY_CHECK_INTERVAL, bot.cull_expired_orders)
+    scheduler.every("balance", BALANCE_REFRESH_INTERVAL, bot.refresh_balance)
+    scheduler.every("intake", DELAY_BETWEEN_STEPS, bot.open_new_trades)
+    if bot.order_events is not None:
+        bot.order_events.on_update = scheduler.wakeup.set
+    CallListener(
+        CALL_SOCKETS["spot"], LOGGER, lambda trade_id: scheduler.trigger("intake")
+    ).start()
+
+    scheduler.run_forever()
+
+
+if __name__ == "__main__":
+    main()
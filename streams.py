@@ -0,0 +1,131 @@
+import json
+import threading
+from logging import Logger
+from autobahn.twisted.websocket import (
+    WebSocketServerFactory,
+    WebSocketServerProtocol,
+    connectWS,
+)
+from binance.websocket.websocket_client import BinanceWebsocketClient
+from twisted.internet import reactor
+
+
+_reactor_lock = threading.Lock()
+_reactor_thread: threading.Thread | None = None
+
+
+def ensure_reactor_running():
+    """
+    The twisted reactor is process-wide and can only be run once, so every
+    client and fake server in the process shares this one thread
+    """
+    global _reactor_thread
+    with _reactor_lock:
+        if _reactor_thread is None:
+            _reactor_thread = threading.Thread(
+                target=reactor.run,
+                kwargs={"installSignalHandlers": False},
+                name="reactor",
+                daemon=True,
+            )
+            _reactor_thread.start()
+
+
+class StreamClient(BinanceWebsocketClient):
+    """
+    The connector's websocket client, but it also accepts plain ws:// urls
+    so the bots can be pointed at a FakeStreamServer.
+    """
+
+    def start(self):
+        ensure_reactor_running()
+
+    def add_connection(self, stream_name, url):
+        if url.startswith("ws://"):
+            self._conns[stream_name] = connectWS(self.factories[stream_name])
+        else:
+            super().add_connection(stream_name, url)
+
+
+def load_recording(path: str) -> list:
+    """Messages written by OrderEventStream(record_path=...), ready for replay()"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class FakeStreamProtocol(WebSocketServerProtocol):
+    def onOpen(self):
+        self.factory.clients.add(self)
+
+    def onMessage(self, payload, isBinary):
+        # SUBSCRIBE / UNSUBSCRIBE requests from the client
+        try:
+            request = json.loads(payload.decode("utf8"))
+        except ValueError:
+            return
+        self.factory.requests.append(request)
+        if "id" in request:
+            self.sendMessage(
+                json.dumps({"result": None, "id": request["id"]}).encode("utf8")
+            )
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.clients.discard(self)
+
+
+class FakeStreamServer:
+    """
+    Local stand-in for the Binance stream endpoints, for testing without the
+    exchange. Whatever is passed to send()/replay() is pushed to every client.
+
+        server = FakeStreamServer(port=9999, logger=logger)
+        server.start()
+        bot.start_price_feed("ws://127.0.0.1:9999")
+        server.send([{"e": "markPriceUpdate", "s": "BTCUSDT", "p": "100.0", ...}])
+    """
+
+    def __init__(self, port: int, logger: Logger, host: str = "127.0.0.1"):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.factory = WebSocketServerFactory(f"ws://{host}:{port}")
+        self.factory.protocol = FakeStreamProtocol
+        self.factory.clients = set()
+        self.factory.requests = []
+        self._listener = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    @property
+    def requests(self) -> list[dict]:
+        return self.factory.requests
+
+    def start(self):
+        ensure_reactor_running()
+        reactor.callFromThread(self._listen)
+
+    def _listen(self):
+        self._listener = reactor.listenTCP(self.port, self.factory, interface=self.host)
+        self.logger.info(f"Fake stream server listening => {self.url}")
+
+    def stop(self):
+        if self._listener is not None:
+            reactor.callFromThread(self._listener.stopListening)
+
+    def send(self, message):
+        payload = json.dumps(message).encode("utf8")
+        reactor.callFromThread(self._broadcast, payload)
+
+    def _broadcast(self, payload: bytes):
+        for client in list(self.factory.clients):
+            client.sendMessage(payload, isBinary=False)
+
+    def replay(self, messages: list, interval: float = 0):
+        """Sends the messages in order, `interval` seconds apart"""
+        for i, message in enumerate(messages):
+            payload = json.dumps(message).encode("utf8")
+            reactor.callFromThread(
+                reactor.callLater, i * interval, self._broadcast, payload
+            )
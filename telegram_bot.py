@@ -1,12 +1,16 @@
+import argparse
 import datetime
 from telethon import TelegramClient, events
-from models import Trade
+from models import Trade, Watermark
 import os
 from dotenv import load_dotenv
 from parse_call import TradingCallParser
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from db import make_engine, make_session
 from utils import setup_logger
+from notify import CALL_SOCKETS, CallNotifier
+from migrate import migrate
+from call_index import CallIndex
+from sqlalchemy.dialects.sqlite import insert
 
 dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
 load_dotenv(dotenv_path)
@@ -16,66 +20,187 @@ client = TelegramClient(
 )
 
 # Create an engine that connects to the database
-engine = create_engine("sqlite:///tradingbot.db")
-session = sessionmaker(bind=engine)()
-Trade.metadata.create_all(engine, checkfirst=True)
+engine = make_engine()
+session = make_session(engine)
 
 logger = setup_logger("tradingbot")
+migrate(engine, logger)
+notifier = CallNotifier(list(CALL_SOCKETS.values()), logger)
+parser = TradingCallParser()
+
+CHANNEL = "Over99PercentWins"
+BACKFILL_DAYS = 5  # on the first start
+BATCH_SIZE = 500  # messages per commit when catching up
+DEBOUNCE = datetime.timedelta(minutes=5)  # same text within this is a duplicate
+
+call_index = CallIndex(DEBOUNCE)
+call_index.warm(session)
 
 
 def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Syncs the calls channel into the DB"
+    )
+    arg_parser.add_argument(
+        "--backfill-days",
+        type=float,
+        help=f"re-read this much history instead of resuming from the last message "
+        f"ingested (default {BACKFILL_DAYS} days when there's nothing to resume from)",
+    )
+    args = arg_parser.parse_args()
+
     client.start()
-    offset_date = (
-        datetime.datetime.now() - datetime.timedelta(days=5)
-    ).date()  # Get from 2 days ago
-    for message in client.iter_messages(
-        entity="Over99PercentWins",
-        offset_date=offset_date,
-        reverse=True,
-    ):
-        filter_and_save(message)
+    watermark = session.get(Watermark, CHANNEL)
+    if args.backfill_days is None and watermark is not None:
+        logger.info(f"Resuming => after {watermark}")
+        messages = client.iter_messages(
+            entity=CHANNEL, offset_id=watermark.message_id, reverse=True
+        )
+    else:
+        offset_date = datetime.datetime.now() - datetime.timedelta(
+            days=args.backfill_days or BACKFILL_DAYS
+        )
+        logger.info(f"Backfilling => since {offset_date}")
+        messages = client.iter_messages(
+            entity=CHANNEL, offset_date=offset_date, reverse=True
+        )
+
+    batch = []
+    for message in messages:
+        batch.append(message)
+        if len(batch) == BATCH_SIZE:
+            save_messages(batch)
+            batch = []
+    save_messages(batch)
 
 
 # save new messages as they arrive
-@client.on(events.NewMessage(chats="Over99PercentWins"))
+@client.on(events.NewMessage(chats=CHANNEL))
 async def handler(event):
-    filter_and_save(event.message)
+    save_messages([event.message])
+
 
+def utc(timestamp: datetime.datetime) -> datetime.datetime:
+    """Message dates are aware, the DB hands them back naive (in UTC)"""
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
 
-def filter_and_save(message):
-    if "setup" in message.text.lower():
-        if not session.query(Trade).get(message.id):
+
+def save_messages(messages: list):
+    """
+    Saves the calls among `messages` and marks the ones replied to as bragged.
+    The call index answers for recent calls, the DB is only asked (once for
+    the whole batch) about older ones. Commits with the watermark moved past
+    the batch, so a restart carries on from there.
+    """
+    if not messages:
+        return
+    newest = max(messages, key=lambda message: message.id)
+    texts = [message for message in messages if message.text is not None]
+    calls = [message for message in texts if "setup" in message.text.lower()]
+    replies = [
+        message
+        for message in texts
+        if message.reply_to_msg_id and "setup" not in message.text.lower()
+    ]
+
+    new_calls = []
+    if calls:
+        known = {message.id: call_index.is_call(message.id) for message in calls}
+        existing = {call_id for call_id, is_call in known.items() if is_call}
+        unknown = [call_id for call_id, is_call in known.items() if is_call is None]
+        if unknown:
+            existing.update(
+                trade_id
+                for (trade_id,) in session.query(Trade.id).filter(Trade.id.in_(unknown))
+            )
+        parsed = []
+        for message in calls:
+            if message.id in existing:
+                logger.debug(f"Already exists => {message.id}")
+                continue
             try:
-                new_call = TradingCallParser().parse(message)
-                if not is_duplicate(new_call):
-                    session.add(new_call)
-                    session.commit()
-                    logger.info("New call => " + str(new_call))
+                parsed.append(parser.parse(message))
             except Exception as e:
-                logger.error("Could not parse call => " + str(message.id) + str(e))
-        else:
-            logger.debug("Already exists => " + str(message.id))
-    else:
-        if message.reply_to_msg_id:
-            orig_call = session.query(Trade).get(message.reply_to_msg_id)
-            if orig_call is not None and orig_call.bragged == 0:
-                orig_call.bragged = 1
-                session.commit()
-                logger.info(f"Bragged/Cancelled => {message.reply_to_msg_id}")
-
-
-# for debouncing duplicate calls
-def is_duplicate(call: Trade):
-    duplicate = (
-        session.query(Trade)
-        .filter(Trade.timestamp > call.timestamp - datetime.timedelta(minutes=5))
-        .filter(Trade.texthash == call.texthash)
-        .first()
+                logger.error(f"Could not parse call => {message.id} : {e}")
+
+        # texthash -> timestamps, of older calls a new one could be a duplicate of
+        seen: dict[str, list[datetime.datetime]] = {}
+        uncovered = [
+            call for call in parsed if not call_index.covers_time(utc(call.timestamp))
+        ]
+        if uncovered:
+            since = min(utc(call.timestamp) for call in uncovered) - DEBOUNCE
+            for texthash, timestamp in session.query(
+                Trade.texthash, Trade.timestamp
+            ).filter(
+                Trade.texthash.in_({call.texthash for call in uncovered}),
+                Trade.timestamp > since,
+            ):
+                seen.setdefault(texthash, []).append(timestamp)
+        for call in parsed:
+            timestamp = utc(call.timestamp)
+            if call_index.is_duplicate(call.texthash, timestamp) or any(
+                seen_at > timestamp - DEBOUNCE
+                for seen_at in seen.get(call.texthash, [])
+            ):
+                continue
+            call_index.add_call(call.id, call.texthash, timestamp)
+            new_calls.append(call)
+        session.add_all(new_calls)
+        session.flush()
+        for call in new_calls:
+            # Not the whole repr, its unset order columns would each be a SELECT
+            logger.info(
+                f"New call => {call.id}/{call.symbol} {call.side} entry={call.entry} "
+                f"stop_loss={call.stop_loss} targets={call.targets}"
+            )
+
+    bragged = set()
+    if replies:
+        unknown = []
+        for message in replies:
+            call_id = message.reply_to_msg_id
+            is_call = call_index.is_call(call_id)
+            if is_call is None:
+                unknown.append(call_id)
+            elif is_call and not call_index.is_bragged(call_id):
+                bragged.add(call_id)
+        if unknown:
+            bragged.update(
+                trade_id
+                for (trade_id,) in session.query(Trade.id).filter(
+                    Trade.id.in_(unknown), Trade.bragged == 0
+                )
+            )
+        if bragged:
+            session.query(Trade).filter(Trade.id.in_(bragged)).update(
+                {Trade.bragged: 1}, synchronize_session=False
+            )
+            for trade_id in bragged:
+                call_index.mark_bragged(trade_id)
+                logger.info(f"Bragged/Cancelled => {trade_id}")
+
+    if not new_calls and not bragged and len(messages) < BATCH_SIZE:
+        # Chatter. Not worth a write, a restart would just read it again.
+        session.rollback()
+        return
+    session.execute(
+        insert(Watermark)
+        .values(channel=CHANNEL, message_id=newest.id, message_date=utc(newest.date))
+        .on_conflict_do_update(
+            index_elements=[Watermark.channel],
+            set_={"message_id": newest.id, "message_date": utc(newest.date)},
+            where=Watermark.message_id < newest.id,
+        )
     )
-    if duplicate:
-        return True
-    else:
-        return False
+    newest_call = max((call.id for call in new_calls), default=None)
+    session.commit()
+
+    if newest_call is not None:
+        # One wakeup is enough, the bots pick up every new call in one go
+        notifier.notify(newest_call)
 
 
 main()
@@ -0,0 +1,105 @@
+"""ExchangeInfoCache with a counting fetch instead of the exchange"""
+import logging
+import os
+import tempfile
+from exchange_cache import ExchangeInfoCache
+
+logger = logging.getLogger("test")
+
+EXCHANGE_INFO = {
+    "symbols": [
+        {
+            "symbol": "BTCUSDT",
+            "status": "TRADING",
+            "filters": [
+                {
+                    "filterType": "PRICE_FILTER",
+                    "minPrice": "0.01",
+                    "maxPrice": "1000000",
+                    "tickSize": "0.01",
+                },
+                {
+                    "filterType": "LOT_SIZE",
+                    "minQty": "0.00001",
+                    "maxQty": "9000",
+                    "stepSize": "0.00001",
+                },
+            ],
+        }
+    ],
+    "rateLimits": [
+        {"rateLimitType": "REQUEST_WEIGHT", "interval": "MINUTE", "limit": 1200}
+    ],
+}
+
+
+class CountingFetch:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self) -> dict:
+        self.calls += 1
+        return EXCHANGE_INFO
+
+
+def test_get_indexes_filters_and_precisions():
+    fetch = CountingFetch()
+    cache = ExchangeInfoCache(fetch, None, ttl=60, logger=logger)
+    info = cache.get("BTCUSDT")
+    assert fetch.calls == 1
+    assert info["filterIndex"]["LOT_SIZE"]["stepSize"] == "0.00001"
+    assert info["tickPrecision"] == 2
+    assert info["stepPrecision"] == 5
+    assert cache.rate_limits == EXCHANGE_INFO["rateLimits"]
+    assert not cache.is_stale()
+
+    cache.get("BTCUSDT")
+    assert fetch.calls == 1
+
+
+def test_unknown_symbols_refresh_at_most_once_a_minute():
+    fetch = CountingFetch()
+    cache = ExchangeInfoCache(fetch, None, ttl=60, logger=logger)
+    cache.get("BTCUSDT")
+    for _ in range(3):
+        try:
+            cache.get("NEWUSDT")
+            assert False, "expected KeyError"
+        except KeyError:
+            pass
+    assert fetch.calls == 1
+
+    # Past MISS_REFRESH_SECONDS a miss may be a new listing, look once more
+    cache.updated_at -= cache.MISS_REFRESH_SECONDS + 1
+    try:
+        cache.get("NEWUSDT")
+    except KeyError:
+        pass
+    assert fetch.calls == 2
+
+
+def test_warm_start_from_disk():
+    path = os.path.join(tempfile.mkdtemp(), "exchange_info.json")
+    fetch = CountingFetch()
+    ExchangeInfoCache(fetch, path, ttl=60, logger=logger).refresh()
+    assert fetch.calls == 1
+
+    restarted = ExchangeInfoCache(fetch, path, ttl=60, logger=logger)
+    assert not restarted.is_stale()
+    assert restarted.get("BTCUSDT")["tickPrecision"] == 2
+    assert restarted.rate_limits == EXCHANGE_INFO["rateLimits"]
+    assert fetch.calls == 1
+
+    # A cache older than the ttl still loads, but is due a refresh
+    assert ExchangeInfoCache(fetch, path, ttl=0, logger=logger).is_stale()
+
+
+def test_unreadable_cache_file_is_ignored():
+    path = os.path.join(tempfile.mkdtemp(), "exchange_info.json")
+    with open(path, "w") as f:
+        f.write("{not json")
+    fetch = CountingFetch()
+    cache = ExchangeInfoCache(fetch, path, ttl=60, logger=logger)
+    assert cache.symbols == {}
+    assert cache.get("BTCUSDT")["symbol"] == "BTCUSDT"
+    assert fetch.calls == 1
@@ -0,0 +1,141 @@
+"""
+PriceFeed and OrderEventStream against a FakeStreamServer, end to end over a
+local websocket
+"""
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+from order_events import OrderEventStream
+from prices import PriceBook, PriceFeed
+from streams import FakeStreamServer
+
+logger = logging.getLogger("test")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def start_server() -> FakeStreamServer:
+    server = FakeStreamServer(port=free_port(), logger=logger)
+    server.start()
+    wait_for(lambda: server._listener is not None)
+    return server
+
+
+class ListenKeyClient:
+    """The listen key calls OrderEventStream makes on the REST client"""
+
+    def new_listen_key(self):
+        return {"listenKey": "test-key"}
+
+    def renew_listen_key(self, listen_key):
+        pass
+
+
+def execution_report(order_id: int, status: str) -> dict:
+    return {
+        "e": "executionReport",
+        "s": "BTCUSDT",
+        "i": order_id,
+        "c": f"trade-{order_id}",
+        "X": status,
+        "x": "TRADE",
+        "z": "0.5",
+        "Z": "50.0",
+        "T": 1700000000000,
+        "l": "0.5",
+        "L": "100.0",
+        "n": "0.0005",
+        "N": "BTC",
+        "t": 7,
+    }
+
+
+def test_price_feed_fills_the_book():
+    server = start_server()
+    book = PriceBook()
+    feed = PriceFeed(server.url, "!markPrice@arr@1s", "p", book, logger)
+    feed.start()
+    try:
+        wait_for(lambda: server.requests)
+        assert server.requests[0]["method"] == "SUBSCRIBE"
+        assert server.requests[0]["params"] == ["!markPrice@arr@1s"]
+
+        server.send(
+            [
+                {"e": "markPriceUpdate", "s": "BTCUSDT", "p": "100.5"},
+                {"e": "markPriceUpdate", "s": "ETHUSDT", "p": "10.25"},
+            ]
+        )
+        wait_for(lambda: book.get("ETHUSDT", 60) is not None)
+        assert book.get("BTCUSDT", 60) == 100.5
+        assert book.get("ETHUSDT", 60) == 10.25
+        assert feed.is_alive(5)
+
+        # Errors and non-array messages leave the book alone
+        server.send({"e": "error", "m": "nope"})
+        server.send([{"e": "markPriceUpdate", "s": "BTCUSDT", "p": "101"}])
+        wait_for(lambda: book.get("BTCUSDT", 60) == 101)
+        assert book.get("ETHUSDT", 60) == 10.25
+    finally:
+        feed.stop()
+        server.stop()
+
+
+def test_order_events_are_queued_and_recorded():
+    server = start_server()
+    record_path = os.path.join(tempfile.mkdtemp(), "events.jsonl")
+    stream = OrderEventStream(ListenKeyClient(), server.url, logger, record_path)
+    woken = []
+    stream.on_update = lambda: woken.append(True)
+    stream.start()
+    try:
+        wait_for(lambda: server.requests)
+        assert server.requests[0]["params"] == ["test-key"]
+
+        server.replay(
+            [
+                execution_report(1, "PARTIALLY_FILLED"),
+                {"e": "outboundAccountPosition"},
+                execution_report(1, "FILLED"),
+            ]
+        )
+        wait_for(lambda: len(woken) == 2)
+        assert stream.wakeup.is_set()
+        updates = stream.drain()
+        assert [(u["orderId"], u["status"]) for u in updates] == [
+            (1, "PARTIALLY_FILLED"),
+            (1, "FILLED"),
+        ]
+        assert updates[0]["clientOrderId"] == "trade-1"
+        assert updates[0]["tradeId"] == 7
+        assert not stream.wakeup.is_set()
+        assert stream.drain() == []
+
+        # Every event is recorded, order updates or not (next to the subscribe ack)
+        with open(record_path) as f:
+            recorded = [json.loads(line) for line in f]
+        assert [message["e"] for message in recorded if "e" in message] == [
+            "executionReport",
+            "outboundAccountPosition",
+            "executionReport",
+        ]
+
+        server.send({"e": "listenKeyExpired"})
+        wait_for(lambda: not stream.alive)
+    finally:
+        stream.stop()
+        server.stop()
@@ -0,0 +1,201 @@
+import bisect
+from collections import defaultdict
+
+INF = float("inf")
+
+
+def left_open(levels: list[tuple[float, int]], low: float, high: float) -> list:
+    """The (level, trade id)s of sorted `levels` with low < level <= high"""
+    start = bisect.bisect_right(levels, (low, INF))
+    end = bisect.bisect_right(levels, (high, INF))
+    return levels[start:end]
+
+
+def right_open(levels: list[tuple[float, int]], low: float, high: float) -> list:
+    """The (level, trade id)s of sorted `levels` with low <= level < high"""
+    start = bisect.bisect_left(levels, (low, -INF))
+    end = bisect.bisect_left(levels, (high, -INF))
+    return levels[start:end]
+
+
+class Zones:
+    """
+    One symbol's price zones (entry ranges), a trade being triggered while
+    low <= price <= high. Lows and highs are kept sorted, so a price move
+    only looks at the bounds it crossed.
+    """
+
+    def __init__(self, price: float | None = None):
+        self.lows: list[tuple[float, int]] = []
+        self.highs: list[tuple[float, int]] = []
+        self.bounds: dict[int, tuple[float, float]] = {}
+        self.price = price
+        self.triggered: set[int] = set()
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def add(self, trade_id: int, low: float, high: float):
+        bisect.insort(self.lows, (low, trade_id))
+        bisect.insort(self.highs, (high, trade_id))
+        self.bounds[trade_id] = (low, high)
+        if self.price is not None and low <= self.price <= high:
+            self.triggered.add(trade_id)
+
+    def remove(self, trade_id: int):
+        low, high = self.bounds.pop(trade_id)
+        del self.lows[bisect.bisect_left(self.lows, (low, trade_id))]
+        del self.highs[bisect.bisect_left(self.highs, (high, trade_id))]
+        self.triggered.discard(trade_id)
+
+    def move(self, price: float | None) -> set[int]:
+        """Returns the trades whose zone the price just moved into"""
+        old, self.price = self.price, price
+        if price is None:
+            self.triggered.clear()
+            return set()
+        if old is None:
+            self.triggered = {
+                trade_id
+                for trade_id, (low, high) in self.bounds.items()
+                if low <= price <= high
+            }
+            return set(self.triggered)
+        if price == old:
+            return set()
+        low, high = min(old, price), max(old, price)
+        # The lows in (low, high] and the highs in [low, high) were crossed
+        lows = left_open(self.lows, low, high)
+        highs = right_open(self.highs, low, high)
+        if price > old:
+            # In if its low was crossed on the way up, out if its high was
+            entered = {
+                trade_id for _, trade_id in lows if self.bounds[trade_id][1] >= price
+            }
+            left = highs
+        else:
+            entered = {
+                trade_id for _, trade_id in highs if self.bounds[trade_id][0] <= price
+            }
+            left = lows
+        self.triggered.difference_update(trade_id for _, trade_id in left)
+        self.triggered |= entered
+        return entered
+
+
+class Levels:
+    """
+    One symbol's price levels (stops, targets), a trade being triggered while
+    the price is below its level (or above, for the ones added with
+    below=False). Sorted like Zones.
+    """
+
+    def __init__(self, price: float | None = None):
+        self.below: list[tuple[float, int]] = []
+        self.above: list[tuple[float, int]] = []
+        self.levels: dict[int, tuple[float, bool]] = {}
+        self.price = price
+        self.triggered: set[int] = set()
+
+    def __len__(self):
+        return len(self.levels)
+
+    def add(self, trade_id: int, level: float, below: bool):
+        bisect.insort(self.below if below else self.above, (level, trade_id))
+        self.levels[trade_id] = (level, below)
+        if self.price is not None and (
+            self.price < level if below else self.price > level
+        ):
+            self.triggered.add(trade_id)
+
+    def remove(self, trade_id: int):
+        level, below = self.levels.pop(trade_id)
+        levels = self.below if below else self.above
+        del levels[bisect.bisect_left(levels, (level, trade_id))]
+        self.triggered.discard(trade_id)
+
+    def move(self, price: float | None) -> set[int]:
+        """Returns the trades whose level the price just crossed"""
+        old, self.price = self.price, price
+        if price is None:
+            self.triggered.clear()
+            return set()
+        if old is None:
+            self.triggered = {
+                trade_id for _, trade_id in left_open(self.below, price, INF)
+            }
+            self.triggered.update(
+                trade_id for _, trade_id in right_open(self.above, -INF, price)
+            )
+            return set(self.triggered)
+        low, high = min(old, price), max(old, price)
+        # Levels in (low, high] are below one price and not the other, same
+        # for levels in [low, high) and above
+        below = {trade_id for _, trade_id in left_open(self.below, low, high)}
+        above = {trade_id for _, trade_id in right_open(self.above, low, high)}
+        crossed, uncrossed = (below, above) if price < old else (above, below)
+        self.triggered -= uncrossed
+        self.triggered |= crossed
+        return crossed
+
+
+class TriggerIndex:
+    """
+    The price levels of the live trades, by kind ("entry", "stop", ...) and
+    symbol. A price update for a symbol costs O(log n + levels crossed), not
+    a pass over every trade, see Bot.move_triggers.
+    """
+
+    def __init__(self):
+        self.books: dict[str, dict[str, Zones | Levels]] = defaultdict(dict)
+        self.watched: dict[str, dict[int, tuple]] = defaultdict(dict)
+        self.prices: dict[str, float | None] = {}
+
+    def watch_zones(self, kind: str, zones: dict[int, tuple[str, float, float]]):
+        """Replaces the watched `kind` zones with {trade id: (symbol, low, high)}"""
+        self._watch(kind, zones, Zones)
+
+    def watch_levels(self, kind: str, levels: dict[int, tuple[str, float, bool]]):
+        """Replaces the watched `kind` levels with {trade id: (symbol, level, below)}"""
+        self._watch(kind, levels, Levels)
+
+    def _watch(self, kind: str, entries: dict[int, tuple], book_class):
+        books = self.books[kind]
+        watched = self.watched[kind]
+        for trade_id, entry in list(watched.items()):
+            if entries.get(trade_id) != entry:
+                books[entry[0]].remove(trade_id)
+                del watched[trade_id]
+        for trade_id, (symbol, *bounds) in entries.items():
+            if trade_id in watched:
+                continue
+            if symbol not in books:
+                books[symbol] = book_class(self.prices.get(symbol))
+            books[symbol].add(trade_id, *bounds)
+            watched[trade_id] = (symbol, *bounds)
+        for symbol in [symbol for symbol, book in books.items() if not book]:
+            del books[symbol]
+
+    def symbols(self) -> set[str]:
+        return {symbol for books in self.books.values() for symbol in books}
+
+    def move(self, symbol: str, price: float | None) -> dict[str, set[int]]:
+        """
+        Moves `symbol` to `price` (None when it's unknown or stale) and returns
+        the newly triggered trades by kind
+        """
+        if symbol in self.prices and self.prices[symbol] == price:
+            return {}
+        self.prices[symbol] = price
+        return {
+            kind: books[symbol].move(price)
+            for kind, books in self.books.items()
+            if symbol in books
+        }
+
+    def triggered(self, kind: str) -> set[int]:
+        return set().union(*(book.triggered for book in self.books[kind].values()))
+
+    def is_triggered(self, kind: str, trade_id: int) -> bool:
+        entry = self.watched[kind].get(trade_id)
+        return entry is not None and trade_id in self.books[kind][entry[0]].triggered
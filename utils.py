@@ -2,6 +2,7 @@ import sys
 import math
 import logging
 import datetime
+from decimal import Decimal
 from models import Trade
 
 
@@ -35,21 +36,68 @@ def step_size_to_precision(step_size: str) -> int:
     return -int(math.log10(x))
 
 
-def format_quantity(qty: float, exchange_info):
-    qty_precision = step_size_to_precision(
+def quantity_precision(exchange_info) -> int:
+    if "stepPrecision" in exchange_info:
+        return exchange_info["stepPrecision"]
+    return step_size_to_precision(
         [
             i["stepSize"]
             for i in exchange_info["filters"]
             if i["filterType"] == "LOT_SIZE"
         ][0]
     )
-    return round_down_to_precision(qty, qty_precision)
 
 
-def format_price(price: float, exchange_info):
-    price_precision = step_size_to_precision(
+def price_precision(exchange_info) -> int:
+    if "tickPrecision" in exchange_info:
+        return exchange_info["tickPrecision"]
+    return step_size_to_precision(
         [i for i in exchange_info["filters"] if i["filterType"] == "PRICE_FILTER"][0][
             "tickSize"
         ]
     )
-    return round_down_to_precision(price, price_precision)
+
+
+def format_quantity(qty: float, exchange_info):
+    return round_down_to_precision(qty, quantity_precision(exchange_info))
+
+
+def format_price(price: float, exchange_info):
+    return round_down_to_precision(price, price_precision(exchange_info))
+
+
+def decimal_string(value) -> str:
+    """str() for order params, without scientific notation for small floats"""
+    if isinstance(value, float):
+        return format(Decimal(repr(value)), "f")
+    return str(value)
+
+
+def check_order_filters(params: dict, exchange_info):
+    """Raises ValueError if the order would be rejected by the symbol's filters"""
+    filters = exchange_info["filterIndex"]
+    price = params.get("price", params.get("stopPrice"))
+    price = float(price) if price is not None else None
+    quantity = params.get("quantity")
+    quantity = float(quantity) if quantity is not None else None
+
+    price_filter = filters.get("PRICE_FILTER")
+    if price is not None and price_filter:
+        if float(price_filter["minPrice"]) and price < float(price_filter["minPrice"]):
+            raise ValueError(f"price {price} below {price_filter['minPrice']}")
+        if float(price_filter["maxPrice"]) and price > float(price_filter["maxPrice"]):
+            raise ValueError(f"price {price} above {price_filter['maxPrice']}")
+
+    lot_size = filters.get("LOT_SIZE")
+    if quantity is not None and lot_size:
+        if quantity < float(lot_size["minQty"]):
+            raise ValueError(f"quantity {quantity} below {lot_size['minQty']}")
+        if quantity > float(lot_size["maxQty"]):
+            raise ValueError(f"quantity {quantity} above {lot_size['maxQty']}")
+
+    # Futures call it MIN_NOTIONAL/notional, spot NOTIONAL (or MIN_NOTIONAL)/minNotional
+    notional = filters.get("NOTIONAL") or filters.get("MIN_NOTIONAL")
+    if price is not None and quantity is not None and notional:
+        min_notional = float(notional.get("minNotional") or notional.get("notional"))
+        if price * quantity < min_notional:
+            raise ValueError(f"notional {price * quantity} below {min_notional}")